@@ -1,10 +1,187 @@
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
 import numpy as np
 
-# Change directory by uncommenting and passing the appropriate directory path
-# os.chdir('D:/Downloads/')
+from instrumentation import instrumented
+
+# Population share tables (NYC, 2019) used to normalize the record counts. The row-wise functions below
+# and the vectorized lookup engine both read from these tables, so the values only live in one place.
+# Age data retrieved from: https://www.statista.com/statistics/911456/new-york-population-share-age-group/
+AGE_POPULATION_SHARE = {
+    '<18': 0.232,
+    '18-24': 0.065,
+    '25-44': 0.272,
+    '45-64': 0.261,
+    '65+': 0.17,
+}
+
+# Race data retrieved from: https://worldpopulationreview.com/us-cities/new-york-city-ny-population
+RACE_POPULATION_SHARE = {
+    'AMERICAN INDIAN/ALASKAN NATIVE': 0.0043,
+    'ASIAN / PACIFIC ISLANDER': 0.14,
+    'BLACK': 0.2195,
+    'BLACK HISPANIC': 0.0233,
+    'WHITE': 0.3214,
+    'WHITE HISPANIC': 0.1053,
+    '(null)': 0.1862,
+    'UNKNOWN': 0.1862,
+}
+
+SEX_POPULATION_SHARE = {
+    'MALE': 0.4767,
+    'FEMALE': 0.5233,
+}
+
+# Number of rows the lookups and groupbys over whole datasets process at a time. The slices are views of the
+# input, so the factorization codes and hash tables of these passes never cover more than SLICE_ROWS rows.
+SLICE_ROWS = 250_000
+
+
+# This function splits a dataframe or series into consecutive slices of rows without copying it
+def row_slices(df, rows=SLICE_ROWS):
+    """
+    This function returns a generator of consecutive row slices of a dataframe or series. The slices are
+    views (iloc slices), so the data is not copied. An empty input gives one empty slice.
+
+    :param df: Dataframe or series to be split
+    :param rows: Maximum number of rows per slice
+    :return: Generator of dataframes or series
+
+    >>> [len(part) for part in row_slices(pd.DataFrame({'col1': range(5)}), 2)]
+    [2, 2, 1]
+    """
+    return (df.iloc[start:start + rows] for start in range(0, max(len(df), 1), rows))
+
+
+# This function checks an unmapped policy and returns the share given to the labels it applies to
+def unmapped_fill(unmapped):
+    """
+    This function validates the unmapped policy of the population share lookups and returns the share that
+    unmapped labels get: NaN for 'nan' and 'raise', the number itself for a numeric fill. A numeric fill must
+    be positive since the counts are divided by the shares, and booleans are not accepted as numbers.
+
+    :param unmapped: Policy for labels that are not found in shares - 'nan', 'raise' or a positive fill value
+    :return: The fill value as a float
+
+    >>> unmapped_fill('nan'), unmapped_fill(0.05)
+    (nan, 0.05)
+    >>> unmapped_fill(0)
+    Traceback (most recent call last):
+    ...
+    ValueError: unmapped must be 'nan', 'raise' or a positive number, got 0
+    >>> unmapped_fill(True)
+    Traceback (most recent call last):
+    ...
+    ValueError: unmapped must be 'nan', 'raise' or a positive number, got True
+    """
+    if isinstance(unmapped, str) and unmapped in ('nan', 'raise'):
+        return np.nan
+    if isinstance(unmapped, (int, float)) and not isinstance(unmapped, bool) and unmapped > 0:
+        return float(unmapped)
+    raise ValueError("unmapped must be 'nan', 'raise' or a positive number, got {!r}".format(unmapped))
+
+
+# This function maps a column of demographic labels onto their population share in a single vectorized pass
+@instrumented
+def population_share_lookup(values, shares, unmapped='nan'):
+    """
+    This function is the shared lookup engine behind age_pct_col, race_pct_col and sex_pct_col.
+    Instead of running a Python if-chain once per row, the labels are factorized once (each distinct
+    label is hashed a single time) and the population shares are gathered with one NumPy indexing step.
+    Categorical input is supported and only its categories are looked up.
+
+    Unmapped policy - what happens to labels (and missing values) that are not present in the table:
+    'nan' : the row gets NaN, which matches the behaviour of the original row-wise functions
+    'raise' : a ValueError listing the unmapped labels is raised
+    a positive number : the row gets that number as its population share
+
+    :param values: Series (or array-like) of demographic labels
+    :param shares: Dictionary mapping each label to its share of the total population
+    :param unmapped: Policy for labels that are not found in shares - 'nan', 'raise' or a positive fill value
+    :return: Float series of population shares, aligned to the index of values
+
+    >>> population_share_lookup(pd.Series(['25-44', '<18', '65+']), AGE_POPULATION_SHARE)
+    0    0.272
+    1    0.232
+    2    0.170
+    dtype: float64
+
+    >>> population_share_lookup(pd.Series(['MALE', 'OTHER', None]), SEX_POPULATION_SHARE)
+    0    0.4767
+    1       NaN
+    2       NaN
+    dtype: float64
+
+    >>> population_share_lookup(pd.Series(['MALE', 'OTHER']), SEX_POPULATION_SHARE, unmapped=0.05)
+    0    0.4767
+    1    0.0500
+    dtype: float64
+
+    >>> population_share_lookup(pd.Series(['MALE', 'OTHER']), SEX_POPULATION_SHARE, unmapped='raise')
+    Traceback (most recent call last):
+    ...
+    ValueError: No population share found for label(s): ['OTHER']
+    """
+    if not isinstance(values, pd.Series):
+        values = pd.Series(values)
+
+    fill = unmapped_fill(unmapped)
+
+    # The shares are gathered slice by slice into one preallocated array, so the factorization only ever
+    # holds the codes of SLICE_ROWS rows besides the result
+    result = np.empty(len(values), dtype='float64')
+    missing = {}
+    has_missing_values = False
+    for start in range(0, len(values), SLICE_ROWS):
+        codes, uniques = pd.factorize(values.iloc[start:start + SLICE_ROWS])
+        labels = list(uniques)
+        missing.update(dict.fromkeys(label for label in labels if label not in shares))
+        has_missing_values = has_missing_values or bool((codes == -1).any())
+        # The trailing fill value is picked up by the -1 code that pd.factorize assigns to missing values
+        table = np.array([shares.get(label, fill) for label in labels] + [fill], dtype='float64')
+        result[start:start + len(codes)] = table[codes]
+
+    if isinstance(unmapped, str) and unmapped == 'raise' and (missing or has_missing_values):
+        raise ValueError('No population share found for label(s): {}'.format(list(missing) or [None]))
+    # copy=False, the Series constructor would otherwise copy the array
+    return pd.Series(result, index=values.index, copy=False)
+
+
+# This function appends a population share column to a dataframe using the vectorized lookup engine
+@instrumented
+def add_population_share(df, col, shares, new_col, unmapped='nan', inplace=False):
+    """
+    This function adds a population share column to a dataframe based on the labels of an existing column.
+    It is the common implementation of age_pct_col, race_pct_col and sex_pct_col.
+
+    Only the new column is allocated. By default it is added to a shallow copy of df, which shares the data
+    of the existing columns with df, so df itself is left unchanged. With inplace=True it is added to df.
+
+    :param df: Dataframe to which the population share column has to be appended
+    :param col: Column holding the demographic labels
+    :param shares: Dictionary mapping each label to its share of the total population
+    :param new_col: Name of the population share column to be added
+    :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+    :param inplace: Whether the column is added to df itself instead of a shallow copy
+    :return: Dataframe with the added population share column
+
+    >>> df = pd.DataFrame({'SEX': ['FEMALE', 'MALE']})
+    >>> add_population_share(df, 'SEX', SEX_POPULATION_SHARE, 'POP_BY_SEX_PCT')
+          SEX  POP_BY_SEX_PCT
+    0  FEMALE          0.5233
+    1    MALE          0.4767
+    >>> list(df.columns)
+    ['SEX']
+    >>> add_population_share(df, 'SEX', SEX_POPULATION_SHARE, 'POP_BY_SEX_PCT', inplace=True) is df
+    True
+    >>> list(df.columns)
+    ['SEX', 'POP_BY_SEX_PCT']
+    """
+    values = population_share_lookup(df[col], shares, unmapped)
+    result = df if inplace else df.copy(deep=False)
+    result[new_col] = values
+    return result
+
 
 # This function generates a series to denote age group distribution
 def age_distribution(row, colname) -> pd.core.series.Series:
@@ -39,27 +216,24 @@ def age_distribution(row, colname) -> pd.core.series.Series:
 
         """
 
-    if row[colname] == '25-44':
-        return 0.272
-    if row[colname] == '18-24':
-        return 0.065
-    if row[colname] == '45-64':
-        return 0.261
-    if row[colname] == '<18':
-        return 0.232
-    if row[colname] == '65+':
-        return 0.17
+    return AGE_POPULATION_SHARE.get(row[colname])
 
 
 # This function adds the age percentage column to a dataframe that has the 'AGE_GROUP' column
-def age_pct_col(df):
+@instrumented
+def age_pct_col(df, year_col=None, geography='NYC', registry=None, inplace=False):
     """
     This function allows us to add the age percentage column to an existing
     dataframe that contains the 'AGE_GROUP' column. Addition of this new column
-    is an intermediate step to allow normalizing the values. Within this function
-    another function - age_distribution is used.
+    is an intermediate step to allow normalizing the values. The shares come from
+    AGE_POPULATION_SHARE through the vectorized add_population_share lookup.
 
     :param df: Dataframe to which the age percentage column has to be appended
+    :param year_col: Optional column with the year (or date) of every record. When given, the share of every
+                     record is taken from the population baseline of its own year (see population_baselines)
+    :param geography: Geography of the population baselines used with year_col
+    :param registry: Optional population_baselines.BaselineRegistry used with year_col
+    :param inplace: Whether the column is added to df itself instead of a shallow copy (see add_population_share)
     :return: Dataframe with the added column - age percentage distribution
 
     >>> df = pd.DataFrame({'AGE_GROUP': ['25-44', '18-24', '45-64', '<18', '65+']})
@@ -84,13 +258,15 @@ def age_pct_col(df):
     7     45-64           0.261
     8       <18           0.232
     """
-    age_pct = pd.DataFrame(df.apply(lambda row: age_distribution(row, 'AGE_GROUP'), axis=1))
-    age_pct.rename(columns={0: 'POP_BY_AGE_PCT'}, inplace=True)
-    df = pd.concat([df, age_pct], axis=1)
-    return df
+    if year_col is not None:
+        from population_baselines import AGE, add_population_share_by_year
+        return add_population_share_by_year(df, 'AGE_GROUP', year_col, AGE, 'POP_BY_AGE_PCT', geography, registry,
+                                            inplace=inplace)
+    return add_population_share(df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT', inplace=inplace)
 
 
 # This function allows selection of specific/required column(s) from a dataframe
+@instrumented
 def select_columns(df, *args):
     """
     This function is used to select particular columns from dataframes.
@@ -191,33 +367,24 @@ def race_percentage(row, colname):
 
     """
 
-    if row[colname] == 'AMERICAN INDIAN/ALASKAN NATIVE':
-        return 0.0043
-    if row[colname] == 'ASIAN / PACIFIC ISLANDER':
-        return 0.14
-    if row[colname] == 'BLACK':
-        return 0.2195
-    if row[colname] == 'BLACK HISPANIC':
-        return 0.0233
-    if row[colname] == 'WHITE':
-        return 0.3214
-    if row[colname] == 'WHITE HISPANIC':
-        return 0.1053
-    if row[colname] == '(null)':
-        return 0.1862
-    if row[colname] == 'UNKNOWN':
-        return 0.1862
-    
+    return RACE_POPULATION_SHARE.get(row[colname])
 
-def race_pct_col(df, col):
+
+@instrumented
+def race_pct_col(df, col, year_col=None, geography='NYC', registry=None, inplace=False):
     """
     This function allows us to add the racial percentage column to an existing
     dataframe that contains the race column. Addition of this new column
-    is an intermediate step to allow normalizing the values. Within this function
-    another function - race_percentage is used.
+    is an intermediate step to allow normalizing the values. The shares come from
+    RACE_POPULATION_SHARE through the vectorized add_population_share lookup.
 
     :param df: Dataframe to which the racial percentage column has to be appended
     :param col: Column used for calculating the race percentage
+    :param year_col: Optional column with the year (or date) of every record. When given, the share of every
+                     record is taken from the population baseline of its own year (see population_baselines)
+    :param geography: Geography of the population baselines used with year_col
+    :param registry: Optional population_baselines.BaselineRegistry used with year_col
+    :param inplace: Whether the column is added to df itself instead of a shallow copy (see add_population_share)
     :return: Dataframe with the added column - racial percentage distribution
 
     >>> df = pd.DataFrame({'col1': [1, 2, 3, 4, 5, 6, 7, 8], 'SUSPECT_RACE_DESCRIPTION': ['AMERICAN INDIAN/ALASKAN NATIVE', 'ASIAN / PACIFIC ISLANDER', 'BLACK', 'BLACK HISPANIC', 'WHITE', 'WHITE HISPANIC', '(null)', 'UNKNOWN']})
@@ -246,20 +413,120 @@ def race_pct_col(df, col):
     8  ASIAN / PACIFIC ISLANDER           0.1400
     """
     
-    race_pct = pd.DataFrame(df.apply(lambda row: race_percentage(row, col), axis=1))
-    race_pct.rename(columns={0: 'POP_BY_RACE_PCT'}, inplace=True)
-    df = pd.concat([df, race_pct], axis=1)
-    return df
+    if year_col is not None:
+        from population_baselines import RACE, add_population_share_by_year
+        return add_population_share_by_year(df, col, year_col, RACE, 'POP_BY_RACE_PCT', geography, registry,
+                                            inplace=inplace)
+    return add_population_share(df, col, RACE_POPULATION_SHARE, 'POP_BY_RACE_PCT', inplace=inplace)
+
+
+# This function tells a single dataframe apart from a stream of dataframe chunks
+def is_chunk_stream(df):
+    """
+    This function returns True when the argument is an iterable of dataframe chunks (a list, a generator,
+    a pandas TextFileReader, ...) rather than one dataframe. The counting functions use it to decide
+    whether to aggregate the input in one go or chunk by chunk.
+
+    :param df: Dataframe or iterable of dataframes
+    :return: True if df has to be consumed chunk by chunk
+
+    >>> is_chunk_stream(pd.DataFrame({'col1': [1]}))
+    False
+    >>> is_chunk_stream([pd.DataFrame({'col1': [1]})])
+    True
+    """
+    return not isinstance(df, (pd.DataFrame, pd.Series)) and hasattr(df, '__iter__')
+
+
+# This function gives the categorical group keys of two partial counts the same categories, so that adding them keeps
+# the categorical dtype and the canonical order of the keys
+def _align_categories(merged, partial):
+    """
+    This function makes the categorical index levels of two count tables share one category set: the categories
+    of the running total followed by those only the partial has (chunks of the same dataset start with the same
+    canonical categories, but labels outside them are appended per chunk).
+
+    :param merged: Running total of the counts
+    :param partial: Partial counts of the next chunk
+    :return: Tuple of the two count tables, with aligned categorical index levels
+    """
+    merged_levels = [merged.index.get_level_values(i) for i in range(merged.index.nlevels)]
+    partial_levels = [partial.index.get_level_values(i) for i in range(partial.index.nlevels)]
+    changed = False
+    for i, (left, right) in enumerate(zip(merged_levels, partial_levels)):
+        if (isinstance(left.dtype, pd.CategoricalDtype) and isinstance(right.dtype, pd.CategoricalDtype)
+                and left.dtype != right.dtype):
+            categories = list(dict.fromkeys([*left.dtype.categories, *right.dtype.categories]))
+            dtype = pd.CategoricalDtype(categories, ordered=left.dtype.ordered)
+            merged_levels[i], partial_levels[i] = left.astype(dtype), right.astype(dtype)
+            changed = True
+    if not changed:
+        return merged, partial
+
+    def rebuild(table, levels):
+        if len(levels) == 1:
+            return table.set_axis(pd.Index(levels[0], name=table.index.name))
+        return table.set_axis(pd.MultiIndex.from_arrays(levels, names=table.index.names))
+    return rebuild(merged, merged_levels), rebuild(partial, partial_levels)
+
+
+# This function adds up partial group counts computed on separate chunks of the same dataset
+@instrumented
+def merge_counts(partials):
+    """
+    This function merges partial counts (series or dataframes indexed by the group keys) into a single
+    count table. Groups that only appear in some of the chunks are kept, so the result is exactly what a
+    single groupby over the full dataset would have produced. Only one partial is held in memory at a time
+    besides the running total, so memory does not grow with the number of chunks. Categorical group keys stay
+    categorical: when chunks have different categories, the union is used with the canonical ones first, so
+    the result is still sorted in the canonical order (e.g. age groups from youngest to oldest).
+
+    :param partials: Iterable of count series/dataframes indexed by the group keys
+    :return: The merged counts, sorted by the group keys
+
+    >>> first = pd.Series({'MALE': 3, 'FEMALE': 1})
+    >>> second = pd.Series({'FEMALE': 2, 'UNKNOWN': 1})
+    >>> merge_counts([first, second])
+    FEMALE     3
+    MALE       3
+    UNKNOWN    1
+    dtype: int64
+    >>> ages = pd.CategoricalDtype(['<18', '18-24', '25-44'], ordered=True)
+    >>> first = pd.Series(['25-44', '<18'], dtype=ages).value_counts(sort=False)
+    >>> second = pd.Series(['25-44', 'UNKNOWN']).astype(
+    ...     pd.CategoricalDtype([*ages.categories, 'UNKNOWN'], ordered=True)).value_counts(sort=False)
+    >>> merged = merge_counts([first[first > 0], second[second > 0]])
+    >>> merged.index.dtype
+    CategoricalDtype(categories=['<18', '18-24', '25-44', 'UNKNOWN'], ordered=True, categories_dtype=str)
+    >>> merged.to_dict()
+    {'<18': 1, '25-44': 2, 'UNKNOWN': 1}
+    """
+    merged = None
+    for partial in partials:
+        if merged is None:
+            merged = partial
+        else:
+            merged, partial = _align_categories(merged, partial)
+            merged = merged.add(partial, fill_value=0)
+    if merged is None:
+        raise ValueError('No partial counts to merge')
+    return merged.sort_index().astype('int64')
 
 
 # This function allows grouping the dataframe based on same values in particular column(s). This helps to determine
 # the count of the values through the aforementioned columns.
+@instrumented
 def grouping_for_count(df, col_to_groupby1, col_to_groupby2, col_for_count):
     """
     This function allows grouping the dataframe based on same values in particular column(s). This helps to determine
     the count of the values through the aforementioned columns.
 
-    :param df: The dataframe on which the pd.groupby() function will be applied
+    The dataframe may also be an iterable of dataframe chunks (for example from data_loading.read_csv_chunks),
+    in which case every chunk is grouped on its own and the partial counts are merged with merge_counts. A
+    dataframe is grouped the same way in slices of SLICE_ROWS rows (see row_slices), which bounds the memory
+    taken by the groupby codes whatever the size of the dataframe.
+
+    :param df: The dataframe (or iterable of dataframe chunks) on which the pd.groupby() function will be applied
     :param col_to_groupby1: The first column by which the grouping will be done
     :param col_to_groupby2: The second column by which the grouping will be done
     :param col_for_count: Column whose count values are to be determined
@@ -274,8 +541,15 @@ def grouping_for_count(df, col_to_groupby1, col_to_groupby2, col_for_count):
     3       65+           0.170      2
     4       <18           0.232      1
 
+    >>> chunks = [dummy_df.iloc[:3], dummy_df.iloc[3:]]
+    >>> grouping_for_count(iter(chunks), 'AGE_GROUP', 'POP_BY_AGE_PCT', 'AGE_GROUP').equals(
+    ...     grouping_for_count(dummy_df, 'AGE_GROUP', 'POP_BY_AGE_PCT', 'AGE_GROUP'))
+    True
+
     """
-    grouped_df = df.groupby([col_to_groupby1, col_to_groupby2])[col_for_count].count()
+    chunks = df if is_chunk_stream(df) else row_slices(df)
+    grouped_df = merge_counts(chunk.groupby([col_to_groupby1, col_to_groupby2], observed=True)[col_for_count]
+                              .count() for chunk in chunks)
     grouped_df = pd.DataFrame(grouped_df)
     grouped_df.rename(columns={col_for_count: 'COUNT'}, inplace=True)
     grouped_df = grouped_df.reset_index()
@@ -284,15 +558,20 @@ def grouping_for_count(df, col_to_groupby1, col_to_groupby2, col_for_count):
 
 # This function helps to normalize the values in the dataset to supplement appropriate analysis. Normalizing
 # helps to scale the values to the entire population. Without normalization, a highly inaccurate analysis would be presented
-def normalized_values(df, count_values, pct_dist_values):
+@instrumented
+def normalized_values(df, count_values, pct_dist_values, inplace=True):
     """
 
     This function helps to normalize the values in the dataset to supplement appropriate analysis. Normalizing
     helps to scale the values to the entire population. Without normalization, a highly inaccurate analysis would be presented
 
+    By default the column is added to df itself, as the notebook relies on it. With inplace=False it is added
+    to a shallow copy and df is left unchanged.
+
     :param df: The dataframe to which the normalized values must be added
     :param count_values: The count column which is the numerator for normalizing
     :param pct_dist_values: The percentage distribution within total population column which is the denominator
+    :param inplace: Whether the column is added to df itself instead of a shallow copy
     :return: Returns the dataframe consisting of normalized values in the new 'NORM_VALUES' column
 
     >>> dummy_df = pd.DataFrame({'COUNT': [750822, 356689, 25012, 45899, 12221], 'POP_BY_AGE_PCT': [0.272, 0.065, 0.261, 0.232, 0.170]})
@@ -303,20 +582,31 @@ def normalized_values(df, count_values, pct_dist_values):
     2   25012           0.261        95831
     3   45899           0.232       197840
     4   12221           0.170        71888
+
+    >>> dummy_df = pd.DataFrame({'COUNT': [10, 20], 'POP_BY_AGE_PCT': [0.5, 0.25]})
+    >>> normalized_values(dummy_df, 'COUNT', 'POP_BY_AGE_PCT', inplace=False)['NORM_VALUES'].tolist()
+    [20, 80]
+    >>> list(dummy_df.columns)
+    ['COUNT', 'POP_BY_AGE_PCT']
     """
-    df['NORM_VALUES'] = (df[count_values] / df[pct_dist_values]).astype('int')
-    return df
+    result = df if inplace else df.copy(deep=False)
+    result['NORM_VALUES'] = (df[count_values] / df[pct_dist_values]).astype('int')
+    return result
 
 
 # This function helps to transform the normalized values to a ratio/proportion. This helps to conclude the analysis and
 # thus, accept/reject the hypothesis
-def proportional_values(df):
+@instrumented
+def proportional_values(df, inplace=True):
     """
 
     This function helps to transform the normalized values to a ratio/proportion. This helps to conclude the analysis and
     thus, accept/reject the hypothesis
 
+    Like normalized_values, the column is added to df itself unless inplace is False.
+
     :param df: The dataframe to which the proportional values must be added
+    :param inplace: Whether the column is added to df itself instead of a shallow copy
     :return: Returns the dataframe consisting of proportional values in the new 'PROP_VALUES' column
 
     >>> dummy_df = pd.DataFrame({'NORM_VALUES': [750822, 356689, 25012, 45899, 12221]})
@@ -328,8 +618,9 @@ def proportional_values(df):
     3        45899         3.85
     4        12221         1.03
     """
-    df['PROP_VALUES'] = ((df['NORM_VALUES'] / df['NORM_VALUES'].sum()) * 100).round(2)
-    return df
+    result = df if inplace else df.copy(deep=False)
+    result['PROP_VALUES'] = ((df['NORM_VALUES'] / df['NORM_VALUES'].sum()) * 100).round(2)
+    return result
 
 
 # Creating a function to return the sex percentage value in NYC
@@ -349,22 +640,25 @@ def sex_distribution(row, colname) -> pd.core.series.Series:
     dtype: float64
     """
 
-    if row[colname] == 'MALE':
-        return 0.4767
-    if row[colname] == 'FEMALE':
-        return 0.5233
-    
+    return SEX_POPULATION_SHARE.get(row[colname])
+
     
 # This function adds the age percentage column to a dataframe that has the 'AGE_GROUP' column
-def sex_pct_col(df, col):
+@instrumented
+def sex_pct_col(df, col, year_col=None, geography='NYC', registry=None, inplace=False):
     """
     This function allows us to add the sex percentage column to an existing
     dataframe that contains the sex column. Addition of this new column
-    is an intermediate step to allow normalizing the values. Within this function
-    another function - sex_distribution is used.
+    is an intermediate step to allow normalizing the values. The shares come from
+    SEX_POPULATION_SHARE through the vectorized add_population_share lookup.
 
     :param df: Dataframe to which the sex percentage column has to be appended
     :param col: Column used for calculating the sex percentage
+    :param year_col: Optional column with the year (or date) of every record. When given, the share of every
+                     record is taken from the population baseline of its own year (see population_baselines)
+    :param geography: Geography of the population baselines used with year_col
+    :param registry: Optional population_baselines.BaselineRegistry used with year_col
+    :param inplace: Whether the column is added to df itself instead of a shallow copy (see add_population_share)
     :return: Dataframe with the added column - sex percentage distribution
 
     >>> df = pd.DataFrame({'SEX': ['MALE', 'FEMALE', 'FEMALE']})
@@ -387,8 +681,276 @@ def sex_pct_col(df, col):
     7        MALE          0.4767
     8        MALE          0.4767
 
+    >>> from population_baselines import BaselineRegistry
+    >>> registry = BaselineRegistry().load('dummy_doctest_files/Population_baselines.csv')
+    >>> df = pd.DataFrame({'SEX': ['MALE', 'MALE', 'FEMALE'], 'YEAR': [2018, 2020, 2020]})
+    >>> sex_pct_col(df, 'SEX', year_col='YEAR', registry=registry)
+          SEX  YEAR  POP_BY_SEX_PCT
+    0    MALE  2018          0.4762
+    1    MALE  2020          0.4771
+    2  FEMALE  2020          0.5229
+    """
+    if year_col is not None:
+        from population_baselines import SEX, add_population_share_by_year
+        return add_population_share_by_year(df, col, year_col, SEX, 'POP_BY_SEX_PCT', geography, registry,
+                                            inplace=inplace)
+    return add_population_share(df, col, SEX_POPULATION_SHARE, 'POP_BY_SEX_PCT', inplace=inplace)
+
+
+# This function computes COUNT, NORM_VALUES and PROP_VALUES for a demographic column in a single grouped pass
+@instrumented
+def grouped_population_values(df, col, shares, pct_col, unmapped='nan', backend=None):
+    """
+    This function fuses grouping_for_count, normalized_values and proportional_values into one step.
+    The raw record frame is grouped once on the demographic column (only that column is read, the
+    frame is neither copied nor filtered), and the population shares are looked up for the distinct
+    groups only. Normalizing and computing proportions then works on the small grouped frame.
+
+    Missing labels are not counted, which matches select_columns dropping the null rows. Groups without
+    a population share are dropped like grouping_for_count drops them, unless the unmapped policy says
+    otherwise (see population_share_lookup).
+
+    :param df: Raw record dataframe containing the demographic column, an iterable of dataframe chunks, or the
+               path of a CSV or Parquet file which is then aggregated out of core (see out_of_core.py)
+    :param col: Demographic column by which the records are grouped
+    :param shares: Dictionary mapping each label to its share of the total population
+    :param pct_col: Name of the population share column in the result, e.g. 'POP_BY_AGE_PCT'
+    :param unmapped: Policy for labels that are not found in shares - 'nan', 'raise' or a positive fill value
+    :param backend: Out-of-core backend used when df is a path - 'arrow' (default), 'duckdb' or 'pandas'
+    :return: Grouped dataframe with the col, pct_col, COUNT, NORM_VALUES and PROP_VALUES columns
+
+    >>> df = pd.read_csv('dummy_doctest_files/Age_group.csv')
+    >>> grouped_population_values(df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT')
+      AGE_GROUP  POP_BY_AGE_PCT  COUNT  NORM_VALUES  PROP_VALUES
+    0     18-24           0.065      2           30        53.57
+    1     25-44           0.272      2            7        12.50
+    2     45-64           0.261      3           11        19.64
+    3       <18           0.232      2            8        14.29
+
+    The result is the same as running the three separate steps:
+
+    >>> grouped = grouping_for_count(age_pct_col(df), 'AGE_GROUP', 'POP_BY_AGE_PCT', 'AGE_GROUP')
+    >>> proportional_values(normalized_values(grouped, 'COUNT', 'POP_BY_AGE_PCT')).equals(
+    ...     grouped_population_values(df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT'))
+    True
+
+    Categorical input stays categorical and the groups follow the category order:
+
+    >>> df['AGE_GROUP'] = pd.Categorical(df['AGE_GROUP'], ['<18', '18-24', '25-44', '45-64', '65+'], ordered=True)
+    >>> grouped = grouped_population_values(df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT')
+    >>> grouped['AGE_GROUP'].tolist(), str(grouped['AGE_GROUP'].dtype)
+    (['<18', '18-24', '25-44', '45-64'], 'category')
+
+    This also holds for a stream of chunks where only some chunks have labels outside the categories:
+
+    >>> from data_schema import AGE_GROUPS, to_categorical
+    >>> chunks = [pd.DataFrame({'AGE_GROUP': to_categorical(pd.Series(ages), AGE_GROUPS, ordered=True)})
+    ...           for ages in (['25-44', '<18'], ['25-44', 'UNKNOWN'])]
+    >>> grouped = grouped_population_values(iter(chunks), 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT')
+    >>> grouped['AGE_GROUP'].tolist(), str(grouped['AGE_GROUP'].dtype)
+    (['<18', '25-44'], 'category')
+
+    A file is aggregated without being loaded, with the same result as for the loaded dataframe:
+
+    >>> path = 'dummy_doctest_files/Age_group.csv'
+    >>> grouped_population_values(path, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT').equals(
+    ...     grouped_population_values(pd.read_csv(path), 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT'))
+    True
+    """
+    if isinstance(df, (str, os.PathLike)):
+        from out_of_core import file_group_counts
+        counts = file_group_counts(df, col, backend=backend)['COUNT_T'].rename(None)
+    else:
+        chunks = df if is_chunk_stream(df) else row_slices(df)
+        counts = merge_counts(chunk.groupby(col, sort=True, observed=True).size() for chunk in chunks)
+    return population_values_from_counts(counts, col, shares, pct_col, unmapped)
+
+
+# This function derives the population share, NORM_VALUES and PROP_VALUES columns from group counts
+@instrumented
+def population_values_from_counts(counts, col, shares, pct_col, unmapped='nan'):
+    """
+    This function builds the output of grouped_population_values from a series of counts per label, for
+    example counts merged from several chunks or worker processes with merge_counts.
+
+    :param counts: Series of record counts indexed by the demographic labels
+    :param col: Name of the demographic column in the result
+    :param shares: Dictionary mapping each label to its share of the total population
+    :param pct_col: Name of the population share column in the result
+    :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+    :return: Grouped dataframe with the col, pct_col, COUNT, NORM_VALUES and PROP_VALUES columns
+
+    >>> population_values_from_counts(pd.Series({'FEMALE': 5233, 'MALE': 9534}), 'SEX', SEX_POPULATION_SHARE,
+    ...                               'POP_BY_SEX_PCT')
+          SEX  POP_BY_SEX_PCT  COUNT  NORM_VALUES  PROP_VALUES
+    0  FEMALE          0.5233   5233        10000        33.33
+    1    MALE          0.4767   9534        20000        66.67
+    """
+    grouped = counts.rename_axis(col).rename('COUNT').reset_index()
+    grouped.insert(1, pct_col, population_share_lookup(grouped[col], shares, unmapped))
+    grouped = grouped.dropna(subset=[pct_col]).reset_index(drop=True)
+    normalized_values(grouped, 'COUNT', pct_col)
+    proportional_values(grouped)
+    return grouped
+
+
+# This function turns a Y/N outcome flag column into a boolean series
+def flag_is_yes(series):
+    """
+    This function returns a boolean series which is True wherever the outcome flag is set. Flags
+    stored as 'Y'/'N' strings and flags already stored as booleans are both supported. Missing
+    values are treated as not flagged.
+
+    :param series: Outcome flag column, e.g. FRISKED_FLAG or SUSPECT_ARRESTED_FLAG
+    :return: Boolean series aligned to the input
+
+    >>> flag_is_yes(pd.Series(['Y', 'N', None]))
+    0     True
+    1    False
+    2    False
+    dtype: bool
+    """
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series.fillna(False).astype(bool)
+    return series.eq('Y').fillna(False).astype(bool)
+
+
+# This function normalizes the group and flag column arguments of flag_counts and flag_probabilities
+def _group_and_flag_names(group_cols, flag_cols):
+    if isinstance(group_cols, str):
+        group_cols = [group_cols]
+    if isinstance(flag_cols, str):
+        flag_cols = [flag_cols]
+    if not isinstance(flag_cols, dict):
+        flag_cols = {flag: flag[:-len('_FLAG')] if flag.endswith('_FLAG') else flag for flag in flag_cols}
+    return list(group_cols), flag_cols
+
+
+# This function counts the records and the 'Y' values of every flag per demographic group
+@instrumented
+def flag_counts(df, group_cols, flag_cols, dropna=True):
+    """
+    This function counts, per demographic group, the records (COUNT_T) and the records with a 'Y' for every
+    flag (COUNT_<NAME>_Y). The counts of separate chunks or partitions can be added up with merge_counts and
+    turned into probabilities with flag_probabilities_from_counts.
+
+    :param df: Raw record dataframe
+    :param group_cols: Demographic column name, or list of column names, to group by
+    :param flag_cols: Flag column name, list of names or dictionary of short names (see flag_probabilities)
+    :param dropna: Whether records with a missing group label are left out, as by pandas groupby. With False
+                   they are counted in groups whose label is NaN
+    :return: Count dataframe indexed by the demographic groups
+
+    >>> df = pd.DataFrame({'SUSPECT_SEX': ['MALE', 'MALE', 'FEMALE'], 'FRISKED_FLAG': ['Y', 'N', 'N']})
+    >>> flag_counts(df, 'SUSPECT_SEX', 'FRISKED_FLAG').reset_index()
+      SUSPECT_SEX  COUNT_T  COUNT_FRISKED_Y
+    0      FEMALE        1                0
+    1        MALE        2                1
+    """
+    group_cols, flag_cols = _group_and_flag_names(group_cols, flag_cols)
+    flagged = pd.DataFrame({'COUNT_' + name + '_Y': flag_is_yes(df[flag]) for flag, name in flag_cols.items()},
+                           index=df.index)
+    grouped = flagged.groupby([df[col] for col in group_cols], sort=True, observed=True, dropna=dropna)
+    counts = grouped.sum().astype('int64')
+    counts.insert(0, 'COUNT_T', grouped.size())
+    return counts
+
+
+# This function turns per-group record and flag counts into probability tables
+@instrumented
+def flag_probabilities_from_counts(counts, shares=None, unmapped='nan'):
+    """
+    This function computes the probability table of flag_probabilities from counts produced by flag_counts
+    (possibly merged across chunks or partitions with merge_counts).
+
+    :param counts: Count dataframe indexed by the demographic groups, with COUNT_T and COUNT_<NAME>_Y columns
+    :param shares: Optional dictionary mapping demographic column names to population share tables
+    :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+    :return: Dataframe with one row per demographic group
+    """
+    names = [col[len('COUNT_'):-len('_Y')] for col in counts.columns if col != 'COUNT_T']
+    table = pd.DataFrame(index=counts.index)
+    if shares is not None:
+        pct = np.ones(len(table))
+        for col in counts.index.names:
+            if col in shares:
+                pct = pct * population_share_lookup(table.index.get_level_values(col), shares[col],
+                                                    unmapped).to_numpy()
+        table['POP_PCT'] = pct
+    table['COUNT_T'] = counts['COUNT_T'].to_numpy()
+    if shares is not None:
+        table = table.dropna(subset=['POP_PCT'])
+        normalized_values(table, 'COUNT_T', 'POP_PCT')
+        table.rename(columns={'NORM_VALUES': 'NORM_VALUES_T'}, inplace=True)
+
+    for name in names:
+        table['COUNT_' + name + '_Y'] = counts['COUNT_' + name + '_Y'].reindex(table.index).astype('int64')
+        if shares is not None:
+            table['NORM_VALUES_' + name + '_Y'] = (table['COUNT_' + name + '_Y'] / table['POP_PCT']).astype('int')
+            table['PROB_' + name] = table['NORM_VALUES_' + name + '_Y'] / table['NORM_VALUES_T']
+        else:
+            table['PROB_' + name] = table['COUNT_' + name + '_Y'] / table['COUNT_T']
+
+    return table.reset_index()
+
+
+# This function computes the probability of Y/N outcomes per demographic group from one grouped pass
+@instrumented
+def flag_probabilities(df, group_cols, flag_cols, shares=None, unmapped='nan', backend=None):
+    """
+    This function generalizes the probability tables of hypotheses 2 and 3 (for example the probability
+    of being frisked by sex, or of being arrested by race). All outcome flags are counted in a single
+    groupby over the demographic columns, so the totals and the per-flag counts share the same group keys
+    and stay aligned even when a group never has a 'Y' for one of the flags (its count is then 0).
+
+    The output has COUNT_T (records per group) and, for every flag, COUNT_<NAME>_Y and PROB_<NAME>.
+    When population share tables are passed, POP_PCT, NORM_VALUES_T and NORM_VALUES_<NAME>_Y are added
+    the same way normalized_values does it, and the probabilities are computed from the normalized
+    values as in the notebook. With several demographic columns the shares are multiplied together,
+    i.e. the columns are assumed to be independent in the population.
+
+    :param df: Raw record dataframe, e.g. the stop, question and frisk data, an iterable of dataframe chunks, or
+               the path of a CSV or Parquet file which is then aggregated out of core (see out_of_core.py)
+    :param group_cols: Demographic column name, or list of column names, to group by
+    :param flag_cols: Flag column name, list of flag column names, or dictionary mapping each flag column to
+                      the short name used in the output columns (by default the '_FLAG' suffix is removed)
+    :param shares: Optional dictionary mapping demographic column names to population share tables
+    :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+    :param backend: Out-of-core backend used when df is a path - 'arrow' (default), 'duckdb' or 'pandas'
+    :return: Dataframe with one row per demographic group
+
+    >>> df = pd.DataFrame({'SUSPECT_SEX': ['MALE', 'MALE', 'MALE', 'FEMALE', 'FEMALE'],
+    ...                    'FRISKED_FLAG': ['Y', 'Y', 'N', 'N', 'N'],
+    ...                    'SUSPECT_ARRESTED_FLAG': ['N', 'Y', 'N', 'Y', 'N']})
+    >>> probabilities = flag_probabilities(df, 'SUSPECT_SEX', {'FRISKED_FLAG': 'FRISKED',
+    ...                                                          'SUSPECT_ARRESTED_FLAG': 'ARRESTED'})
+    >>> list(probabilities.columns)
+    ['SUSPECT_SEX', 'COUNT_T', 'COUNT_FRISKED_Y', 'PROB_FRISKED', 'COUNT_ARRESTED_Y', 'PROB_ARRESTED']
+    >>> probabilities[['SUSPECT_SEX', 'COUNT_T', 'PROB_FRISKED', 'PROB_ARRESTED']]
+      SUSPECT_SEX  COUNT_T  PROB_FRISKED  PROB_ARRESTED
+    0      FEMALE        2      0.000000       0.500000
+    1        MALE        3      0.666667       0.333333
+
+    >>> probabilities = flag_probabilities(df, 'SUSPECT_SEX', 'FRISKED_FLAG',
+    ...                                    shares={'SUSPECT_SEX': SEX_POPULATION_SHARE})
+    >>> probabilities[['SUSPECT_SEX', 'POP_PCT', 'NORM_VALUES_T', 'NORM_VALUES_FRISKED_Y', 'PROB_FRISKED']]
+      SUSPECT_SEX  POP_PCT  NORM_VALUES_T  NORM_VALUES_FRISKED_Y  PROB_FRISKED
+    0      FEMALE   0.5233              3                      0      0.000000
+    1        MALE   0.4767              6                      4      0.666667
+
+    A file is aggregated without being loaded, with the same result as for the loaded dataframe:
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'sqf.csv')
+    >>> df.to_csv(path, index=False)
+    >>> flag_probabilities(path, 'SUSPECT_SEX', 'FRISKED_FLAG',
+    ...                    shares={'SUSPECT_SEX': SEX_POPULATION_SHARE}).equals(probabilities)
+    True
     """
-    sex_pct = pd.DataFrame(df.apply(lambda row: sex_distribution(row, col), axis=1))
-    sex_pct.rename(columns={0: 'POP_BY_SEX_PCT'}, inplace=True)
-    df = pd.concat([df, sex_pct], axis=1)
-    return df
+    if isinstance(df, (str, os.PathLike)):
+        from out_of_core import file_group_counts
+        counts = file_group_counts(df, group_cols, flag_cols, backend=backend)
+    else:
+        chunks = df if is_chunk_stream(df) else row_slices(df)
+        counts = merge_counts(flag_counts(chunk, group_cols, flag_cols) for chunk in chunks)
+    return flag_probabilities_from_counts(counts, shares, unmapped)
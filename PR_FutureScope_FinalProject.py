@@ -13,23 +13,24 @@
 # In[1]:
 
 
-# Importing relevant libraries and changing the working directory
+# Importing relevant libraries. The extracts are read from the directory named by the NYPD_DATA_DIR
+# environment variable (e.g. D:/Downloads/), or from the working directory when it is not set
 
 import pandas as pd
+from data_loading import read_arrests, read_complaints
+from heatmap_tiles import add_tile_layer, render_tiles
+from heatmap_utils import grid_heatmap_data, time_frames
 from folium import Map
 from folium.plugins import HeatMap
 from folium.plugins import HeatMapWithTime
-import os
-
-os.chdir('D:/Downloads/')
 
 
 # In[2]:
 
 
-# Reading the dataset into a pandas dataframe
+# Reading only the columns used below (with compact dtypes and the date parsed) into a pandas dataframe
 
-arrests_2019 = pd.read_csv('NYPD_Arrests_Data_2019.csv')
+arrests_2019 = read_arrests(['ARREST_DATE', 'Latitude', 'Longitude'])
 
 
 # In[3]:
@@ -65,17 +66,30 @@ def generateBaseMap(default_location = [40.693943, -73.985880], default_zoom_sta
 # In[7]:
 
 
+# Binning the locations into grid cells keeps the size of the generated map bounded
+
 arrests_map = generateBaseMap()
-HeatMap(data = arrests_locations[['Latitude', 'Longitude']], radius=8, max_zoom=13).add_to(arrests_map)
+HeatMap(data = grid_heatmap_data(arrests_locations['Latitude'], arrests_locations['Longitude']), radius=8, max_zoom=13).add_to(arrests_map)
 arrests_map
 
 
+# In[ ]:
+
+
+# Offline alternative: the density is rendered once into PNG tiles (see heatmap_tiles.py) and the saved map only
+# references the tile directory next to it, so its size and load time do not depend on the number of arrests
+
+render_tiles(arrests_locations['Latitude'], arrests_locations['Longitude'], 'tiles/arrests', zooms=range(10, 15))
+arrests_tiles_map = add_tile_layer(generateBaseMap(), 'tiles/arrests')
+arrests_tiles_map.save('arrests_tiles_map.html')
+
+
 # In[8]:
 
 
-# Reading the complaints data in a pandas dataframe
+# Reading the columns of the complaints data used below in a pandas dataframe
 
-complaints_2019 = pd.read_csv('NYPD_Complaint_Data_Historic_2019.csv')
+complaints_2019 = read_complaints(['CMPLNT_FR_TM', 'Latitude', 'Longitude'])
 
 
 # In[9]:
@@ -105,7 +119,7 @@ complaints_locations.head()
 
 complaints_map = generateBaseMap()
 
-HeatMap(data=complaints_locations[['Latitude', 'Longitude']], radius = 8, max_zoom = 13).add_to(complaints_map)
+HeatMap(data=grid_heatmap_data(complaints_locations['Latitude'], complaints_locations['Longitude']), radius = 8, max_zoom = 13).add_to(complaints_map)
 
 
 # In[13]:
@@ -134,26 +148,10 @@ arrests_loc_time.head()
 # In[16]:
 
 
-arrests_loc_time['ARREST_DATE'] = pd.to_datetime(arrests_loc_time['ARREST_DATE'], infer_datetime_format=True)
-arrests_loc_time.head()
-
-
-# In[17]:
-
-
-arrests_loc_time['Day'] = arrests_loc_time.ARREST_DATE.apply(lambda x: x.dayofyear)
-
-
-# In[18]:
-
-
-arrests_loc_time.head()
-
-
-# In[19]:
+# ARREST_DATE is parsed while reading the file, so the frames can be built straight away.
+# time_frames sorts the records by day of the year once and cuts out one frame per day (1 - 365)
 
-
-heatmap = [[[row['Latitude'], row['Longitude']] for index, row in arrests_loc_time[arrests_loc_time['Day'] == i].iterrows()] for i in range(1,365)]
+day_index, heatmap = time_frames(arrests_loc_time, 'ARREST_DATE', key='dayofyear')
 
 
 # In[20]:
@@ -163,7 +161,7 @@ heatmap = [[[row['Latitude'], row['Longitude']] for index, row in arrests_loc_ti
 # Used their code snippet 
 
 base_map_DOY = generateBaseMap(default_zoom_start = 11)
-HeatMapWithTime(heatmap, radius = 5, gradient = {0.2: 'blue', 0.4: 'lime', 0.6: 'orange', 1: 'red'}, min_opacity = 0.5, max_opacity = 0.8, use_local_extrema = True).add_to(base_map_DOY)
+HeatMapWithTime(heatmap, index = day_index, radius = 5, gradient = {0.2: 'blue', 0.4: 'lime', 0.6: 'orange', 1: 'red'}, min_opacity = 0.5, max_opacity = 0.8, use_local_extrema = True).add_to(base_map_DOY)
 base_map_DOY
 
 
@@ -184,37 +182,15 @@ complaints_time.head()
 # In[23]:
 
 
-complaints_time['CMPLNT_FR_TM'] = pd.to_datetime(complaints_time['CMPLNT_FR_TM'], infer_datetime_format=True)
-
-
-# In[24]:
-
-
-complaints_time.head()
-
-
-# In[25]:
-
-
-complaints_time['Hour'] = complaints_time.CMPLNT_FR_TM.apply(lambda x: x.hour)
-
-
-# In[26]:
-
-
-complaints_time.head()
-
-
-# In[27]:
-
+# Building one frame per hour of the day (0 - 23) from the HH:MM:SS complaint times
 
-heatmap_hour = [[[row['Latitude'], row['Longitude']] for index, row in complaints_time[complaints_time['Hour'] == i].iterrows()] for i in range(0,24)]
+hour_index, heatmap_hour = time_frames(complaints_time, 'CMPLNT_FR_TM', key='hour', time_format='%H:%M:%S')
 
 
 # In[28]:
 
 
 base_map_hour = generateBaseMap(default_zoom_start=11)
-HeatMapWithTime(heatmap_hour, radius=5, gradient={0.2: 'blue', 0.4: 'lime', 0.6: 'orange', 1: 'red'}, min_opacity=0.5, max_opacity=0.8, use_local_extrema=True).add_to(base_map_hour)
+HeatMapWithTime(heatmap_hour, index=hour_index, radius=5, gradient={0.2: 'blue', 0.4: 'lime', 0.6: 'orange', 1: 'red'}, min_opacity=0.5, max_opacity=0.8, use_local_extrema=True).add_to(base_map_hour)
 base_map_hour
 
@@ -0,0 +1,330 @@
+"""
+Materialized aggregate cube of the record and outcome flag counts of a dataset.
+
+Variants of the hypotheses (the frisk probability by race per precinct, the arrests by age group per month,
+...) are all roll-ups of the same counts. build_cube counts the records, and the 'Y' values of the outcome
+flags, of every observed combination of a set of dimensions once, slice by slice or chunk by chunk. The
+cube stores these combinations sparsely: one small integer code array per dimension and one count array
+per measure, with one entry (cell) per observed combination only. Queries roll the cube up, slice or dice
+it with NumPy bincounts over the cells, without touching the records again, and return the tables of the
+analysis functions: counts() the flag_counts format, flag_probabilities() the flag_probabilities table and
+population_values() the grouped_population_values table.
+
+A dimension is a column, or a time key ('month', 'hour', ... see heatmap_utils.TIME_KEYS) of a date or
+time column. Records with a missing value in a dimension stay in the cube, so they are counted when
+rolling up over the other dimensions, and are left out of the groups of that dimension as pandas groupby
+would leave them out.
+
+    cube = build_cube(read_arrests(), ARRESTS_DIMENSIONS)
+    cube.counts(['AGE_GROUP', 'MONTH'], where={'ARREST_BORO': 'K'})
+    cube.population_values('AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT', where={'MONTH': [6, 7, 8]})
+"""
+import numpy as np
+import pandas as pd
+
+from data_schema import apply_schema
+from Functions_and_Doctests import (_group_and_flag_names, flag_counts, flag_probabilities_from_counts,
+                                    is_chunk_stream, merge_counts, population_values_from_counts, row_slices)
+from heatmap_utils import _time_key
+from instrumentation import instrumented
+
+# Roll-ups onto at most this many groups (or onto fewer groups than there are cells) are counted with a
+# dense bincount over every possible group, larger ones with np.unique over the cells
+DENSE_GROUPS = 1 << 20
+
+# Dimension name -> column, or (date/time column, time key, strftime format) tuple
+ARRESTS_DIMENSIONS = {
+    'AGE_GROUP': 'AGE_GROUP',
+    'PERP_SEX': 'PERP_SEX',
+    'PERP_RACE': 'PERP_RACE',
+    'ARREST_BORO': 'ARREST_BORO',
+    'ARREST_PRECINCT': 'ARREST_PRECINCT',
+    'OFNS_DESC': 'OFNS_DESC',
+    'MONTH': ('ARREST_DATE', 'month', '%m/%d/%Y'),
+}
+
+COMPLAINTS_DIMENSIONS = {
+    'SUSP_AGE_GROUP': 'SUSP_AGE_GROUP',
+    'SUSP_SEX': 'SUSP_SEX',
+    'SUSP_RACE': 'SUSP_RACE',
+    'BORO_NM': 'BORO_NM',
+    'OFNS_DESC': 'OFNS_DESC',
+    'MONTH': ('CMPLNT_FR_DT', 'month', '%m/%d/%Y'),
+    'HOUR': ('CMPLNT_FR_TM', 'hour', '%H:%M:%S'),
+}
+
+SQF_DIMENSIONS = {
+    'SUSPECT_SEX': 'SUSPECT_SEX',
+    'SUSPECT_RACE_DESCRIPTION': 'SUSPECT_RACE_DESCRIPTION',
+}
+
+
+# This function computes the values of one dimension of the cube for a dataframe
+def _dimension_values(df, spec):
+    if isinstance(spec, str):
+        return df[spec]
+    col, key, *time_format = spec
+    keys = _time_key(df[col], key, time_format[0] if time_format else None)
+    return pd.Series(keys, index=df.index).astype('Int64')
+
+
+# This class holds the sparse counts of a cube and answers the roll-up queries
+class AggregateCube:
+    """
+    Record and flag counts of every observed combination of the dimensions, built by build_cube or from a
+    count dataframe in the flag_counts format (COUNT_T and COUNT_<NAME>_Y columns, one index level per
+    dimension, NaN labels for missing values).
+
+    >>> counts = pd.DataFrame({'SEX': ['F', 'M', 'M'], 'BORO': ['K', 'K', 'Q'], 'COUNT_T': [2, 3, 1]})
+    >>> cube = AggregateCube(counts.set_index(['SEX', 'BORO']))
+    >>> cube
+    AggregateCube(2 dimensions, 3 cells)
+    >>> cube.counts('SEX').reset_index()
+      SEX  COUNT_T
+    0   F        2
+    1   M        4
+    >>> cube.counts('BORO', where={'SEX': 'M'}).reset_index()
+      BORO  COUNT_T
+    0    K        3
+    1    Q        1
+    """
+
+    def __init__(self, counts):
+        index = counts.index
+        self.dimensions = list(index.names)
+        self.levels = {}
+        self.codes = {}
+        for position, name in enumerate(self.dimensions):
+            codes, labels = pd.factorize(index.get_level_values(position), sort=True)
+            # Missing labels get the code one past the last label
+            codes[codes == -1] = len(labels)
+            self.levels[name] = pd.Index(labels, name=name)
+            self.codes[name] = codes.astype(np.min_scalar_type(len(labels)))
+        self.measures = {col: counts[col].to_numpy(dtype='int64') for col in counts.columns}
+
+    def __repr__(self):
+        return 'AggregateCube({} dimensions, {:,} cells)'.format(len(self.dimensions), self.cells)
+
+    @property
+    def cells(self):
+        """
+        :return: Number of observed combinations of the dimensions
+        """
+        return len(self.measures['COUNT_T'])
+
+    @property
+    def nbytes(self):
+        """
+        :return: Memory taken by the code and count arrays, in bytes
+        """
+        return sum(codes.nbytes for codes in self.codes.values()) + \
+            sum(values.nbytes for values in self.measures.values())
+
+    def _check(self, dimensions):
+        unknown = [name for name in dimensions if name not in self.levels]
+        if unknown:
+            raise KeyError('Unknown dimension(s) {}, the cube has {}'.format(unknown, self.dimensions))
+
+    # This method returns the mask of the cells matching the where conditions
+    def _select(self, where):
+        keep = np.ones(self.cells, dtype=bool)
+        for name, labels in (where or {}).items():
+            self._check([name])
+            if not pd.api.types.is_list_like(labels):
+                labels = [labels]
+            positions = self.levels[name].get_indexer(labels)
+            keep &= np.isin(self.codes[name], positions[positions >= 0])
+        return keep
+
+    def counts(self, by, where=None):
+        """
+        Rolls the cube up onto some of its dimensions, after keeping only the cells matching where.
+
+        :param by: Dimension name, or list of dimension names, to group by
+        :param where: Optional dictionary mapping dimension names to a label or a list of labels to keep
+        :return: Count dataframe in the flag_counts format, indexed by the groups of the by dimensions
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        if not by:
+            raise ValueError('At least one dimension to group by is needed')
+        self._check(by)
+        keep = self._select(where)
+        sizes = [len(self.levels[name]) for name in by]
+        for name, size in zip(by, sizes):
+            keep &= self.codes[name] < size
+        linear = np.ravel_multi_index([self.codes[name][keep] for name in by], sizes)
+
+        groups_count = int(np.prod(sizes))
+        if groups_count <= max(len(linear), DENSE_GROUPS):
+            present = np.bincount(linear, minlength=groups_count) > 0
+            groups = np.flatnonzero(present)
+            inverse = (np.cumsum(present) - 1)[linear]
+        else:
+            groups, inverse = np.unique(linear, return_inverse=True)
+
+        labels = [self.levels[name].take(codes) for name, codes in zip(by, np.unravel_index(groups, sizes))]
+        index = labels[0] if len(by) == 1 else pd.MultiIndex.from_arrays(labels, names=by)
+        return pd.DataFrame({col: np.bincount(inverse, weights=values[keep], minlength=len(groups)).astype('int64')
+                             for col, values in self.measures.items()}, index=index)
+
+    def flag_probabilities(self, by, flags=None, where=None, shares=None, unmapped='nan'):
+        """
+        Returns the table of flag_probabilities for the records matching where.
+
+        :param by: Dimension name, or list of dimension names, to group by
+        :param flags: Optional flag column names or short names to keep, all flags of the cube when None
+        :param where: Optional dictionary mapping dimension names to a label or a list of labels to keep
+        :param shares: Optional dictionary mapping dimension names to population share tables
+        :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+        :return: Dataframe with one row per group
+        """
+        counts = self.counts(by, where)
+        if flags is not None:
+            _, flags = _group_and_flag_names([], flags)
+            counts = counts[['COUNT_T'] + ['COUNT_' + name + '_Y' for name in flags.values()]]
+        return flag_probabilities_from_counts(counts, shares, unmapped)
+
+    def population_values(self, col, shares, pct_col, where=None, unmapped='nan'):
+        """
+        Returns the table of grouped_population_values for the records matching where.
+
+        :param col: Demographic dimension
+        :param shares: Dictionary mapping each label to its share of the total population
+        :param pct_col: Name of the population share column in the result
+        :param where: Optional dictionary mapping dimension names to a label or a list of labels to keep
+        :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+        :return: Grouped dataframe with the col, pct_col, COUNT, NORM_VALUES and PROP_VALUES columns
+        """
+        counts = self.counts(col, where)['COUNT_T'].rename(None)
+        return population_values_from_counts(counts, col, shares, pct_col, unmapped)
+
+    def to_frame(self):
+        """
+        Returns the cells as a count dataframe in the flag_counts format, from which the cube can be built
+        again (e.g. after saving it to a Parquet file).
+
+        :return: Count dataframe with one index level per dimension
+
+        >>> df = pd.DataFrame({'SEX': ['F', None, 'M'], 'PRECINCT': [5, 5, 7]})
+        >>> build_cube(df, ['SEX', 'PRECINCT']).to_frame().reset_index()
+           SEX  PRECINCT  COUNT_T
+        0    F         5        1
+        1    M         7        1
+        2  NaN         5        1
+        >>> df['PRECINCT'] = pd.array([5, None, 7], dtype='Int16')
+        >>> build_cube(df, ['SEX', 'PRECINCT']).to_frame().index.get_level_values('PRECINCT')
+        Index([5, 7, <NA>], dtype='Int16', name='PRECINCT')
+        """
+        labels = []
+        for name in self.dimensions:
+            level = self.levels[name]
+            codes = self.codes[name].astype('int64')
+            missing = codes == len(level)
+            if missing.any():
+                codes[missing] = -1
+                # Index.take only fills -1 codes with an explicit fill value, which NumPy integer levels cannot
+                # hold (nullable integer levels such as the Int16 precincts fill with <NA> and keep their dtype)
+                if isinstance(level.dtype, np.dtype) and level.dtype.kind in 'iub':
+                    level = level.astype('float64')
+                labels.append(level.take(codes, allow_fill=True, fill_value=np.nan))
+            else:
+                labels.append(level.take(codes))
+        return pd.DataFrame(self.measures, index=pd.MultiIndex.from_arrays(labels, names=self.dimensions))
+
+
+# This function counts the records of a dataset into an aggregate cube
+@instrumented
+def build_cube(df, dimensions, flag_cols=()):
+    """
+    This function builds the aggregate cube of a dataset in one pass over its records. A dataframe is
+    counted in slices of SLICE_ROWS rows (see row_slices), an iterable of chunks chunk by chunk, so the
+    memory used besides the input only depends on the number of cells.
+
+    :param df: Raw record dataframe, or iterable of dataframe chunks (e.g. from data_loading.read_csv_chunks)
+    :param dimensions: Column name, list of column names, or dictionary mapping dimension names to a column
+                       or to a (date/time column, time key, strftime format) tuple, e.g. ARRESTS_DIMENSIONS
+    :param flag_cols: Flag column name, list of names or dictionary of short names (see flag_probabilities)
+    :return: AggregateCube
+
+    >>> df = pd.read_csv('dummy_doctest_files/Complaints_sample.csv')
+    >>> cube = build_cube(df, COMPLAINTS_DIMENSIONS)
+    >>> cube.counts('HOUR', where={'BORO_NM': ['BRONX', 'MANHATTAN']}).T
+    HOUR     1   16  17  23
+    COUNT_T   1   1   1   1
+
+    The record without suspect details is left out of the suspect groups only:
+
+    >>> int(cube.counts('BORO_NM')['COUNT_T'].sum()), int(cube.counts('SUSP_SEX')['COUNT_T'].sum())
+    (6, 5)
+    >>> cube.counts(['SUSP_SEX', 'SUSP_RACE']).equals(flag_counts(df, ['SUSP_SEX', 'SUSP_RACE'], []))
+    True
+
+    Probabilities and population values are the same as from the records:
+
+    >>> from Functions_and_Doctests import SEX_POPULATION_SHARE, flag_probabilities
+    >>> sqf = pd.DataFrame({'SUSPECT_SEX': ['MALE', 'MALE', 'MALE', 'FEMALE', None],
+    ...                     'SUSPECT_RACE_DESCRIPTION': ['BLACK', 'WHITE', 'BLACK', 'BLACK', 'WHITE'],
+    ...                     'FRISKED_FLAG': ['Y', 'Y', 'N', 'N', 'Y']})
+    >>> cube = build_cube(sqf, SQF_DIMENSIONS, 'FRISKED_FLAG')
+    >>> cube.flag_probabilities('SUSPECT_SEX', shares={'SUSPECT_SEX': SEX_POPULATION_SHARE}).equals(
+    ...     flag_probabilities(sqf, 'SUSPECT_SEX', 'FRISKED_FLAG', shares={'SUSPECT_SEX': SEX_POPULATION_SHARE}))
+    True
+    >>> cube.flag_probabilities('SUSPECT_RACE_DESCRIPTION', where={'SUSPECT_SEX': 'MALE'})
+      SUSPECT_RACE_DESCRIPTION  COUNT_T  COUNT_FRISKED_Y  PROB_FRISKED
+    0                    BLACK        2                1           0.5
+    1                    WHITE        1                1           1.0
+    >>> AggregateCube(cube.to_frame()).counts('SUSPECT_RACE_DESCRIPTION').equals(
+    ...     cube.counts('SUSPECT_RACE_DESCRIPTION'))
+    True
+    """
+    if isinstance(dimensions, str):
+        dimensions = [dimensions]
+    if not isinstance(dimensions, dict):
+        dimensions = {name: name for name in dimensions}
+    _, flag_cols = _group_and_flag_names([], flag_cols)
+
+    def chunk_counts(chunk):
+        columns = {name: _dimension_values(chunk, spec) for name, spec in dimensions.items()}
+        columns.update({flag: chunk[flag] for flag in flag_cols})
+        return flag_counts(pd.DataFrame(columns, index=chunk.index, copy=False), list(dimensions), flag_cols,
+                           dropna=False)
+
+    chunks = df if is_chunk_stream(df) else row_slices(df)
+    return AggregateCube(merge_counts(chunk_counts(chunk) for chunk in chunks))
+
+
+# This function adds up the cells of cubes with the same dimensions
+@instrumented
+def merge_cubes(cubes, schema=None):
+    """
+    This function adds up cubes counted over separate sets of records, for example the cube of the records
+    appended to an extract since it was last counted and the cube of the earlier records, which gives the
+    cube of all the records. The work only depends on the number of cells. Cells with missing labels are
+    kept, and measures missing from some of the cubes count as 0 there.
+
+    :param cubes: Iterable of AggregateCube, or of count dataframes in the flag_counts format (see to_frame)
+    :param schema: Optional dataset schema applied to the labels, e.g. to cubes read back from a file storing
+                   them as text, so the groups keep their canonical categories and order
+    :return: AggregateCube
+
+    >>> df = pd.DataFrame({'SEX': ['F', None, 'M', 'M'], 'FRISKED_FLAG': ['Y', 'N', 'N', 'Y']})
+    >>> merged = merge_cubes([build_cube(df.iloc[:2], 'SEX', 'FRISKED_FLAG'), build_cube(df.iloc[2:], 'SEX')])
+    >>> merged.to_frame().sort_index().reset_index()
+       SEX  COUNT_T  COUNT_FRISKED_Y
+    0    F        1                1
+    1    M        2                0
+    2  NaN        1                0
+    """
+    frames = [cube.to_frame() if isinstance(cube, AggregateCube) else cube for cube in cubes]
+    if not frames:
+        raise ValueError('No cubes to merge')
+    dimensions = list(frames[0].index.names)
+    if any(list(frame.index.names) != dimensions for frame in frames):
+        raise ValueError('The cubes to merge must have the same dimensions {}'.format(dimensions))
+    counts = pd.concat(frames).fillna(0)
+    keys = counts.index.to_frame(index=False)
+    if schema is not None:
+        keys = apply_schema(keys, schema)
+    counts = counts.set_axis(pd.MultiIndex.from_frame(keys)).groupby(
+        level=list(range(len(dimensions))), sort=False, observed=True, dropna=False).sum()
+    return AggregateCube(counts.astype('int64'))
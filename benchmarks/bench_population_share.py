@@ -0,0 +1,80 @@
+"""
+Benchmark for the population share lookup used by age_pct_col, race_pct_col and sex_pct_col.
+
+The original implementation ran a row-wise DataFrame.apply with a Python if-chain. It is kept here
+(legacy_pct_col) only to measure the speedup of the vectorized lookup engine. The row-wise version
+is far too slow to run on 10M rows, so by default it is timed on a sample and extrapolated linearly
+(row-wise apply has a constant per-row cost). Pass --legacy-full to time it on every row instead.
+
+Usage (from the repository root):
+    python benchmarks/bench_population_share.py
+    python benchmarks/bench_population_share.py --rows 1000000 10000000 --legacy-sample 200000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Functions_and_Doctests import (AGE_POPULATION_SHARE, RACE_POPULATION_SHARE, SEX_POPULATION_SHARE,
+                                    age_distribution, age_pct_col, race_pct_col, race_percentage,
+                                    sex_distribution, sex_pct_col)
+
+
+# The row-wise implementation that was replaced, kept for comparison only
+def legacy_pct_col(df, col, row_function, new_col):
+    pct = pd.DataFrame(df.apply(lambda row: row_function(row, col), axis=1))
+    pct.rename(columns={0: new_col}, inplace=True)
+    return pd.concat([df, pct], axis=1)
+
+
+CASES = [
+    ('age', 'AGE_GROUP', AGE_POPULATION_SHARE, age_distribution, 'POP_BY_AGE_PCT',
+     lambda df: age_pct_col(df)),
+    ('race', 'SUSPECT_RACE_DESCRIPTION', RACE_POPULATION_SHARE, race_percentage, 'POP_BY_RACE_PCT',
+     lambda df: race_pct_col(df, 'SUSPECT_RACE_DESCRIPTION')),
+    ('sex', 'SUSPECT_SEX', SEX_POPULATION_SHARE, sex_distribution, 'POP_BY_SEX_PCT',
+     lambda df: sex_pct_col(df, 'SUSPECT_SEX')),
+]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def run(rows_list, legacy_sample, legacy_full, seed):
+    rng = np.random.default_rng(seed)
+    print('{:<6} {:>12} {:>14} {:>14} {:>10}'.format('column', 'rows', 'row-wise (s)', 'vectorized (s)', 'speedup'))
+    for rows in rows_list:
+        for name, col, shares, row_function, new_col, vectorized in CASES:
+            df = pd.DataFrame({col: rng.choice(list(shares), size=rows)})
+
+            new_time, new_df = timed(vectorized, df)
+
+            legacy_rows = rows if legacy_full else min(rows, legacy_sample)
+            sample = df.iloc[:legacy_rows]
+            legacy_time, legacy_df = timed(legacy_pct_col, sample, col, row_function, new_col)
+            legacy_time = legacy_time * rows / legacy_rows
+            pd.testing.assert_frame_equal(legacy_df, new_df.iloc[:legacy_rows])
+
+            marker = '' if legacy_rows == rows else '*'
+            print('{:<6} {:>12,} {:>13.2f}{:1} {:>14.3f} {:>9.0f}x'.format(
+                name, rows, legacy_time, marker, new_time, legacy_time / new_time))
+    if not legacy_full:
+        print('* extrapolated from the first {:,} rows'.format(legacy_sample))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000, 10_000_000])
+    parser.add_argument('--legacy-sample', type=int, default=100_000)
+    parser.add_argument('--legacy-full', action='store_true')
+    parser.add_argument('--seed', type=int, default=2019)
+    arguments = parser.parse_args()
+    run(arguments.rows, arguments.legacy_sample, arguments.legacy_full, arguments.seed)
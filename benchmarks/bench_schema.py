@@ -0,0 +1,76 @@
+"""
+Memory use and groupby timing of the demographic/flag columns before and after applying the schema.
+
+"Before" is the column as pandas reads it by default (Python strings), "after" is the column converted
+with data_schema.apply_schema (categoricals and nullable booleans). When the 2019 files are found in the
+data directory they are used, otherwise a synthetic sample with the same columns is generated.
+
+Usage (from the repository root):
+    python benchmarks/bench_schema.py --data-dir D:/Downloads
+    python benchmarks/bench_schema.py --rows 5000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from data_schema import ARRESTS_SCHEMA, SQF_SCHEMA, apply_schema
+from Functions_and_Doctests import AGE_POPULATION_SHARE, flag_probabilities, grouped_population_values
+from synthetic import synthetic_arrests, synthetic_sqf
+
+ARRESTS_COLUMNS = ['AGE_GROUP', 'PERP_SEX', 'PERP_RACE']
+SQF_COLUMNS = ['SUSPECT_SEX', 'SUSPECT_RACE_DESCRIPTION', 'FRISKED_FLAG', 'SUSPECT_ARRESTED_FLAG']
+
+
+def best_of(function, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def report(name, raw, schema, aggregate):
+    converted = apply_schema(raw, schema)
+    raw_mb = raw.memory_usage(deep=True).sum() / 1e6
+    converted_mb = converted.memory_usage(deep=True).sum() / 1e6
+    raw_s = best_of(lambda: aggregate(raw))
+    converted_s = best_of(lambda: aggregate(converted))
+    print('{} ({:,} rows)'.format(name, len(raw)))
+    print('  memory   {:>10.1f} MB -> {:>8.1f} MB  ({:.1f}x smaller)'.format(raw_mb, converted_mb,
+                                                                              raw_mb / converted_mb))
+    print('  groupby  {:>10.3f} s  -> {:>8.3f} s   ({:.1f}x faster)'.format(raw_s, converted_s,
+                                                                            raw_s / converted_s))
+
+
+def main(data_dir, rows, seed):
+    arrests_file = os.path.join(data_dir, 'NYPD_Arrests_Data_2019.csv')
+    sqf_file = os.path.join(data_dir, 'sqf-2019.xlsx')
+
+    if os.path.exists(arrests_file):
+        arrests = pd.read_csv(arrests_file, usecols=ARRESTS_COLUMNS)
+    else:
+        arrests = synthetic_arrests(rows, seed)[ARRESTS_COLUMNS]
+    report('arrests', arrests, ARRESTS_SCHEMA,
+           lambda df: grouped_population_values(df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT'))
+
+    if os.path.exists(sqf_file):
+        sqf = pd.read_excel(sqf_file, usecols=SQF_COLUMNS)
+    else:
+        sqf = synthetic_sqf(rows, seed)[SQF_COLUMNS]
+    report('stop, question and frisk', sqf, SQF_SCHEMA,
+           lambda df: flag_probabilities(df, SQF_COLUMNS[:2], SQF_COLUMNS[2:]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default='.')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='rows of synthetic data if a file is missing')
+    parser.add_argument('--seed', type=int, default=2019)
+    arguments = parser.parse_args()
+    main(arguments.data_dir, arguments.rows, arguments.seed)
@@ -0,0 +1,285 @@
+"""
+Timing and memory benchmarks of the public functions and the notebook pipeline stages on synthetic data.
+
+The arrests, complaints and stop, question and frisk datasets are generated once per size with the seeded
+generators of synthetic.py. Every case prepares its input outside the timed section (so functions which
+modify their input in place, like normalized_values, always get a fresh one), is timed as the best of
+--repeat runs, and is run once more under tracemalloc to record the peak of memory allocated.
+
+Cases listed in MEMORY_CONTRACTS must keep their peak of memory within a multiple of the size of their
+(projected) input; a case breaking its contract also makes the exit status 1. The contract is only checked
+on inputs of at least CONTRACT_MIN_MB, below that the fixed overhead of pandas dominates the peak.
+
+The cold import time of the package modules listed in IMPORT_BUDGETS is measured in fresh interpreters, on
+top of importing pandas and numpy (which any use of the API pays for), as the best of --repeat runs. A module
+importing slower than its budget also makes the exit status 1.
+
+The results are written as JSON. When a baseline (a results file of an earlier run) is given, cases which
+got slower or use more memory than the tolerance allows are reported as regressions and the exit status
+is 1, so the script can gate a CI job. Regressions, broken memory contracts and slow imports are all
+reported before the script exits.
+
+Usage (from the repository root):
+    python benchmarks/run_benchmarks.py --rows 10000 1000000 --output results.json
+    python benchmarks/run_benchmarks.py --baseline results.json --tolerance 0.3
+    python benchmarks/run_benchmarks.py --rows 50000000 --cases grouping flag
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aggregate_cube import ARRESTS_DIMENSIONS, build_cube
+from data_schema import ARRESTS_SCHEMA, COMPLAINTS_SCHEMA, SQF_SCHEMA, apply_schema
+from Functions_and_Doctests import (AGE_POPULATION_SHARE, RACE_POPULATION_SHARE, SEX_POPULATION_SHARE,
+                                    age_pct_col, flag_counts, flag_probabilities, grouped_population_values,
+                                    grouping_for_count, merge_counts, normalized_values, population_share_lookup,
+                                    proportional_values, race_pct_col, select_columns, sex_pct_col)
+from heatmap_utils import grid_heatmap_data, time_frames
+from incremental import IncrementalCounts
+from inference import probability_intervals, proportion_intervals
+from report_lag import report_lag_histograms
+from spatial_index import RegionIndex, add_region_column
+from synthetic import GENERATORS, synthetic_regions
+
+SQF_GROUP = 'SUSPECT_RACE_DESCRIPTION'
+SQF_FLAGS = ['FRISKED_FLAG', 'SUSPECT_ARRESTED_FLAG']
+
+
+def _age_grouped(df):
+    return grouping_for_count(age_pct_col(df[['AGE_GROUP']]), 'AGE_GROUP', 'POP_BY_AGE_PCT', 'AGE_GROUP')
+
+
+def _normalized(df):
+    grouped = _age_grouped(df)
+    normalized_values(grouped, 'COUNT', 'POP_BY_AGE_PCT')
+    return grouped
+
+
+def _partials(df, parts=10):
+    bounds = np.linspace(0, len(df), parts + 1).astype(int)
+    return [df['AGE_GROUP'].iloc[start:stop].value_counts() for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+@functools.lru_cache(maxsize=None)
+def _region_index():
+    return RegionIndex(*synthetic_regions())
+
+
+def _coordinates(df):
+    _region_index()  # built outside the timed section
+    return df[['Latitude', 'Longitude']]
+
+
+@functools.lru_cache(maxsize=None)
+def _scratch_dir():
+    return tempfile.TemporaryDirectory()
+
+
+# This function writes the dataset as an extract, counts its first 90 % and then appends the rest to the file
+def _appended_extract(df):
+    directory = os.path.join(_scratch_dir().name, 'incremental')
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    path = os.path.join(directory, 'NYPD_Arrests_Data_2019.csv')
+    split = len(df) * 9 // 10
+    df.iloc[:split].to_csv(path, index=False)
+    store = IncrementalCounts(os.path.join(directory, 'counts'))
+    store.update(path)
+    df.iloc[split:].to_csv(path, mode='a', index=False, header=False)
+    return store, path
+
+
+# Case name -> (dataset, preparation of the input outside the timed section, timed function of that input)
+CASES = {
+    'population_share_lookup': ('arrests', lambda df: df['AGE_GROUP'],
+                                lambda values: population_share_lookup(values, AGE_POPULATION_SHARE)),
+    'select_columns': ('arrests', None, lambda df: select_columns(df, 'AGE_GROUP')),
+    'age_pct_col': ('arrests', lambda df: df[['AGE_GROUP']], age_pct_col),
+    'race_pct_col': ('sqf', lambda df: df[[SQF_GROUP]], lambda df: race_pct_col(df, SQF_GROUP)),
+    'sex_pct_col': ('sqf', lambda df: df[['SUSPECT_SEX']], lambda df: sex_pct_col(df, 'SUSPECT_SEX')),
+    'grouping_for_count': ('arrests', lambda df: age_pct_col(df[['AGE_GROUP']]),
+                           lambda df: grouping_for_count(df, 'AGE_GROUP', 'POP_BY_AGE_PCT', 'AGE_GROUP')),
+    'normalized_values': ('arrests', _age_grouped, lambda df: normalized_values(df, 'COUNT', 'POP_BY_AGE_PCT')),
+    'proportional_values': ('arrests', _normalized, proportional_values),
+    'grouped_population_values': ('arrests', None, lambda df: grouped_population_values(
+        df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT')),
+    'merge_counts': ('arrests', _partials, merge_counts),
+    'flag_counts': ('sqf', None, lambda df: flag_counts(df, SQF_GROUP, SQF_FLAGS)),
+    'flag_probabilities': ('sqf', None, lambda df: flag_probabilities(
+        df, SQF_GROUP, SQF_FLAGS, shares={SQF_GROUP: RACE_POPULATION_SHARE})),
+    'flag_probabilities.sex': ('sqf', None, lambda df: flag_probabilities(
+        df, 'SUSPECT_SEX', SQF_FLAGS, shares={'SUSPECT_SEX': SEX_POPULATION_SHARE})),
+    'report_lag_histograms': ('complaints', None, report_lag_histograms),
+    'grid_heatmap_data': ('arrests', None, lambda df: grid_heatmap_data(df['Latitude'], df['Longitude'])),
+    'time_frames.hour': ('complaints', None, lambda df: time_frames(
+        df, 'CMPLNT_FR_TM', 'hour', time_format='%H:%M:%S', cell_size=0.0025)),
+    'apply_schema.arrests': ('arrests', None, lambda df: apply_schema(df, ARRESTS_SCHEMA)),
+    'apply_schema.complaints': ('complaints', None, lambda df: apply_schema(df, COMPLAINTS_SCHEMA)),
+    'apply_schema.sqf': ('sqf', None, lambda df: apply_schema(df, SQF_SCHEMA)),
+    'build_cube': ('arrests', None, lambda df: build_cube(df, ARRESTS_DIMENSIONS)),
+    'cube.counts': ('arrests', lambda df: build_cube(df, ARRESTS_DIMENSIONS),
+                    lambda cube: cube.counts(['PERP_RACE', 'ARREST_PRECINCT'], where={'MONTH': [6, 7, 8]})),
+    'proportion_intervals': ('arrests', lambda df: grouped_population_values(
+        df, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT'), lambda df: proportion_intervals(
+        df, 'POP_BY_AGE_PCT', seed=0)),
+    'probability_intervals': ('sqf', lambda df: flag_probabilities(df, SQF_GROUP, SQF_FLAGS),
+                              lambda df: probability_intervals(df, seed=0)),
+    'add_region_column': ('arrests', _coordinates, lambda df: add_region_column(df, _region_index(), 'REGION')),
+    # Counting the last 10 % of the records appended to an extract whose first 90 % are already counted
+    'IncrementalCounts.update': ('arrests', _appended_extract, lambda arguments: arguments[0].update(arguments[1])),
+    # Hypothesis 1 of the notebook end to end, on the columns the schema converts at load time
+    'notebook.hypothesis_1': ('arrests', lambda df: apply_schema(df[['AGE_GROUP']], ARRESTS_SCHEMA),
+                              lambda df: proportional_values(_normalized(df))),
+    # The same on the projected column as read from the CSV file, without the schema
+    'notebook.hypothesis_1.raw': ('arrests', lambda df: df[['AGE_GROUP']],
+                                  lambda df: proportional_values(_normalized(select_columns(df, 'AGE_GROUP')))),
+}
+
+# Case name -> largest allowed peak of memory, as a multiple of the memory taken by the input of the case
+MEMORY_CONTRACTS = {'notebook.hypothesis_1.raw': 1.5}
+CONTRACT_MIN_MB = 10
+
+# Module -> largest allowed cold import time in seconds, on top of importing pandas and numpy
+IMPORT_BUDGETS = {'nypd_analysis': 0.02, 'nypd_analysis.lookup': 0.1, 'nypd_analysis.aggregate': 0.15}
+_IMPORT_TIMER = 'import time, numpy, pandas; start = time.perf_counter(); import {}; print(time.perf_counter() - start)'
+
+
+# This function returns the memory taken by a dataframe or series, None for other inputs
+def input_bytes(argument):
+    if isinstance(argument, pd.DataFrame):
+        return int(argument.memory_usage(deep=True).sum())
+    if isinstance(argument, pd.Series):
+        return int(argument.memory_usage(deep=True))
+    return None
+
+
+# This function times a case and measures the peak of memory it allocates
+def measure(dataset, prepare, function, repeat):
+    timings = []
+    for _ in range(repeat):
+        argument = prepare(dataset) if prepare else dataset
+        start = time.perf_counter()
+        function(argument)
+        timings.append(time.perf_counter() - start)
+    argument = prepare(dataset) if prepare else dataset
+    tracemalloc.start()
+    function(argument)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(timings), peak, input_bytes(argument)
+
+
+# This function runs the selected cases on every size
+def run(rows_list, repeat, seed, selected):
+    results = []
+    for rows in rows_list:
+        datasets = {}
+        for name, (dataset, prepare, function) in CASES.items():
+            if selected and not any(pattern in name for pattern in selected):
+                continue
+            if dataset not in datasets:
+                datasets[dataset] = GENERATORS[dataset](rows, seed)
+            seconds, peak, size = measure(datasets[dataset], prepare, function, repeat)
+            results.append({'case': name, 'rows': rows, 'seconds': seconds, 'peak_mb': peak / 1e6,
+                            'input_mb': None if size is None else size / 1e6})
+            print('{:<28} {:>12,} {:>10.4f} s {:>10.1f} MB'.format(name, rows, seconds, peak / 1e6), flush=True)
+    return results
+
+
+# This function measures the cold import time of a module in fresh interpreters
+def import_seconds(module, repeat):
+    return min(float(subprocess.run([sys.executable, '-c', _IMPORT_TIMER.format(module)], cwd=ROOT, check=True,
+                                    capture_output=True, text=True).stdout) for _ in range(repeat))
+
+
+# This function lists the results whose peak of memory breaks the contract of their case
+def contract_violations(results):
+    found = []
+    for result in results:
+        limit = MEMORY_CONTRACTS.get(result['case'])
+        if limit is None or not result.get('input_mb') or result['input_mb'] < CONTRACT_MIN_MB:
+            continue
+        if result['peak_mb'] > limit * result['input_mb']:
+            found.append((result, limit))
+    return found
+
+
+# This function lists the cases which got slower or use more memory than in the baseline
+def regressions(results, baseline, tolerance, min_seconds):
+    previous = {(result['case'], result['rows']): result for result in baseline['results']}
+    found = []
+    for result in results:
+        before = previous.get((result['case'], result['rows']))
+        if before is None:
+            continue
+        slower = result['seconds'] > before['seconds'] * (1 + tolerance) and \
+            result['seconds'] - before['seconds'] > min_seconds
+        bigger = result['peak_mb'] > before['peak_mb'] * (1 + tolerance) and result['peak_mb'] - before['peak_mb'] > 1
+        if slower or bigger:
+            found.append((result, before))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=2019)
+    parser.add_argument('--cases', nargs='+', default=None, help='only run the cases whose name contains one of these')
+    parser.add_argument('--output', default=None, help='JSON file the results are written to')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed relative slowdown/memory growth')
+    parser.add_argument('--min-seconds', type=float, default=0.005, help='ignore slowdowns smaller than this')
+    arguments = parser.parse_args()
+
+    print('{:<28} {:>12} {:>12} {:>13}'.format('case', 'rows', 'time', 'peak memory'))
+    report = {
+        'environment': {'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__,
+                        'machine': platform.machine(), 'processor': platform.processor(),
+                        'cpus': os.cpu_count()},
+        'seed': arguments.seed,
+        'repeat': arguments.repeat,
+        'results': run(arguments.rows, arguments.repeat, arguments.seed, arguments.cases),
+        'imports': {module: import_seconds(module, arguments.repeat) for module in IMPORT_BUDGETS},
+    }
+    for module, seconds in report['imports'].items():
+        print('import {:<30} {:>10.4f} s   budget {:.3f} s'.format(module, seconds, IMPORT_BUDGETS[module]))
+    if arguments.output:
+        with open(arguments.output, 'w') as out:
+            json.dump(report, out, indent=1)
+
+    violations = contract_violations(report['results'])
+    for result, limit in violations:
+        print('MEMORY CONTRACT {case} ({rows:,} rows): peak {peak_mb:.1f} MB for {input_mb:.1f} MB of input'
+              .format(**result) + ', allowed {:.1f}x'.format(limit))
+
+    found = []
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_in:
+            found = regressions(report['results'], json.load(baseline_in), arguments.tolerance, arguments.min_seconds)
+        for result, before in found:
+            print('REGRESSION {case} ({rows:,} rows): {seconds:.4f} s / {peak_mb:.1f} MB'.format(**result) +
+                  ', baseline {seconds:.4f} s / {peak_mb:.1f} MB'.format(**before))
+        if not found:
+            print('no regression against {}'.format(arguments.baseline))
+    slow_imports = [module for module, seconds in report['imports'].items() if seconds > IMPORT_BUDGETS[module]]
+    for module in slow_imports:
+        print('IMPORT BUDGET {}: {:.4f} s, allowed {:.3f} s'.format(module, report['imports'][module],
+                                                                   IMPORT_BUDGETS[module]))
+    # Every kind of failure is reported before exiting
+    if found or violations or slow_imports:
+        sys.exit(1)
@@ -0,0 +1,200 @@
+"""
+Seeded generators of synthetic data shaped like the 2019 NYPD arrests, complaints and stop, question and
+frisk extracts.
+
+The columns, labels and formats are those of the real files as pandas reads them (dates as mm/dd/yyyy
+strings, Y/N flags, '(null)' and empty values), with a skew of the categories, null rates and report lags
+of the same order as in the 2019 data, and coordinates clustered around the boroughs inside NYC_BOUNDS.
+Every distinct label is built once and the rows are gathered from small arrays of labels, so tens of
+millions of rows are generated in seconds. The same seed always produces the same data.
+synthetic_regions generates boundaries of precinct-like regions tiling the same bounding box.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from heatmap_utils import NYC_BOUNDS
+
+YEAR = 2019
+
+# Label -> share of the records, roughly as in the 2019 extracts
+ARREST_AGE_GROUPS = {'<18': 0.04, '18-24': 0.19, '25-44': 0.55, '45-64': 0.2, '65+': 0.02}
+ARREST_RACES = {'BLACK': 0.47, 'WHITE HISPANIC': 0.25, 'BLACK HISPANIC': 0.1, 'WHITE': 0.1,
+                'ASIAN / PACIFIC ISLANDER': 0.06, 'UNKNOWN': 0.015, 'AMERICAN INDIAN/ALASKAN NATIVE': 0.005}
+ARREST_SEXES = {'M': 0.83, 'F': 0.17}
+SQF_SEXES = {'MALE': 0.9, 'FEMALE': 0.08, '(null)': 0.02}
+SQF_RACES = {'BLACK': 0.59, 'WHITE HISPANIC': 0.18, 'BLACK HISPANIC': 0.09, 'WHITE': 0.09,
+             'ASIAN / PACIFIC ISLANDER': 0.04, '(null)': 0.008, 'AMERICAN INDIAN/ALASKAN NATIVE': 0.002}
+# Share of 'Y' of every stop, question and frisk outcome flag
+SQF_FLAGS = {'FRISKED_FLAG': 0.66, 'SEARCHED_FLAG': 0.36, 'SUSPECT_ARRESTED_FLAG': 0.3,
+             'SUMMONS_ISSUED_FLAG': 0.06}
+COMPLAINT_AGE_GROUPS = {'25-44': 0.3, '18-24': 0.1, '45-64': 0.12, '<18': 0.03, '65+': 0.015,
+                        'UNKNOWN': 0.2, '': 0.235}
+COMPLAINT_RACES = {'BLACK': 0.3, 'WHITE HISPANIC': 0.12, 'BLACK HISPANIC': 0.05, 'WHITE': 0.07,
+                   'ASIAN / PACIFIC ISLANDER': 0.03, 'UNKNOWN': 0.2, 'AMERICAN INDIAN/ALASKAN NATIVE': 0.004,
+                   '': 0.226}
+COMPLAINT_SEXES = {'M': 0.42, 'F': 0.15, 'U': 0.2, '': 0.23}
+OFFENSES = {'ASSAULT 3 & RELATED OFFENSES': 0.16, 'PETIT LARCENY': 0.16, 'HARRASSMENT 2': 0.15,
+            'DANGEROUS DRUGS': 0.1, 'CRIMINAL MISCHIEF & RELATED OF': 0.09, 'FELONY ASSAULT': 0.08,
+            'GRAND LARCENY': 0.08, 'ROBBERY': 0.05, 'BURGLARY': 0.05, 'SEX CRIMES': 0.03, 'FRAUDS': 0.05}
+# Borough code, name, centre of its cluster of coordinates and share of the records
+BOROUGHS = [('K', 'BROOKLYN', 40.650, -73.950, 0.3), ('M', 'MANHATTAN', 40.780, -73.970, 0.24),
+            ('B', 'BRONX', 40.840, -73.880, 0.22), ('Q', 'QUEENS', 40.720, -73.830, 0.2),
+            ('S', 'STATEN ISLAND', 40.580, -74.150, 0.04)]
+
+# Share of records without coordinates, and of complaints without the date the crime occurred
+MISSING_COORDINATES = 0.004
+MISSING_OCCURRED_DATE = 0.001
+
+
+# This function draws labels from a label -> share table, the empty label standing for a missing value
+def _choice(rng, table, rows):
+    labels = np.array([label or None for label in table], dtype=object)
+    weights = np.array(list(table.values()), dtype='float64')
+    return labels[rng.choice(len(labels), rows, p=weights / weights.sum())]
+
+
+# This function draws dates, as mm/dd/yyyy strings, from the days of YEAR shifted back by a lag
+def _dates(day_numbers):
+    first = np.datetime64('{}-01-01'.format(YEAR)) + day_numbers.min()
+    calendar = pd.date_range(first, periods=int(day_numbers.max() - day_numbers.min()) + 1, freq='D')
+    labels = np.array(calendar.strftime('%m/%d/%Y'), dtype=object)
+    return labels[day_numbers - day_numbers.min()]
+
+
+# This function draws coordinates clustered around the boroughs inside the NYC bounding box
+def _coordinates(rng, rows):
+    weights = np.array([borough[4] for borough in BOROUGHS])
+    boroughs = rng.choice(len(BOROUGHS), rows, p=weights / weights.sum())
+    south, north, west, east = NYC_BOUNDS
+    lat = np.clip(np.array([b[2] for b in BOROUGHS])[boroughs] + rng.normal(0, 0.03, rows), south, north)
+    lon = np.clip(np.array([b[3] for b in BOROUGHS])[boroughs] + rng.normal(0, 0.04, rows), west, east)
+    missing = rng.random(rows) < MISSING_COORDINATES
+    lat[missing] = np.nan
+    lon[missing] = np.nan
+    return boroughs, lat.round(5), lon.round(5)
+
+
+# This function generates an arrests extract
+def synthetic_arrests(rows, seed=2019):
+    """
+    This function returns a dataframe with the columns of NYPD_Arrests_Data_2019.csv.
+
+    :param rows: Number of records
+    :param seed: Seed of the random generator
+    :return: Dataframe of arrests
+    """
+    rng = np.random.default_rng(seed)
+    boroughs, lat, lon = _coordinates(rng, rows)
+    return pd.DataFrame({
+        'ARREST_KEY': rng.permutation(rows) + 190_000_000,
+        'ARREST_DATE': _dates(rng.integers(0, 365, rows)),
+        'OFNS_DESC': _choice(rng, OFFENSES, rows),
+        'ARREST_BORO': np.array([b[0] for b in BOROUGHS], dtype=object)[boroughs],
+        'ARREST_PRECINCT': rng.integers(1, 124, rows),
+        'AGE_GROUP': _choice(rng, ARREST_AGE_GROUPS, rows),
+        'PERP_SEX': _choice(rng, ARREST_SEXES, rows),
+        'PERP_RACE': _choice(rng, ARREST_RACES, rows),
+        'Latitude': lat,
+        'Longitude': lon,
+    })
+
+
+# This function generates a complaints extract
+def synthetic_complaints(rows, seed=2019):
+    """
+    This function returns a dataframe with the columns of NYPD_Complaint_Data_Historic_2019.csv. Most
+    complaints are reported on the day of the crime, the others after a geometrically distributed lag, so
+    some crimes occurred before the year of the report.
+
+    :param rows: Number of records
+    :param seed: Seed of the random generator
+    :return: Dataframe of complaints
+    """
+    rng = np.random.default_rng(seed)
+    boroughs, lat, lon = _coordinates(rng, rows)
+    reported = rng.integers(0, 365, rows)
+    lags = np.where(rng.random(rows) < 0.6, 0, rng.geometric(0.08, rows))
+    occurred = _dates(reported - lags)
+    occurred[rng.random(rows) < MISSING_OCCURRED_DATE] = np.nan
+    minutes = rng.integers(0, 24 * 60, rows)
+    times = np.array(['{:02d}:{:02d}:00'.format(minute // 60, minute % 60) for minute in range(24 * 60)],
+                     dtype=object)[minutes]
+    return pd.DataFrame({
+        'CMPLNT_NUM': rng.permutation(rows) + 100_000_000,
+        'CMPLNT_FR_DT': occurred,
+        'CMPLNT_FR_TM': times,
+        'RPT_DT': _dates(reported),
+        'OFNS_DESC': _choice(rng, OFFENSES, rows),
+        'BORO_NM': np.array([b[1] for b in BOROUGHS], dtype=object)[boroughs],
+        'SUSP_AGE_GROUP': _choice(rng, COMPLAINT_AGE_GROUPS, rows),
+        'SUSP_RACE': _choice(rng, COMPLAINT_RACES, rows),
+        'SUSP_SEX': _choice(rng, COMPLAINT_SEXES, rows),
+        'Latitude': lat,
+        'Longitude': lon,
+    })
+
+
+# This function generates a stop, question and frisk extract
+def synthetic_sqf(rows, seed=2019):
+    """
+    This function returns a dataframe with the demographic and outcome columns of sqf-2019.xlsx.
+
+    :param rows: Number of records
+    :param seed: Seed of the random generator
+    :return: Dataframe of stops
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'SUSPECT_SEX': _choice(rng, SQF_SEXES, rows),
+                       'SUSPECT_RACE_DESCRIPTION': _choice(rng, SQF_RACES, rows)})
+    for flag, share in SQF_FLAGS.items():
+        df[flag] = np.where(rng.random(rows) < share, 'Y', 'N').astype(object)
+    return df
+
+
+# This function generates precinct-like regions tiling the NYC bounding box
+def synthetic_regions(rows=8, cols=10, points=400, seed=2019):
+    """
+    This function returns jagged quadrilaterals tiling NYC_BOUNDS, with about as many regions and vertices
+    as the precinct boundaries, as the (keys, edges, edge_region) tuple of spatial_index.read_regions.
+
+    :param rows: Number of regions from south to north
+    :param cols: Number of regions from west to east
+    :param points: Number of vertices of every side of a region
+    :param seed: Seed of the random generator
+    :return: Tuple of the region keys, the (n, 4) edge array and the region of every edge
+    """
+    rng = np.random.default_rng(seed)
+    south, north, west, east = NYC_BOUNDS
+    lat = np.linspace(south, north, rows + 1)[:, None] + rng.normal(0, 0.005, (rows + 1, cols + 1))
+    lon = np.linspace(west, east, cols + 1)[None, :] + rng.normal(0, 0.005, (rows + 1, cols + 1))
+    steps = np.linspace(0, 1, points, endpoint=False)
+
+    # Every side is shared by the two regions it separates, so it is drawn once
+    def side(start, stop):
+        line = np.array(start) + steps[:, None] * (np.array(stop) - np.array(start))
+        return line + rng.normal(0, 0.00003, line.shape) * (steps[:, None] > 0)
+
+    south_sides = {(i, j): side((lon[i, j], lat[i, j]), (lon[i, j + 1], lat[i, j + 1]))
+                   for i in range(rows + 1) for j in range(cols)}
+    west_sides = {(i, j): side((lon[i, j], lat[i, j]), (lon[i + 1, j], lat[i + 1, j]))
+                  for i in range(rows) for j in range(cols + 1)}
+    keys, edges, edge_region = [], [], []
+    for i in range(rows):
+        for j in range(cols):
+            # Counterclockwise from the south-west corner, the north and west sides walked backwards
+            north_side, west_side = south_sides[i + 1, j], west_sides[i, j]
+            ring = np.vstack([south_sides[i, j], west_sides[i, j + 1], [(lon[i + 1, j + 1], lat[i + 1, j + 1])],
+                              north_side[:0:-1], north_side[:1], west_side[:0:-1], west_side[:1]])
+            edges.append(np.hstack([ring[:-1], ring[1:]]))
+            edge_region.append(np.full(len(ring) - 1, len(keys), dtype='int32'))
+            keys.append(len(keys) + 1)
+    return keys, np.vstack(edges), np.concatenate(edge_region)
+
+
+# Dataset name -> generator
+GENERATORS = {'arrests': synthetic_arrests, 'complaints': synthetic_complaints, 'sqf': synthetic_sqf}
@@ -0,0 +1,253 @@
+"""
+Concurrent loading of many extract files (one per year, borough or dataset) into one dataframe or a stream
+of partitions.
+
+The files are given as glob patterns, paths or a JSON manifest (see expand_sources), and the dataset of
+every file (arrests, complaints or sqf) is told from its name unless the manifest says it. Every file goes
+through the Arrow cache of data_loading.py:
+- the parsing (CSV chunks, Excel workbooks), which is CPU bound, runs in a pool of worker processes that
+  write the projected columns of the file to its Arrow IPC cache and only send back the path of that file.
+  Files whose cache is up to date are not parsed again;
+- the cache files are then memory-mapped and converted to pandas by threads of the calling process, which
+  mostly wait on I/O, and the schema of the dataset is applied so every partition has the same canonical
+  labels and dtypes.
+
+All the files are processed at the same time, up to max_pending files: a new file is only started when
+the partition of a finished one has been consumed, which bounds the memory taken by partitions waiting to
+be consumed (backpressure). With enough workers the whole load takes about as long as the slowest file.
+
+Usage:
+    python bulk_loading.py "data/NYPD_Arrests_Data_*.csv" --columns AGE_GROUP PERP_RACE --workers 8
+    python bulk_loading.py manifest.json --columns SUSPECT_SEX FRISKED_FLAG --dataset sqf
+"""
+import argparse
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from data_loading import arrow_cache, concat_chunks, read_arrow
+from data_schema import apply_schema
+from instrumentation import instrumented
+from parallel_hypotheses import DATASETS, _source_reader
+
+# Dataset -> lower-case fragments of the file names of its extracts
+DATASET_NAMES = {'arrests': ('arrest',), 'complaints': ('complaint',), 'sqf': ('sqf', 'stop', 'frisk')}
+
+
+# This function tells the dataset of an extract from its file name
+def detect_dataset(path):
+    """
+    :param path: Path of an extract
+    :return: 'arrests', 'complaints' or 'sqf'
+
+    >>> detect_dataset('data/NYPD_Arrests_Data_2018.csv'), detect_dataset('sqf-2017.xlsx')
+    ('arrests', 'sqf')
+    """
+    name = os.path.basename(path).lower()
+    for dataset, fragments in DATASET_NAMES.items():
+        if any(fragment in name for fragment in fragments):
+            return dataset
+    raise ValueError('Cannot tell the dataset of {!r} from its name, list it in a manifest with its '
+                     'dataset'.format(path))
+
+
+# This function expands a path or glob pattern into the matching files
+def _matching_files(pattern):
+    files = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+    if not files or not os.path.exists(files[0]):
+        raise FileNotFoundError('No file matches {!r}'.format(pattern))
+    return files
+
+
+# This function lists the files of a set of sources with their dataset
+def expand_sources(sources, dataset=None):
+    """
+    This function lists the files to be loaded. Sources may be a path, a glob pattern, the path of a JSON
+    manifest, or a list of those. A manifest holds a list of paths or glob patterns (relative to the
+    manifest) or of {"path": ..., "dataset": ...} entries naming the dataset of files whose name does not
+    tell it.
+
+    :param sources: Path, glob pattern, manifest or list of them
+    :param dataset: Optional dataset the files are restricted to
+    :return: List of (dataset, path) tuples without duplicates, in the order of the sources (glob matches
+             sorted by name)
+
+    >>> expand_sources('dummy_doctest_files/*_sample.csv')
+    [('arrests', 'dummy_doctest_files/Arrests_sample.csv'), ('complaints', 'dummy_doctest_files/Complaints_sample.csv')]
+    >>> expand_sources(['dummy_doctest_files/*_sample.csv'], dataset='complaints')
+    [('complaints', 'dummy_doctest_files/Complaints_sample.csv')]
+    """
+    entries = []
+    for source in [sources] if isinstance(sources, (str, os.PathLike, dict)) else sources:
+        if isinstance(source, dict):
+            entries.extend((source.get('dataset'), path) for path in _matching_files(source['path']))
+        elif str(source).lower().endswith('.json'):
+            with open(source) as manifest_in:
+                manifest = json.load(manifest_in)
+            base = os.path.dirname(str(source))
+            for entry in manifest:
+                entry = dict(entry) if isinstance(entry, dict) else {'path': entry}
+                entry['path'] = os.path.join(base, entry['path'])
+                entries.extend((entry.get('dataset'), path) for path in _matching_files(entry['path']))
+        else:
+            entries.extend((None, path) for path in _matching_files(str(source)))
+    found = {}
+    for entry_dataset, path in entries:
+        found.setdefault(path, entry_dataset or detect_dataset(path))
+    return [(found_dataset, path) for path, found_dataset in found.items()
+            if dataset is None or found_dataset == dataset]
+
+
+# This function returns the tag of the Arrow cache of the projected columns of a file. Files of different
+# directories with the same name (e.g. one directory per borough) get different caches in a shared cache_dir
+def _cache_tag(path, columns, clashing):
+    tag = 'columns-' + '-'.join(sorted(columns))
+    if clashing:
+        tag += '-' + hashlib.blake2b(os.path.dirname(os.path.abspath(path)).encode(), digest_size=4).hexdigest()
+    return tag
+
+
+# This function is run by the worker processes: it parses the projected columns of a file into its Arrow cache
+def _parse_source(dataset, path, columns, cache_dir, tag):
+    return arrow_cache(path, _source_reader(dataset, columns), cache_dir, tag)
+
+
+# This function is run by the threads: it waits for the Arrow cache of a file and reads it back
+def _load_source(pool, dataset, path, columns, cache_dir, tag, source_col):
+    arguments = (dataset, path, columns, cache_dir, tag)
+    cache_file = pool.submit(_parse_source, *arguments).result() if pool else _parse_source(*arguments)
+    df = apply_schema(read_arrow(cache_file, columns), DATASETS[dataset][1])
+    if source_col is not None:
+        df[source_col] = pd.Categorical.from_codes(np.zeros(len(df), dtype='int8'), categories=[path])
+    return dataset, path, df
+
+
+# This function streams the partitions of many files, loaded concurrently with bounded memory
+def iter_partitions(sources, columns, dataset=None, workers=None, max_pending=None, ordered=True, cache_dir=None,
+                    source_col=None):
+    """
+    This function loads the files of the sources concurrently (see the module documentation) and yields
+    one partition per file.
+
+    :param sources: Path, glob pattern, manifest or list of them (see expand_sources)
+    :param columns: List of the columns to load, or dictionary mapping each dataset to its list of columns
+    :param dataset: Optional dataset the files are restricted to
+    :param workers: Number of worker processes parsing the files, all the cores when None; 1 parses in
+                    threads of the calling process
+    :param max_pending: Largest number of files being loaded or waiting to be consumed, twice the number of
+                        workers when None
+    :param ordered: Whether the partitions are yielded in the order of the sources, or as they are ready
+    :param cache_dir: Directory holding the Arrow files, defaults to .nypd_cache next to every file
+    :param source_col: Optional name of a categorical column added with the path of the file of every record
+    :return: Generator of (dataset, path, dataframe) tuples
+
+    >>> import shutil, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> for year in (2018, 2019):
+    ...     _ = shutil.copy('dummy_doctest_files/Arrests_sample.csv', '{}/NYPD_Arrests_Data_{}.csv'.format(tmp, year))
+    >>> for dataset, path, df in iter_partitions(tmp + '/*.csv', ['AGE_GROUP', 'PERP_SEX'], workers=2):
+    ...     print(dataset, os.path.basename(path), df.shape, df['PERP_SEX'].cat.categories.tolist())
+    arrests NYPD_Arrests_Data_2018.csv (6, 2) ['MALE', 'FEMALE']
+    arrests NYPD_Arrests_Data_2019.csv (6, 2) ['MALE', 'FEMALE']
+    >>> shutil.rmtree(tmp)
+    """
+    entries = expand_sources(sources, dataset)
+    names = collections.Counter(os.path.basename(path) for _, path in entries)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max(1, max_pending or 2 * workers)
+    pool = ProcessPoolExecutor(max_workers=min(workers, len(entries))) if workers > 1 and entries else None
+    threads = ThreadPoolExecutor(max_workers=max_pending)
+    pending = collections.deque()
+    remaining = iter(entries)
+    try:
+        while True:
+            for entry_dataset, path in remaining:
+                entry_columns = list(columns[entry_dataset] if isinstance(columns, dict) else columns)
+                tag = _cache_tag(path, entry_columns, cache_dir is not None and names[os.path.basename(path)] > 1)
+                pending.append(threads.submit(_load_source, pool, entry_dataset, path, entry_columns, cache_dir, tag,
+                                              source_col))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                return
+            if ordered:
+                future = pending.popleft()
+            else:
+                future = next(iter(concurrent.futures.wait(pending, return_when='FIRST_COMPLETED')[0]))
+                pending.remove(future)
+            yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        threads.shutdown()
+        if pool is not None:
+            pool.shutdown()
+
+
+# This function loads many files of one dataset into a single dataframe
+@instrumented
+def load_sources(sources, columns, dataset=None, workers=None, max_pending=None, cache_dir=None, source_col=None):
+    """
+    This function loads the files of one dataset concurrently (see iter_partitions) and concatenates them
+    in the order of the sources. Categorical columns keep their canonical categories.
+
+    :param sources: Path, glob pattern, manifest or list of them (see expand_sources)
+    :param columns: List of the columns to load
+    :param dataset: Dataset of the files, required when the sources hold files of several datasets
+    :param workers: Number of worker processes parsing the files, all the cores when None
+    :param max_pending: Largest number of files being loaded at the same time
+    :param cache_dir: Directory holding the Arrow files, defaults to .nypd_cache next to every file
+    :param source_col: Optional name of a categorical column added with the path of the file of every record
+    :return: Dataframe of the records of all the files
+
+    >>> import shutil, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> manifest = os.path.join(tmp, 'manifest.json')
+    >>> with open(manifest, 'w') as manifest_out:
+    ...     json.dump([{'path': os.path.abspath('dummy_doctest_files/Arrests_sample.csv'), 'dataset': 'arrests'},
+    ...                os.path.abspath('dummy_doctest_files/Complaints_sample.csv')], manifest_out)
+    >>> df = load_sources(manifest, ['AGE_GROUP'], dataset='arrests', workers=1, cache_dir=tmp, source_col='FILE')
+    >>> df.groupby('FILE', observed=True).size().rename(index=os.path.basename)
+    FILE
+    Arrests_sample.csv    6
+    dtype: int64
+    >>> load_sources(manifest, ['AGE_GROUP'], workers=1, cache_dir=tmp)
+    Traceback (most recent call last):
+    ...
+    ValueError: The sources hold files of several datasets (arrests, complaints), pass one with dataset
+    >>> shutil.rmtree(tmp)
+    """
+    found = sorted({entry_dataset for entry_dataset, _ in expand_sources(sources, dataset)})
+    if len(found) > 1:
+        raise ValueError('The sources hold files of several datasets ({}), pass one with dataset'
+                         .format(', '.join(found)))
+    return concat_chunks(df for _, _, df in iter_partitions(sources, columns, dataset, workers, max_pending,
+                                                            True, cache_dir, source_col))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('sources', nargs='+', help='paths, glob patterns or JSON manifests')
+    parser.add_argument('--columns', nargs='+', required=True)
+    parser.add_argument('--dataset', choices=list(DATASET_NAMES), default=None)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, all the cores by default')
+    parser.add_argument('--max-pending', type=int, default=None)
+    arguments = parser.parse_args()
+
+    started = time.perf_counter()
+    rows = 0
+    for found_dataset, found_path, partition in iter_partitions(arguments.sources, arguments.columns,
+                                                                arguments.dataset, arguments.workers,
+                                                                arguments.max_pending, ordered=False):
+        rows += len(partition)
+        print('{:>8.2f} s  {:<10} {:>12,} rows  {}'.format(time.perf_counter() - started, found_dataset,
+                                                             len(partition), found_path), flush=True)
+    print('{:,} rows in {:.2f} s'.format(rows, time.perf_counter() - started))
@@ -0,0 +1,519 @@
+"""
+Streaming readers for the NYPD arrests and complaints CSV extracts.
+
+Instead of loading a whole extract with every column and default (object) dtypes, the files are read in
+chunks with only the requested columns, explicit compact dtypes and the date columns parsed during the
+read. The chunk generators can be passed straight to grouping_for_count, grouped_population_values and
+flag_probabilities in Functions_and_Doctests.py, which merge the partial counts of every chunk, so peak
+memory depends on the chunk size and not on the size of the file.
+
+Sources which are slow to parse (mainly the sqf-2019.xlsx workbook) can be read through cached_read, which
+converts them once into an Arrow IPC file and memory-maps that file on later loads.
+
+The extracts are looked up in the directory named by the NYPD_DATA_DIR environment variable (the working
+directory when it is not set) unless a path is given, see data_path.
+"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from data_schema import ARRESTS_SCHEMA, COMPLAINTS_SCHEMA, SQF_SCHEMA, apply_schema
+from instrumentation import instrumented
+
+# Default file names of the 2019 extracts downloaded from NYC Open Data
+ARRESTS_FILE = 'NYPD_Arrests_Data_2019.csv'
+COMPLAINTS_FILE = 'NYPD_Complaint_Data_Historic_2019.csv'
+SQF_FILE = 'sqf-2019.xlsx'
+# Environment variable naming the directory of the extracts
+DATA_DIR_VARIABLE = 'NYPD_DATA_DIR'
+
+# Cached copies are written to this directory (relative to the source file) unless another one is given
+CACHE_DIR_NAME = '.nypd_cache'
+# Bumped whenever the layout of the cache files changes, so old caches are rebuilt
+CACHE_FORMAT_VERSION = 1
+# Rows per Arrow record batch in the cache file
+CACHE_BATCH_ROWS = 1_000_000
+
+DEFAULT_CHUNKSIZE = 250_000
+
+# Compact dtypes for the columns used in the analysis. Low-cardinality text columns are read as
+# categoricals, coordinates as float32 (~1 m precision at NYC latitudes) and codes as small
+# nullable integers, so that a record without a code does not fail the read.
+ARRESTS_DTYPES = {
+    'ARREST_KEY': 'int64',
+    'PD_CD': 'Int16',
+    'PD_DESC': 'category',
+    'KY_CD': 'Int16',
+    'OFNS_DESC': 'category',
+    'LAW_CODE': 'category',
+    'LAW_CAT_CD': 'category',
+    'ARREST_BORO': 'category',
+    'ARREST_PRECINCT': 'Int16',
+    'JURISDICTION_CODE': 'Int16',
+    'AGE_GROUP': 'category',
+    'PERP_SEX': 'category',
+    'PERP_RACE': 'category',
+    'X_COORD_CD': 'float32',
+    'Y_COORD_CD': 'float32',
+    'Latitude': 'float32',
+    'Longitude': 'float32',
+}
+
+COMPLAINTS_DTYPES = {
+    'CMPLNT_NUM': 'int64',
+    'CMPLNT_FR_TM': 'category',
+    'CMPLNT_TO_TM': 'category',
+    'ADDR_PCT_CD': 'Int16',
+    'KY_CD': 'Int16',
+    'OFNS_DESC': 'category',
+    'PD_CD': 'Int16',
+    'PD_DESC': 'category',
+    'CRM_ATPT_CPTD_CD': 'category',
+    'LAW_CAT_CD': 'category',
+    'BORO_NM': 'category',
+    'LOC_OF_OCCUR_DESC': 'category',
+    'PREM_TYP_DESC': 'category',
+    'JURIS_DESC': 'category',
+    'JURISDICTION_CODE': 'Int16',
+    'SUSP_AGE_GROUP': 'category',
+    'SUSP_RACE': 'category',
+    'SUSP_SEX': 'category',
+    'Latitude': 'float32',
+    'Longitude': 'float32',
+    'PATROL_BORO': 'category',
+    'VIC_AGE_GROUP': 'category',
+    'VIC_RACE': 'category',
+    'VIC_SEX': 'category',
+}
+
+# Date columns and their format in the extracts
+ARRESTS_DATES = {'ARREST_DATE': '%m/%d/%Y'}
+COMPLAINTS_DATES = {'CMPLNT_FR_DT': '%m/%d/%Y', 'CMPLNT_TO_DT': '%m/%d/%Y', 'RPT_DT': '%m/%d/%Y'}
+
+
+# This function reads a CSV file in chunks, keeping only the requested columns with compact dtypes
+def read_csv_chunks(path, usecols, dtypes=None, dates=None, chunksize=DEFAULT_CHUNKSIZE, schema=None, offset=0):
+    """
+    This function is a generator which yields the CSV file chunk by chunk. Only the columns in usecols
+    are parsed, columns found in dtypes get that dtype and columns found in dates are converted to
+    datetimes with the given format. Dates that do not match the format (the complaint data has a few
+    records with years such as 1019) become NaT instead of failing the read. When a schema is given
+    (see data_schema.py) it is applied to every chunk, so all chunks start with the same canonical
+    categories in the same order; labels outside them are appended per chunk, so a chunk may have extra
+    categories (concat_chunks and merge_counts take the union of the categories).
+
+    With an offset, parsing starts at that byte of the file (the column names are still taken from its
+    header line), e.g. at the size the file had when it was last read, to only read the rows appended since.
+
+    :param path: Path of the CSV file
+    :param usecols: List of the columns to be read
+    :param dtypes: Dictionary mapping column names to dtypes, columns which are not read are ignored
+    :param dates: Dictionary mapping date column names to their strftime format
+    :param chunksize: Number of rows per chunk
+    :param schema: Optional dataset schema applied to every chunk
+    :param offset: Byte offset of the first line to parse, past the header line
+    :return: Generator of dataframes with at most chunksize rows each
+
+    >>> chunks = read_csv_chunks('dummy_doctest_files/Arrests_sample.csv', ['ARREST_DATE', 'AGE_GROUP'],
+    ...                          ARRESTS_DTYPES, ARRESTS_DATES, chunksize=4)
+    >>> [len(chunk) for chunk in chunks]
+    [4, 2]
+    >>> chunk = next(read_csv_chunks('dummy_doctest_files/Arrests_sample.csv', ['ARREST_DATE', 'AGE_GROUP'],
+    ...                              ARRESTS_DTYPES, ARRESTS_DATES))
+    >>> chunk['ARREST_DATE'].iloc[0], str(chunk['AGE_GROUP'].dtype)
+    (Timestamp('2019-01-26 00:00:00'), 'category')
+    >>> with open('dummy_doctest_files/Arrests_sample.csv', 'rb') as source:
+    ...     offset = len(source.readline()) + len(source.readline())
+    >>> [chunk['ARREST_KEY'].tolist() for chunk in read_csv_chunks('dummy_doctest_files/Arrests_sample.csv',
+    ...                                                             ['ARREST_KEY'], offset=offset, chunksize=3)]
+    [[193260691, 149117452, 190049060], [190313413, 193184930]]
+    """
+    usecols = list(usecols)
+    dtype = {col: dtypes[col] for col in usecols if dtypes and col in dtypes}
+    with open(path, 'rb') as source:
+        options = {}
+        if offset:
+            options = {'header': None, 'names': pd.read_csv(source, nrows=0).columns.tolist()}
+            source.seek(offset)
+        with pd.read_csv(source, usecols=usecols, dtype=dtype, chunksize=chunksize, **options) as reader:
+            for chunk in reader:
+                for col, date_format in (dates or {}).items():
+                    if col in chunk:
+                        chunk[col] = pd.to_datetime(chunk[col], format=date_format, errors='coerce')
+                if schema is not None:
+                    chunk = apply_schema(chunk, schema)
+                yield chunk[usecols]
+
+
+# This function returns the directory of the extracts
+def data_dir():
+    """
+    :return: Directory named by the NYPD_DATA_DIR environment variable, '.' when it is not set
+    """
+    return os.environ.get(DATA_DIR_VARIABLE) or '.'
+
+
+# This function returns the path of a data file in the directory of the extracts
+def data_path(file_name, directory=None):
+    """
+    :param file_name: Name of the file, e.g. ARRESTS_FILE
+    :param directory: Directory of the file, data_dir() when None
+    :return: Path of the file
+
+    >>> data_path(ARRESTS_FILE, 'D:/Downloads')
+    'D:/Downloads/NYPD_Arrests_Data_2019.csv'
+    >>> os.environ[DATA_DIR_VARIABLE] = 'data'
+    >>> data_path(SQF_FILE)
+    'data/sqf-2019.xlsx'
+    >>> del os.environ[DATA_DIR_VARIABLE]
+    """
+    return os.path.join(directory or data_dir(), file_name)
+
+
+# This function streams the arrests extract
+def read_arrests_chunks(usecols, path=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    This function streams the NYPD arrests extract with the arrests dtypes, date format and schema.
+
+    :param usecols: List of the columns to be read
+    :param path: Path of the arrests CSV file, data_path(ARRESTS_FILE) when None
+    :param chunksize: Number of rows per chunk
+    :return: Generator of dataframe chunks
+
+    >>> from Functions_and_Doctests import AGE_POPULATION_SHARE, grouped_population_values
+    >>> chunks = read_arrests_chunks(['AGE_GROUP'], 'dummy_doctest_files/Arrests_sample.csv', chunksize=2)
+    >>> grouped_population_values(chunks, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT')
+      AGE_GROUP  POP_BY_AGE_PCT  COUNT  NORM_VALUES  PROP_VALUES
+    0       <18           0.232      1            4        12.12
+    1     18-24           0.065      1           15        45.45
+    2     25-44           0.272      3           11        33.33
+    3     45-64           0.261      1            3         9.09
+
+    The codes are read as nullable integers:
+
+    >>> next(read_arrests_chunks(['ARREST_PRECINCT', 'KY_CD', 'PD_CD', 'JURISDICTION_CODE'],
+    ...                          'dummy_doctest_files/Arrests_sample.csv')).dtypes
+    ARREST_PRECINCT      Int16
+    KY_CD                Int16
+    PD_CD                Int16
+    JURISDICTION_CODE    Int16
+    dtype: object
+    """
+    path = data_path(ARRESTS_FILE) if path is None else path
+    return read_csv_chunks(path, usecols, ARRESTS_DTYPES, ARRESTS_DATES, chunksize, ARRESTS_SCHEMA)
+
+
+# This function streams the complaints extract
+def read_complaints_chunks(usecols, path=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    This function streams the NYPD complaints extract with the complaints dtypes, date formats and schema.
+
+    :param usecols: List of the columns to be read
+    :param path: Path of the complaints CSV file, data_path(COMPLAINTS_FILE) when None
+    :param chunksize: Number of rows per chunk
+    :return: Generator of dataframe chunks
+
+    The codes are read as nullable integers, a complaint without a precinct gets <NA>:
+
+    >>> chunk = next(read_complaints_chunks(['ADDR_PCT_CD', 'KY_CD', 'PD_CD', 'JURISDICTION_CODE'],
+    ...                                     'dummy_doctest_files/Complaints_sample.csv'))
+    >>> chunk.dtypes
+    ADDR_PCT_CD          Int16
+    KY_CD                Int16
+    PD_CD                Int16
+    JURISDICTION_CODE    Int16
+    dtype: object
+    >>> chunk['ADDR_PCT_CD'].tolist()
+    [20, 47, 105, <NA>, 44, 9]
+    """
+    path = data_path(COMPLAINTS_FILE) if path is None else path
+    return read_csv_chunks(path, usecols, COMPLAINTS_DTYPES, COMPLAINTS_DATES, chunksize, COMPLAINTS_SCHEMA)
+
+
+# This function stitches streamed chunks back into one dataframe
+@instrumented
+def concat_chunks(chunks):
+    """
+    This function concatenates dataframe chunks into a single dataframe. Categorical columns whose
+    categories differ between chunks get the union of the categories so that they stay categorical
+    instead of falling back to object dtype. Use it when the projected columns do fit in memory (e.g. for plotting).
+
+    :param chunks: Iterable of dataframes with the same columns
+    :return: A single dataframe with a fresh RangeIndex
+
+    >>> df = concat_chunks(read_arrests_chunks(['PERP_SEX', 'Latitude'],
+    ...                                        'dummy_doctest_files/Arrests_sample.csv', chunksize=3))
+    >>> df.dtypes
+    PERP_SEX    category
+    Latitude     float32
+    dtype: object
+    >>> df['PERP_SEX'].value_counts()
+    PERP_SEX
+    MALE      4
+    FEMALE    2
+    Name: count, dtype: int64
+    >>> len(df)
+    6
+    """
+    chunks = list(chunks)
+    if not chunks:
+        raise ValueError('No chunks to concatenate')
+    columns = {}
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            # Keep the category order of the first chunk and append labels only seen in later chunks
+            categories = list(dict.fromkeys(label for chunk in chunks for label in chunk[col].cat.categories))
+            dtype = pd.CategoricalDtype(categories, ordered=chunks[0][col].cat.ordered)
+            columns[col] = pd.concat([chunk[col].astype(dtype) for chunk in chunks], ignore_index=True)
+        else:
+            columns[col] = pd.concat([chunk[col] for chunk in chunks], ignore_index=True)
+    return pd.DataFrame(columns)
+
+
+# This function reads only the requested columns of the arrests extract into one dataframe
+@instrumented
+def read_arrests(usecols, path=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    This function loads the requested columns of the arrests extract with compact dtypes.
+
+    :param usecols: List of the columns to be read
+    :param path: Path of the arrests CSV file, data_path(ARRESTS_FILE) when None
+    :param chunksize: Number of rows parsed at a time
+    :return: Dataframe with the requested columns
+    """
+    return concat_chunks(read_arrests_chunks(usecols, path, chunksize))
+
+
+# This function reads only the requested columns of the complaints extract into one dataframe
+@instrumented
+def read_complaints(usecols, path=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    This function loads the requested columns of the complaints extract with compact dtypes.
+
+    :param usecols: List of the columns to be read
+    :param path: Path of the complaints CSV file, data_path(COMPLAINTS_FILE) when None
+    :param chunksize: Number of rows parsed at a time
+    :return: Dataframe with the requested columns
+    """
+    return concat_chunks(read_complaints_chunks(usecols, path, chunksize))
+
+
+# This function computes the fingerprint used to decide whether a cached copy of a source file is stale
+def source_fingerprint(path, with_hash=True):
+    """
+    This function returns the size, modification time and (optionally) BLAKE2 hash of a file. The hash is
+    computed in 1 MB blocks so that large workbooks are never loaded into memory at once.
+
+    :param path: Path of the source file
+    :param with_hash: Whether the content hash should be computed as well
+    :return: Dictionary with the 'size', 'mtime_ns' and 'hash' keys ('hash' is None when not computed)
+
+    >>> fingerprint = source_fingerprint('dummy_doctest_files/Age_group.csv')
+    >>> fingerprint['size'] == os.path.getsize('dummy_doctest_files/Age_group.csv'), len(fingerprint['hash'])
+    (True, 40)
+    """
+    stat = os.stat(path)
+    digest = None
+    if with_hash:
+        hasher = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 20), b''):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest}
+
+
+# This function picks the pandas reader for a source file based on its extension
+def _default_reader(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in ('.xlsx', '.xls'):
+        return pd.read_excel
+    if extension == '.csv':
+        return lambda source: pd.read_csv(source, low_memory=False)
+    raise ValueError('No default reader for {!r}, pass one with the reader argument'.format(path))
+
+
+# This function converts columns that Arrow cannot store as one type into strings. This covers object columns
+# mixing numbers and text, and categoricals, whose categories may differ from one chunk to the next while an
+# Arrow IPC file only holds one dictionary per column (the schema is re-applied when the cache is read back)
+def _arrow_compatible(df):
+    text = [col for col in df.columns
+            if isinstance(df[col].dtype, pd.CategoricalDtype)
+            or (df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True).startswith('mixed'))]
+    if text:
+        df = df.assign(**{col: df[col].astype('string') for col in text})
+    return df
+
+
+# This function imports the optional pyarrow dependency
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+    except ImportError as error:
+        raise ImportError('The Arrow cache requires pyarrow, install it with "pip install pyarrow"') from error
+    return pa
+
+
+# This function builds (when needed) the Arrow IPC cache of a source file and returns its path
+@instrumented
+def arrow_cache(path, reader, cache_dir=None, tag=None):
+    """
+    This function converts a source file into an Arrow IPC file, unless an up-to-date conversion already
+    exists, and returns the path of that file. The reader may return a single dataframe or an iterable of
+    dataframe chunks (e.g. read_csv_chunks); chunks are written as separate record batches as they arrive,
+    so a large CSV is converted with bounded memory. The file can then be memory-mapped by any number of
+    processes without copying it (see read_arrow).
+
+    The cache is invalidated when the source changes: if the size and modification time still match the
+    ones recorded with the cache it is used straight away, otherwise the content hash decides (a file which
+    was only touched keeps its cache).
+
+    :param path: Path of the source file
+    :param reader: Function parsing the source into a dataframe or an iterable of dataframe chunks
+    :param cache_dir: Directory holding the cache files, defaults to .nypd_cache next to the source
+    :param tag: Optional suffix telling apart caches of different projections of the same source
+    :return: Path of the Arrow IPC file
+    """
+    pa = _import_pyarrow()
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    name = os.path.basename(path) + ('.' + tag if tag else '')
+    cache_file = os.path.join(cache_dir, name + '.arrow')
+    meta_file = os.path.join(cache_dir, name + '.json')
+
+    if not _cache_is_fresh(path, cache_file, meta_file):
+        result = reader(path)
+        chunks = [result] if isinstance(result, pd.DataFrame) else result
+        tmp_file = cache_file + '.tmp'
+        writer = schema = None
+        with pa.OSFile(tmp_file, 'wb') as sink:
+            for chunk in chunks:
+                table = pa.Table.from_pandas(_arrow_compatible(chunk), schema=schema, preserve_index=False)
+                if writer is None:
+                    schema = table.schema
+                    writer = pa.ipc.new_file(sink, schema)
+                for batch in table.to_batches(max_chunksize=CACHE_BATCH_ROWS):
+                    writer.write_batch(batch)
+            if writer is None:
+                raise ValueError('{!r} did not produce any data'.format(path))
+            writer.close()
+        os.replace(tmp_file, cache_file)
+        meta = dict(source_fingerprint(path), version=CACHE_FORMAT_VERSION)
+        with open(meta_file, 'w') as meta_out:
+            json.dump(meta, meta_out)
+    return cache_file
+
+
+# This function reads columns and a row range of an Arrow IPC file through a memory map
+@instrumented
+def read_arrow(cache_file, columns=None, start=0, stop=None):
+    """
+    This function memory-maps an Arrow IPC file and converts the requested columns and rows to pandas.
+    Only the pages holding the requested slice are touched, and several processes reading the same file
+    share it through the operating system's page cache instead of each holding a private copy.
+
+    :param cache_file: Path of the Arrow IPC file
+    :param columns: Optional list of columns to read, all columns when None
+    :param start: First row to read
+    :param stop: Row after the last one to read, the end of the file when None
+    :return: Dataframe with the requested slice
+    """
+    pa = _import_pyarrow()
+    with pa.memory_map(cache_file, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(list(columns))
+        if start or stop is not None:
+            table = table.slice(start, (table.num_rows if stop is None else stop) - start)
+        return table.to_pandas()
+
+
+# This function returns the number of rows of an Arrow IPC file without reading its data
+def arrow_num_rows(cache_file):
+    """
+    This function returns the number of rows in an Arrow IPC file, read from the record batch headers.
+
+    :param cache_file: Path of the Arrow IPC file
+    :return: Number of rows
+    """
+    pa = _import_pyarrow()
+    with pa.memory_map(cache_file, 'r') as source:
+        reader = pa.ipc.open_file(source)
+        return sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+
+
+# This function loads a source file through an on-disk Arrow cache
+@instrumented
+def cached_read(path, columns=None, reader=None, cache_dir=None):
+    """
+    This function reads a source file (Excel workbook or CSV) through a columnar cache. On the first load
+    the source is parsed with the given pandas reader and written as an Arrow IPC file. Later loads
+    memory-map that file, read only the requested columns and skip the slow parsing step entirely.
+
+    The cache is invalidated when the source changes (see arrow_cache). Every call returns a new dataframe,
+    so the caller does not need to take a defensive .copy() of the result.
+
+    Requires the optional pyarrow dependency.
+
+    :param path: Path of the source file
+    :param columns: Optional list of columns to load, all columns are loaded when None
+    :param reader: Function parsing the source into a dataframe, chosen from the file extension when None
+    :param cache_dir: Directory holding the cache files, defaults to .nypd_cache next to the source
+    :return: Dataframe with the requested columns
+
+    >>> import shutil, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> source = shutil.copy('dummy_doctest_files/Race_group.csv', tmp)
+    >>> cached_read(source).equals(pd.read_csv(source))
+    True
+    >>> sorted(os.listdir(os.path.join(tmp, CACHE_DIR_NAME)))
+    ['Race_group.csv.arrow', 'Race_group.csv.json']
+    >>> cached_read(source, columns=['SUSPECT_RACE_DESCRIPTION']).shape
+    (9, 1)
+    >>> shutil.rmtree(tmp)
+    """
+    cache_file = arrow_cache(path, reader or _default_reader(path), cache_dir)
+    return read_arrow(cache_file, columns)
+
+
+# This function checks the cache metadata against the source file
+def _cache_is_fresh(path, cache_file, meta_file):
+    if not (os.path.exists(cache_file) and os.path.exists(meta_file)):
+        return False
+    with open(meta_file) as meta_in:
+        meta = json.load(meta_in)
+    if meta.get('version') != CACHE_FORMAT_VERSION:
+        return False
+    current = source_fingerprint(path, with_hash=False)
+    if current['size'] != meta['size']:
+        return False
+    if current['mtime_ns'] == meta['mtime_ns']:
+        return True
+    # Same size but touched since the cache was built - compare the content and remember the new mtime
+    current = source_fingerprint(path)
+    if current['hash'] != meta['hash']:
+        return False
+    with open(meta_file, 'w') as meta_out:
+        json.dump(dict(current, version=CACHE_FORMAT_VERSION), meta_out)
+    return True
+
+
+# This function loads the stop, question and frisk workbook through the Arrow cache
+@instrumented
+def read_sqf(columns=None, path=None, cache_dir=None):
+    """
+    This function loads the stop, question and frisk workbook. The first call parses the Excel file and
+    caches it, later calls start from the memory-mapped cache (see cached_read). The SQF schema is
+    applied to the loaded columns.
+
+    :param columns: Optional list of columns to load, all columns are loaded when None
+    :param path: Path of the sqf-2019.xlsx workbook, data_path(SQF_FILE) when None
+    :param cache_dir: Directory holding the cache files, defaults to .nypd_cache next to the workbook
+    :return: Dataframe with the requested columns
+    """
+    path = data_path(SQF_FILE) if path is None else path
+    return apply_schema(cached_read(path, columns, pd.read_excel, cache_dir), SQF_SCHEMA)
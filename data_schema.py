@@ -0,0 +1,162 @@
+"""
+Canonical column schema for the arrests, complaints and stop, question and frisk datasets.
+
+Demographic columns are stored as categoricals with a fixed, canonical set of categories (the age bands,
+the eight race labels of the population share tables and MALE/FEMALE), and Y/N outcome flags are stored
+as (nullable) booleans. Comparisons, dropna and groupby then work on small integer codes instead of Python
+strings. Labels which are not part of the canonical categories are never dropped: they are appended after
+the canonical ones so that no record silently loses its value.
+
+The schemas are applied at load time by the readers in data_loading.py.
+"""
+import numpy as np
+import pandas as pd
+
+from Functions_and_Doctests import RACE_POPULATION_SHARE, SEX_POPULATION_SHARE
+from instrumentation import instrumented
+
+# Canonical categories, in the order they should appear in tables and charts
+AGE_GROUPS = ['<18', '18-24', '25-44', '45-64', '65+']
+RACE_LABELS = list(RACE_POPULATION_SHARE)
+SEXES = list(SEX_POPULATION_SHARE)
+
+# Marker for Y/N columns which are stored as booleans
+FLAG = 'flag'
+
+AGE_GROUP = {'categories': AGE_GROUPS, 'ordered': True}
+RACE = {'categories': RACE_LABELS}
+# The arrests and complaints extracts abbreviate the sex, the stop, question and frisk data spells it out
+SEX = {'categories': SEXES, 'aliases': {'M': 'MALE', 'F': 'FEMALE'}}
+
+ARRESTS_SCHEMA = {
+    'AGE_GROUP': AGE_GROUP,
+    'PERP_SEX': SEX,
+    'PERP_RACE': RACE,
+}
+
+COMPLAINTS_SCHEMA = {
+    'SUSP_AGE_GROUP': AGE_GROUP,
+    'SUSP_SEX': SEX,
+    'SUSP_RACE': RACE,
+    'VIC_AGE_GROUP': AGE_GROUP,
+    'VIC_SEX': SEX,
+    'VIC_RACE': RACE,
+}
+
+SQF_SCHEMA = {
+    'SUSPECT_SEX': SEX,
+    'SUSPECT_RACE_DESCRIPTION': RACE,
+    'FRISKED_FLAG': FLAG,
+    'SEARCHED_FLAG': FLAG,
+    'SUSPECT_ARRESTED_FLAG': FLAG,
+    'SUMMONS_ISSUED_FLAG': FLAG,
+}
+
+
+# This function converts a column of labels into a categorical with the canonical categories
+def to_categorical(series, categories, aliases=None, ordered=False):
+    """
+    This function converts a column into a categorical whose categories start with the canonical ones.
+    Aliases (e.g. 'M' for 'MALE') are resolved first, and labels outside the canonical categories are
+    appended at the end instead of being turned into missing values. Each distinct label is only looked
+    at once, so the conversion is cheap even on millions of rows.
+
+    :param series: Column of labels (object, string or categorical)
+    :param categories: Canonical categories, in display order
+    :param aliases: Optional dictionary mapping alternative spellings to canonical labels
+    :param ordered: Whether the categorical is ordered
+    :return: Categorical series aligned to the input
+
+    >>> sex = to_categorical(pd.Series(['F', 'MALE', None, 'U']), SEXES, {'F': 'FEMALE'})
+    >>> sex.tolist()
+    ['FEMALE', 'MALE', nan, 'U']
+    >>> sex.cat.categories.tolist()
+    ['MALE', 'FEMALE', 'U']
+    """
+    codes, uniques = pd.factorize(series)
+    labels = [aliases.get(label, label) for label in uniques] if aliases else list(uniques)
+    extras = sorted(set(labels) - set(categories), key=str)
+    dtype = pd.CategoricalDtype(list(categories) + extras, ordered=ordered)
+    # The trailing -1 is picked up by the -1 code that pd.factorize assigns to missing values
+    label_codes = np.append(pd.Categorical(labels, dtype=dtype).codes, -1)
+    return pd.Series(pd.Categorical.from_codes(label_codes[codes], dtype=dtype),
+                     index=series.index, name=series.name)
+
+
+# This function converts a Y/N flag column into a nullable boolean column
+def flag_to_bool(series):
+    """
+    This function converts a 'Y'/'N' flag into a nullable boolean column. Any other value (e.g. '(null)')
+    becomes a missing value. Columns which are already boolean are returned unchanged.
+
+    :param series: Flag column
+    :return: Series with the 'boolean' dtype
+
+    >>> flag_to_bool(pd.Series(['Y', 'N', '(null)', None]))
+    0     True
+    1    False
+    2     <NA>
+    3     <NA>
+    dtype: boolean
+    """
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return series
+    codes, uniques = pd.factorize(series)
+    lookup = np.array([{'Y': 1, 'N': 0}.get(label, -1) for label in uniques] + [-1], dtype='int8')
+    values = lookup[codes]
+    return pd.Series(pd.arrays.BooleanArray(values == 1, values == -1), index=series.index, name=series.name)
+
+
+# This function applies a dataset schema to the columns of a dataframe
+@instrumented
+def apply_schema(df, schema):
+    """
+    This function converts every column of the dataframe that appears in the schema. Columns which are not
+    part of the schema, and schema columns missing from the dataframe, are left alone, so the same schema can
+    be applied to any projection of a dataset.
+
+    :param df: Dataframe to be converted
+    :param schema: Dictionary mapping column names to FLAG or to a category specification
+    :return: A new dataframe with the converted columns
+
+    >>> df = pd.DataFrame({'SUSPECT_SEX': ['MALE', 'FEMALE'], 'FRISKED_FLAG': ['Y', 'N'], 'col1': [1, 2]})
+    >>> apply_schema(df, SQF_SCHEMA).dtypes
+    SUSPECT_SEX     category
+    FRISKED_FLAG     boolean
+    col1               int64
+    dtype: object
+    """
+    converted = {}
+    for col, spec in schema.items():
+        if col not in df.columns:
+            continue
+        if spec == FLAG:
+            converted[col] = flag_to_bool(df[col])
+        else:
+            converted[col] = to_categorical(df[col], spec['categories'], spec.get('aliases'),
+                                            spec.get('ordered', False))
+    return df.assign(**converted) if converted else df
+
+
+# This function converts the group labels of a count table the way apply_schema converts the columns
+@instrumented
+def canonical_counts(counts, schema):
+    """
+    This function applies the schema to the group labels (index levels) of a count series or dataframe, for
+    example counts computed on raw files or merged from partitions whose categories differ. Aliases of the
+    same label are added up, and the groups come back in the canonical order of the categories.
+
+    :param counts: Count series or dataframe indexed by the group labels
+    :param schema: Dictionary mapping column names to FLAG or to a category specification
+    :return: Counts indexed by the converted labels
+
+    >>> canonical_counts(pd.Series([2, 1, 4], index=pd.Index(['M', 'FEMALE', 'MALE'], name='PERP_SEX')),
+    ...                  ARRESTS_SCHEMA)
+    PERP_SEX
+    MALE      6
+    FEMALE    1
+    dtype: int64
+    """
+    keys = apply_schema(counts.index.to_frame(index=False), schema)
+    index = pd.MultiIndex.from_frame(keys) if keys.shape[1] > 1 else pd.Index(keys.iloc[:, 0])
+    return counts.set_axis(index).groupby(level=list(range(index.nlevels)), sort=True, observed=True).sum()
@@ -0,0 +1,316 @@
+"""
+Offline rendering of the arrest/complaint location heatmaps as a pyramid of XYZ PNG tiles.
+
+A folium HeatMap embeds its points in the HTML document and the browser redraws the density on every view,
+so the size of the map and its load time grow with the data. Here the density is rendered once, in Python,
+into 256 x 256 px web mercator tiles laid out as <output_dir>/<zoom>/<x>/<y>.png for a range of zoom levels
+over the NYC bounding box. A map then only references the tile directory (see add_tile_layer): its size and
+load time no longer depend on the number of records.
+
+For every tile the points falling on the tile (plus a margin of the kernel size) are counted per pixel with
+np.bincount and smoothed with a Gaussian kernel, applied as two banded matrix products. The densities are
+coloured with the gradient of the folium heatmaps, relative to the largest density of the zoom level so the
+tiles of one level join up. The tiles are rendered by a pool of worker processes, which only receive the
+pixel coordinates of their own points; tiles without points are not written.
+
+Usage (from the directory holding the 2019 extracts, or with NYPD_DATA_DIR naming it):
+    python heatmap_tiles.py arrests --output-dir tiles/arrests --zooms 10 11 12 13 14 --workers 8
+"""
+import argparse
+import functools
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from heatmap_utils import NYC_BOUNDS
+from instrumentation import instrumented
+
+TILE_SIZE = 256
+DEFAULT_ZOOMS = (10, 11, 12, 13)
+# Colour stops of the density (0 - 1), the default gradient of Leaflet.heat used by folium's HeatMap
+DEFAULT_GRADIENT = {0.4: 'blue', 0.6: 'cyan', 0.7: 'lime', 0.8: 'yellow', 1.0: 'red'}
+# Relative density from which a pixel is fully opaque, lower densities fade out linearly
+OPAQUE_FROM = 0.4
+METADATA_FILE = 'tiles.json'
+
+
+# This function projects coordinates onto the global web mercator pixel grid of a zoom level
+def mercator_pixels(lat, lon, zoom):
+    """
+    This function returns the position of points in pixels of the zoom level, counted from the north-west
+    corner of the world map (tile x = pixel x // 256, tile y = pixel y // 256).
+
+    :param lat: Array-like of latitudes
+    :param lon: Array-like of longitudes
+    :param zoom: Zoom level
+    :return: Tuple (x, y) of float arrays
+
+    >>> x, y = mercator_pixels([40.693943], [-73.985880], 11)
+    >>> (x // TILE_SIZE).astype(int), (y // TILE_SIZE).astype(int)
+    (array([603]), array([770]))
+    """
+    scale = TILE_SIZE * 2 ** zoom
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    x = (np.asarray(lon, dtype='float64') + 180) / 360 * scale
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * scale
+    return x, y
+
+
+# This function lists the tiles covering a bounding box
+def tile_range(bounds, zoom):
+    """
+    :param bounds: (south, north, west, east) edges of the box
+    :param zoom: Zoom level
+    :return: Tuple (x_min, x_max, y_min, y_max) of the tiles covering the box, bounds included
+
+    >>> tile_range(NYC_BOUNDS, 10)
+    (300, 302, 384, 385)
+    """
+    south, north, west, east = bounds
+    x, y = mercator_pixels([north, south], [west, east], zoom)
+    (x_min, x_max), (y_min, y_max) = (x // TILE_SIZE).astype(int), (y // TILE_SIZE).astype(int)
+    return int(x_min), int(x_max), int(y_min), int(y_max)
+
+
+# This function builds the banded matrix applying a 1-D Gaussian kernel to a tile and its margins
+@functools.lru_cache(maxsize=None)
+def _kernel_matrix(radius):
+    margin = 2 * radius
+    offsets = np.arange(TILE_SIZE + 2 * margin)[None, :] - margin - np.arange(TILE_SIZE)[:, None]
+    weights = np.exp(-0.5 * (offsets / (radius / 2)) ** 2) * (np.abs(offsets) <= margin)
+    return weights / weights[TILE_SIZE // 2].sum()
+
+
+# This function computes the smoothed point density of one tile
+def tile_density(x, y, tile_x, tile_y, radius=8):
+    """
+    This function counts the points per pixel of a tile and of a margin of 2 * radius pixels around it,
+    and smooths the counts with a Gaussian kernel of standard deviation radius / 2 pixels. Every point
+    contributes a total of 1 spread over the pixels around it.
+
+    :param x: Array of the pixel x coordinates of the points (see mercator_pixels)
+    :param y: Array of the pixel y coordinates of the points
+    :param tile_x: x of the tile
+    :param tile_y: y of the tile
+    :param radius: Kernel radius in pixels
+    :return: 256 x 256 float array of densities, indexed [row, column] from the north-west corner
+
+    >>> density = tile_density(np.array([100.5, 100.5]), np.array([50.5, 50.5]), 0, 0)
+    >>> density.shape, float(density.sum().round(6)), divmod(int(density.argmax()), TILE_SIZE)
+    ((256, 256), 2.0, (50, 100))
+    """
+    margin = 2 * radius
+    width = TILE_SIZE + 2 * margin
+    col = np.floor(x).astype('int64') - tile_x * TILE_SIZE + margin
+    row = np.floor(y).astype('int64') - tile_y * TILE_SIZE + margin
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < width)
+    counts = np.bincount(row[inside] * width + col[inside], minlength=width * width).reshape(width, width)
+    counts = counts.astype('float64')
+    kernel = _kernel_matrix(radius)
+    return kernel @ counts @ kernel.T
+
+
+# This function turns relative densities into RGBA pixels
+def colorize(density, vmax, gradient=None, max_opacity=0.8):
+    """
+    This function colours densities relative to vmax with the colour stops of gradient. Pixels with a
+    relative density of OPAQUE_FROM or more get max_opacity, lower densities fade out to transparent.
+
+    :param density: Array of densities
+    :param vmax: Density mapped to the last colour stop
+    :param gradient: Dictionary mapping relative densities (0 - 1) to matplotlib colours, DEFAULT_GRADIENT
+                     when None
+    :param max_opacity: Opacity of the densest pixels
+    :return: uint8 array of the shape of density with a last axis of 4 (red, green, blue, alpha)
+
+    >>> colorize(np.array([[0.0, 1.0, 4.0]]), vmax=4.0).tolist()
+    [[[0, 0, 255, 0], [0, 0, 255, 127], [255, 0, 0, 204]]]
+    """
+    from matplotlib.colors import to_rgb
+
+    gradient = DEFAULT_GRADIENT if gradient is None else gradient
+    stops = sorted(gradient)
+    colours = np.array([to_rgb(gradient[stop]) for stop in stops])
+    relative = np.clip(density / vmax, 0, 1) if vmax > 0 else np.zeros_like(density)
+    rgba = np.empty(relative.shape + (4,), dtype='uint8')
+    for channel in range(3):
+        rgba[..., channel] = np.round(np.interp(relative, stops, colours[:, channel]) * 255)
+    rgba[..., 3] = np.clip(relative / OPAQUE_FROM, 0, 1) * max_opacity * 255
+    return rgba
+
+
+# This function renders one tile, it is run by the worker processes. Without a path it only returns the
+# largest density of the tile
+def _render_tile(zoom, tile_x, tile_y, x, y, radius, vmax=None, path=None, gradient=None, max_opacity=0.8):
+    density = tile_density(x, y, tile_x, tile_y, radius)
+    if path is None:
+        return zoom, float(density.max())
+    from matplotlib.image import imsave
+
+    rgba = colorize(density, vmax, gradient, max_opacity)
+    if not rgba[..., 3].any():
+        return zoom, None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    imsave(path, rgba)
+    return zoom, path
+
+
+# This function splits the points of a zoom level into the point sets of the tiles they are drawn on
+def _tile_jobs(x, y, zoom, bounds, radius):
+    margin = 2 * radius
+    x_min, x_max, y_min, y_max = tile_range(bounds, zoom)
+    columns, rows = x_max - x_min + 1, y_max - y_min + 1
+    # The points are grouped by tile with a stable sort of small integer keys, which NumPy radix sorts
+    tile = (x // TILE_SIZE - x_min).astype('int64') * rows + (y // TILE_SIZE - y_min).astype('int64')
+    order = np.argsort(tile.astype(np.min_scalar_type(columns * rows)), kind='stable')
+    x, y = x[order], y[order]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(tile, minlength=columns * rows))])
+
+    jobs = []
+    for column in range(columns):
+        for row in range(rows):
+            # A point is drawn on the tiles whose margin it falls in, which are at most one tile away
+            neighbours = [(column + dx) * rows + row + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                          if 0 <= column + dx < columns and 0 <= row + dy < rows]
+            if all(offsets[key] == offsets[key + 1] for key in neighbours):
+                continue
+            near_x = np.concatenate([x[offsets[key]:offsets[key + 1]] for key in neighbours])
+            near_y = np.concatenate([y[offsets[key]:offsets[key + 1]] for key in neighbours])
+            tile_x, tile_y = x_min + column, y_min + row
+            near = (near_x >= tile_x * TILE_SIZE - margin) & (near_x < (tile_x + 1) * TILE_SIZE + margin) & \
+                (near_y >= tile_y * TILE_SIZE - margin) & (near_y < (tile_y + 1) * TILE_SIZE + margin)
+            if near.any():
+                jobs.append((zoom, tile_x, tile_y, near_x[near], near_y[near], radius))
+    return jobs
+
+
+# This function runs tile jobs in worker processes, or in the calling process for a single worker
+def _run(jobs, workers):
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            return list(pool.map(_render_tile, *zip(*jobs)))
+    return [_render_tile(*job) for job in jobs]
+
+
+# This function renders the heatmap of a set of locations as XYZ PNG tiles
+@instrumented
+def render_tiles(lat, lon, output_dir, zooms=DEFAULT_ZOOMS, radius=8, bounds=NYC_BOUNDS, workers=None,
+                 gradient=None, max_opacity=0.8):
+    """
+    This function renders the density of the points as <output_dir>/<zoom>/<x>/<y>.png tiles for every zoom
+    level and writes a tiles.json file describing them. Points with missing coordinates or outside bounds
+    are ignored. The densities are rendered twice, once to find the largest density of every zoom level and
+    once to colour and write the tiles.
+
+    :param lat: Array-like of latitudes
+    :param lon: Array-like of longitudes
+    :param output_dir: Directory of the tile pyramid
+    :param zooms: Zoom levels to render
+    :param radius: Kernel radius in pixels, the radius of the folium heatmaps by default
+    :param bounds: (south, north, west, east) edges of the rendered area
+    :param workers: Number of worker processes, all the cores when None; 1 renders in the calling process
+    :param gradient: Colour stops, see colorize
+    :param max_opacity: Opacity of the densest pixels
+    :return: Dictionary written to tiles.json: the zoom levels, bounds, radius, number of points, largest
+             density and number of tiles written per zoom level, and the rendering time
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> rng = np.random.default_rng(0)
+    >>> lat, lon = rng.normal(40.75, 0.02, 1000), rng.normal(-73.95, 0.02, 1000)
+    >>> summary = render_tiles(np.append(lat, [np.nan, 0.0]), np.append(lon, [np.nan, 0.0]), tmp, zooms=(10, 11),
+    ...                        workers=1)
+    >>> summary['points'], summary['tiles']
+    (1000, {'10': 2, '11': 3})
+    >>> sorted(os.listdir(os.path.join(tmp, '11')))
+    ['602', '603']
+    >>> from matplotlib.image import imread
+    >>> imread(os.path.join(tmp, '10', '301', '384.png')).shape
+    (256, 256, 4)
+    >>> shutil.rmtree(tmp)
+    """
+    started = time.perf_counter()
+    south, north, west, east = bounds
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    inside = (lat >= south) & (lat < north) & (lon >= west) & (lon < east)
+    lat, lon = lat[inside], lon[inside]
+    workers = workers or os.cpu_count() or 1
+
+    jobs = []
+    for zoom in zooms:
+        x, y = mercator_pixels(lat, lon, zoom)
+        jobs.extend(_tile_jobs(x, y, zoom, bounds, radius))
+
+    vmax = {zoom: 0.0 for zoom in zooms}
+    for zoom, tile_max in _run(jobs, workers):
+        vmax[zoom] = max(vmax[zoom], tile_max)
+    write_jobs = []
+    for job in jobs:
+        zoom, tile_x, tile_y = job[:3]
+        path = os.path.join(output_dir, str(zoom), str(tile_x), '{}.png'.format(tile_y))
+        write_jobs.append(job + (vmax[zoom], path, gradient, max_opacity))
+    written = _run(write_jobs, workers)
+
+    tiles = {str(zoom): 0 for zoom in zooms}
+    for zoom, path in written:
+        tiles[str(zoom)] += path is not None
+    summary = {'zooms': list(zooms), 'bounds': list(bounds), 'radius': radius, 'points': int(len(lat)),
+               'vmax': {str(zoom): value for zoom, value in vmax.items()}, 'tiles': tiles,
+               'seconds': time.perf_counter() - started}
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, METADATA_FILE), 'w') as metadata_out:
+        json.dump(summary, metadata_out, indent=1)
+    return summary
+
+
+# This function adds a rendered tile pyramid to a folium map
+def add_tile_layer(base_map, tile_dir, name='Density', opacity=1.0):
+    """
+    This function adds the tiles written by render_tiles as an overlay of a folium map. The map only holds
+    the URL template of the tiles, which are loaded from tile_dir (relative to the HTML file, or served over
+    HTTP) as the map is panned and zoomed; beyond the deepest rendered level the deepest tiles are scaled
+    up. Requires the optional folium dependency.
+
+    :param base_map: folium Map to which the layer is added
+    :param tile_dir: Directory (or URL) of the tile pyramid holding tiles.json
+    :param name: Name of the layer in the layer control
+    :param opacity: Opacity of the layer
+    :return: The base map
+    """
+    from folium import TileLayer
+
+    with open(os.path.join(tile_dir, METADATA_FILE)) as metadata_in:
+        metadata = json.load(metadata_in)
+    south, north, west, east = metadata['bounds']
+    TileLayer(tiles=tile_dir.rstrip('/') + '/{z}/{x}/{y}.png', attr='NYC Open Data', name=name, overlay=True,
+              opacity=opacity, min_zoom=min(metadata['zooms']), max_native_zoom=max(metadata['zooms']),
+              bounds=[[south, west], [north, east]]).add_to(base_map)
+    return base_map
+
+
+if __name__ == '__main__':
+    from data_loading import ARRESTS_FILE, COMPLAINTS_FILE, data_path, read_arrests, read_complaints
+
+    readers = {'arrests': (read_arrests, ARRESTS_FILE), 'complaints': (read_complaints, COMPLAINTS_FILE)}
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dataset', choices=sorted(readers))
+    parser.add_argument('--data-dir', default=None, help='directory of the extracts, $NYPD_DATA_DIR or the working directory by default')
+    parser.add_argument('--output-dir', default=None, help='tile directory, tiles/<dataset> by default')
+    parser.add_argument('--zooms', type=int, nargs='+', default=list(DEFAULT_ZOOMS))
+    parser.add_argument('--radius', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, all the cores by default')
+    arguments = parser.parse_args()
+
+    reader, file_name = readers[arguments.dataset]
+    locations = reader(['Latitude', 'Longitude'], data_path(file_name, arguments.data_dir))
+    output_dir = arguments.output_dir or os.path.join('tiles', arguments.dataset)
+    summary = render_tiles(locations['Latitude'], locations['Longitude'], output_dir, arguments.zooms,
+                           arguments.radius, workers=arguments.workers)
+    print('{points:,} points, {seconds:.2f} s'.format(**summary))
+    for zoom, count in summary['tiles'].items():
+        print('zoom {:>2}: {:>5} tiles'.format(zoom, count))
@@ -0,0 +1,303 @@
+"""
+Helpers which prepare arrest/complaint locations for the folium heatmaps in PR_FutureScope_FinalProject.py.
+
+Pushing every raw Latitude/Longitude pair into a HeatMap embeds each record in the generated HTML, which
+becomes huge for a full year of data. Here the points are first binned into a fixed grid over the NYC
+bounding box with NumPy, and every non-empty cell is emitted once as a weighted [lat, lon, weight] triple.
+The payload then depends on the grid resolution and not on the number of records.
+
+For HeatMapWithTime, time_frames splits the points into per-frame lists (day of year, hour, ...) with a
+single sort on the time key instead of re-filtering the whole frame once per frame.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+# South, north, west and east edges of the box containing the five boroughs
+NYC_BOUNDS = (40.49, 40.92, -74.27, -73.68)
+NYC_CENTER = [40.693943, -73.985880]
+
+# Metres per pixel at zoom level 0 on the equator for 256 px web mercator tiles
+_METRES_PER_PIXEL_ZOOM_0 = 156543.03392
+_METRES_PER_DEGREE_LATITUDE = 111320.0
+
+# Time keys supported by time_frames, with the function extracting the key from a datetime series and
+# the range of frames produced for it
+TIME_KEYS = {
+    'dayofyear': (lambda times: times.dt.dayofyear, range(1, 367)),
+    'hour': (lambda times: times.dt.hour, range(0, 24)),
+    'weekday': (lambda times: times.dt.weekday, range(0, 7)),
+    'week': (lambda times: times.dt.isocalendar().week, range(1, 54)),
+    'month': (lambda times: times.dt.month, range(1, 13)),
+}
+
+
+# This function converts a map zoom level into a grid cell size matching the heatmap radius
+def cell_size_for_zoom(zoom, radius=8, latitude=NYC_CENTER[0]):
+    """
+    This function returns the grid cell size (in degrees) which covers about one heatmap radius at the
+    given zoom level. Binning finer than that is invisible on the map, binning coarser looks blocky.
+
+    :param zoom: Leaflet zoom level
+    :param radius: Heatmap radius in pixels
+    :param latitude: Latitude at which the pixel size is computed
+    :return: Cell size in degrees
+
+    >>> round(cell_size_for_zoom(11), 5)
+    0.00416
+    >>> round(cell_size_for_zoom(12) / cell_size_for_zoom(11), 2)
+    0.5
+    """
+    metres_per_pixel = _METRES_PER_PIXEL_ZOOM_0 * math.cos(math.radians(latitude)) / 2 ** zoom
+    return radius * metres_per_pixel / _METRES_PER_DEGREE_LATITUDE
+
+
+# This function assigns coordinates to the cells of a regular grid
+def grid_cells(lat, lon, cell_size, bounds=NYC_BOUNDS):
+    """
+    This function returns the number (row * number of columns + column) of the grid cell holding every
+    point, so that the points can be counted per cell with np.bincount or the cell numbers stored instead
+    of the coordinates. Points with missing coordinates or outside bounds get -1.
+
+    :param lat: Array-like of latitudes
+    :param lon: Array-like of longitudes
+    :param cell_size: Cell size in degrees
+    :param bounds: (south, north, west, east) edges of the grid
+    :return: Tuple (cells, rows, cols) with the int64 array of cell numbers and the number of rows and columns
+
+    >>> grid_cells([40.70, 40.803, 0.0], [-73.90, -73.95, 0.0], cell_size=0.01)
+    (array([1275, 1860,   -1]), 43, 59)
+    """
+    south, north, west, east = bounds
+    lat = np.asarray(lat, dtype='float64')
+    lon = np.asarray(lon, dtype='float64')
+    rows = int(math.ceil((north - south) / cell_size))
+    cols = int(math.ceil((east - west) / cell_size))
+
+    inside = (lat >= south) & (lat < north) & (lon >= west) & (lon < east)
+    row = np.minimum(((lat[inside] - south) / cell_size).astype('int64'), rows - 1)
+    col = np.minimum(((lon[inside] - west) / cell_size).astype('int64'), cols - 1)
+    cells = np.full(len(lat), -1, dtype='int64')
+    cells[inside] = row * cols + col
+    return cells, rows, cols
+
+
+# This function returns the coordinates of the centres of grid cells
+def cell_centres(cells, cell_size, bounds=NYC_BOUNDS):
+    """
+    :param cells: Array-like of cell numbers (see grid_cells)
+    :param cell_size: Cell size in degrees
+    :param bounds: (south, north, west, east) edges of the grid
+    :return: Tuple (cell_lat, cell_lon) of NumPy arrays
+
+    >>> cell_centres([1275, 1860], cell_size=0.01)
+    (array([40.705, 40.805]), array([-73.905, -73.955]))
+    """
+    south, _, west, east = bounds
+    cells = np.asarray(cells, dtype='int64')
+    cols = int(math.ceil((east - west) / cell_size))
+    return south + (cells // cols + 0.5) * cell_size, west + (cells % cols + 0.5) * cell_size
+
+
+# This function bins coordinates into grid cells and counts the points (or sums the weights) per cell
+@instrumented
+def grid_counts(lat, lon, cell_size, bounds=NYC_BOUNDS, weights=None):
+    """
+    This function assigns every point to a cell of a regular grid over bounds (see grid_cells) and adds up
+    the points per cell in a single np.bincount pass. Points with missing coordinates or outside bounds
+    (the extracts contain a few records located at 0, 0) are ignored.
+
+    :param lat: Array-like of latitudes
+    :param lon: Array-like of longitudes
+    :param cell_size: Cell size in degrees
+    :param bounds: (south, north, west, east) edges of the grid
+    :param weights: Optional array-like of weights, every point counts as 1 when None
+    :return: Tuple (cell_lat, cell_lon, weight) of NumPy arrays with the centres of the non-empty cells
+
+    >>> grid_counts([40.70, 40.7001, 40.803, 0.0], [-73.90, -73.9001, -73.95, 0.0], cell_size=0.01)
+    (array([40.705, 40.805]), array([-73.905, -73.955]), array([2., 1.]))
+    """
+    cells, rows, cols = grid_cells(lat, lon, cell_size, bounds)
+    inside = cells >= 0
+    if weights is not None:
+        weights = np.asarray(weights, dtype='float64')[inside]
+    totals = np.bincount(cells[inside], weights=weights, minlength=rows * cols).astype('float64')
+
+    cells = np.flatnonzero(totals)
+    cell_lat, cell_lon = cell_centres(cells, cell_size, bounds)
+    return cell_lat, cell_lon, totals[cells]
+
+
+# This function prepares weighted heatmap data with a bounded number of points
+@instrumented
+def grid_heatmap_data(lat, lon, cell_size=0.0025, bounds=NYC_BOUNDS, max_points=20000, normalize=True,
+                      weights=None):
+    """
+    This function bins the points into grid cells and returns [lat, lon, weight] triples which can be
+    passed straight to folium's HeatMap. If there are more non-empty cells than max_points the cell size
+    is doubled until the payload fits, so the size of the generated map is capped whatever the number of
+    records. With normalize the weights are scaled to the 0 - 1 range expected by Leaflet.heat.
+
+    :param lat: Array-like of latitudes
+    :param lon: Array-like of longitudes
+    :param cell_size: Starting cell size in degrees
+    :param bounds: (south, north, west, east) edges of the grid
+    :param max_points: Maximum number of triples returned
+    :param normalize: Whether the weights are divided by the largest weight
+    :param weights: Optional array-like of weights (e.g. the counts of points already binned), every point
+                    counts as 1 when None
+    :return: List of [lat, lon, weight] lists
+
+    >>> grid_heatmap_data([40.70, 40.7001, 40.803], [-73.90, -73.9001, -73.95], cell_size=0.01)
+    [[40.705, -73.905, 1.0], [40.805, -73.955, 0.5]]
+    >>> len(grid_heatmap_data(np.random.default_rng(0).uniform(40.5, 40.9, 100000),
+    ...                       np.random.default_rng(1).uniform(-74.2, -73.7, 100000), max_points=500)) <= 500
+    True
+    >>> grid_heatmap_data([40.70], [-73.90], max_points=0)
+    Traceback (most recent call last):
+    ...
+    ValueError: max_points must be at least 1, got 0
+    """
+    if max_points < 1:
+        raise ValueError('max_points must be at least 1, got {}'.format(max_points))
+    cell_lat, cell_lon, weight = grid_counts(lat, lon, cell_size, bounds, weights)
+    while len(weight) > max_points:
+        cell_size *= 2
+        cell_lat, cell_lon, weight = grid_counts(lat, lon, cell_size, bounds, weights)
+    if normalize and len(weight):
+        weight = weight / weight.max()
+    return np.column_stack([cell_lat.round(5), cell_lon.round(5), weight.round(4)]).tolist()
+
+
+# This function prepares one heatmap payload per zoom level
+@instrumented
+def multi_resolution_heatmap_data(lat, lon, zooms=(10, 11, 12, 13), radius=8, bounds=NYC_BOUNDS,
+                                  max_points=20000):
+    """
+    This function bins the same points once per zoom level, with the cell size matched to the heatmap
+    radius at that zoom (see cell_size_for_zoom). Zoomed-out levels get coarse, light payloads and
+    zoomed-in levels get finer detail, each capped at max_points.
+
+    :param lat: Array-like of latitudes
+    :param lon: Array-like of longitudes
+    :param zooms: Zoom levels for which data is prepared
+    :param radius: Heatmap radius in pixels
+    :param bounds: (south, north, west, east) edges of the grid
+    :param max_points: Maximum number of triples per level
+    :return: Dictionary mapping each zoom level to its list of [lat, lon, weight] lists
+
+    >>> levels = multi_resolution_heatmap_data([40.70, 40.7001, 40.803], [-73.90, -73.9001, -73.95])
+    >>> sorted(levels), [len(points) for points in levels.values()]
+    ([10, 11, 12, 13], [2, 2, 2, 2])
+    """
+    return {zoom: grid_heatmap_data(lat, lon, cell_size_for_zoom(zoom, radius), bounds, max_points)
+            for zoom in zooms}
+
+
+# This function adds one heatmap layer per resolution level to a folium map
+def add_multi_resolution_heatmap(base_map, levels, radius=8, default_zoom=None):
+    """
+    This function adds every level produced by multi_resolution_heatmap_data as its own HeatMap layer
+    and a layer control to switch between them. Only the layer matching default_zoom (or the first level)
+    is shown when the map opens. Requires the optional folium dependency.
+
+    :param base_map: folium Map to which the layers are added
+    :param levels: Dictionary mapping zoom levels to [lat, lon, weight] lists
+    :param radius: Heatmap radius in pixels
+    :param default_zoom: Zoom level of the layer shown initially
+    :return: The base map
+    """
+    from folium import LayerControl
+    from folium.plugins import HeatMap
+
+    if default_zoom not in levels:
+        default_zoom = next(iter(levels))
+    for zoom, points in levels.items():
+        HeatMap(data=points, radius=radius, max_zoom=zoom, name='Zoom {}'.format(zoom),
+                show=(zoom == default_zoom)).add_to(base_map)
+    LayerControl().add_to(base_map)
+    return base_map
+
+
+# This function extracts an integer time key (day of year, hour, ...) from a date or time column
+def _time_key(series, key, time_format):
+    extract, _ = TIME_KEYS[key]
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Parse each distinct value once, e.g. the 1,440 distinct HH:MM:SS values of CMPLNT_FR_TM
+        category_keys = _time_key(pd.Series(series.cat.categories), key, time_format)
+        return np.append(category_keys, np.nan)[series.cat.codes.to_numpy()]
+    if not pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = pd.to_datetime(series, format=time_format, errors='coerce')
+    return extract(series).to_numpy(dtype='float64', na_value=np.nan)
+
+
+# This function builds the per-frame location lists used by HeatMapWithTime
+@instrumented
+def time_frames(df, time_col, key='dayofyear', lat_col='Latitude', lon_col='Longitude', frames=None,
+                time_format=None, cell_size=None, bounds=NYC_BOUNDS, as_arrays=False):
+    """
+    This function splits the locations into one frame per value of a time key (day of year, hour of the
+    day, weekday, ISO week or month). The key is computed for every record at once, the records are sorted
+    by it a single time and the frames are cut out of the sorted arrays, so the cost does not grow with
+    the number of frames. Frames without records are kept as empty lists so the slider stays aligned.
+
+    With a cell_size the points of every frame are binned into grid cells (see grid_counts) and returned
+    as [lat, lon, weight] triples with the weights scaled to the 0 - 1 range within each frame.
+
+    :param df: Dataframe holding the time and coordinate columns
+    :param time_col: Datetime column, or column of date/time strings parsed with time_format
+    :param key: 'dayofyear', 'hour', 'weekday', 'week' or 'month'
+    :param lat_col: Latitude column
+    :param lon_col: Longitude column
+    :param frames: Key values to produce frames for, defaults to the full range of the key (day 366 is only
+                   included when the data has it)
+    :param time_format: strftime format used when time_col has to be parsed, e.g. '%H:%M:%S'
+    :param cell_size: Optional cell size in degrees for binning the points of every frame
+    :param bounds: (south, north, west, east) edges of the grid when binning
+    :param as_arrays: Return NumPy arrays instead of lists of lists
+    :return: Tuple (index, data) with the frame key values and the per-frame point lists
+
+    >>> df = pd.DataFrame({'CMPLNT_FR_TM': ['01:15:00', '23:40:00', '01:55:00'],
+    ...                    'Latitude': [40.70, 40.80, 40.75], 'Longitude': [-73.90, -73.95, -73.92]})
+    >>> index, data = time_frames(df, 'CMPLNT_FR_TM', 'hour', time_format='%H:%M:%S')
+    >>> len(index), data[1], data[2], data[23]
+    (24, [[40.7, -73.9], [40.75, -73.92]], [], [[40.8, -73.95]])
+
+    >>> df = pd.DataFrame({'ARREST_DATE': pd.to_datetime(['2019-01-01', '2019-12-31', '2019-12-31']),
+    ...                    'Latitude': [40.703, 40.803, 40.8031], 'Longitude': [-73.90, -73.95, -73.9501]})
+    >>> index, data = time_frames(df, 'ARREST_DATE', cell_size=0.01)
+    >>> index[-1], data[0], data[364]
+    (365, [[40.705, -73.905, 1.0]], [[40.805, -73.955, 1.0]])
+    """
+    _, default_frames = TIME_KEYS[key]
+    keys = _time_key(df[time_col], key, time_format)
+    lat = df[lat_col].to_numpy(dtype='float64', na_value=np.nan)
+    lon = df[lon_col].to_numpy(dtype='float64', na_value=np.nan)
+
+    valid = ~(np.isnan(keys) | np.isnan(lat) | np.isnan(lon))
+    keys, lat, lon = keys[valid].astype('int64'), lat[valid], lon[valid]
+    order = np.argsort(keys, kind='stable')
+    keys, lat, lon = keys[order], lat[order], lon[order]
+
+    if frames is None:
+        frames = default_frames
+        if key == 'dayofyear' and not (len(keys) and keys[-1] == 366):
+            frames = range(1, 366)
+    index = list(frames)
+    starts = np.searchsorted(keys, index, side='left')
+    ends = np.searchsorted(keys, index, side='right')
+
+    data = []
+    for start, end in zip(starts, ends):
+        if cell_size is None:
+            points = np.column_stack([lat[start:end], lon[start:end]]).round(5)
+        else:
+            cell_lat, cell_lon, weight = grid_counts(lat[start:end], lon[start:end], cell_size, bounds)
+            if len(weight):
+                weight = weight / weight.max()
+            points = np.column_stack([cell_lat.round(5), cell_lon.round(5), weight.round(4)])
+        data.append(points if as_arrays else points.tolist())
+    return index, data
@@ -0,0 +1,413 @@
+"""
+Declarative, lazily evaluated pipelines for the hypotheses of PR_All_Hypotheses_Final.ipynb.
+
+A hypothesis is described as a DAG of named stages (load -> select_columns -> *_pct_col ->
+grouping_for_count -> normalized_values -> proportional_values ...). Nothing runs until a stage is asked
+for, and then only the stages it depends on are evaluated. Every stage result is memoized under a key
+derived from the stage function, its parameters and the keys of its inputs (source files contribute their
+size and modification time), so changing one parameter only re-executes the stages downstream of it.
+
+Results are kept in a size-bounded in-memory LRU cache and, optionally, in a size-bounded on-disk cache
+which survives kernel restarts. Results handed out by the pipeline are shared with the cache and must be
+treated as read-only; normalized_values and proportional_values are run with inplace=False (which only
+allocates their new column), and stages whose function can only modify its input in place are declared
+with copy_inputs=True.
+"""
+import copy
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import sys
+import sysconfig
+from collections import OrderedDict
+
+import pandas as pd
+
+from data_loading import (ARRESTS_FILE, COMPLAINTS_FILE, SQF_FILE, data_path, read_arrests, read_complaints,
+                          read_sqf)
+from Functions_and_Doctests import (AGE_POPULATION_SHARE, RACE_POPULATION_SHARE, SEX_POPULATION_SHARE,
+                                    age_pct_col, flag_probabilities, grouping_for_count, normalized_values,
+                                    proportional_values, select_columns)
+from report_lag import report_lag_histograms
+
+# Population share table of every demographic column analysed in the hypotheses
+SHARES_BY_COLUMN = {
+    'AGE_GROUP': AGE_POPULATION_SHARE,
+    'SUSPECT_SEX': SEX_POPULATION_SHARE,
+    'SUSPECT_RACE_DESCRIPTION': RACE_POPULATION_SHARE,
+}
+
+# Marker for a cache miss (None is a valid stage result)
+_MISSING = object()
+
+# Code in these directories (the standard library and installed packages) is not hashed into stage keys
+_LIBRARY_DIRS = tuple(sorted({os.path.abspath(sysconfig.get_paths()[name])
+                              for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')}))
+
+
+# This function estimates how much memory a stage result takes
+def result_size(value):
+    """
+    This function returns the approximate size in bytes of a stage result. It is used to bound the size
+    of the in-memory cache.
+
+    :param value: Stage result (dataframe, series, dictionary/list of those or any other object)
+    :return: Size in bytes
+
+    >>> result_size(pd.Series([1, 2, 3], dtype='int64')) >= 24
+    True
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum()) if isinstance(value, pd.DataFrame) \
+            else int(value.memory_usage(deep=True))
+    if isinstance(value, dict):
+        return sum(result_size(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(result_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+# This function hashes a code object, its nested code objects (lambdas, inner functions) and the code of the
+# functions of the project it calls by name, so that a change to a helper also changes the digest
+def _hash_code(code, namespace, hasher, seen):
+    hasher.update(code.co_code)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _hash_code(const, namespace, hasher, seen)
+        elif isinstance(const, frozenset):
+            # The order of a set literal depends on the string hash seed of the process
+            hasher.update(repr(sorted(map(repr, const))).encode())
+        else:
+            hasher.update(repr(const).encode())
+    for name in code.co_names:
+        helper = namespace.get(name)
+        if not (callable(helper) and hasattr(helper, '__code__')):
+            continue
+        helper = inspect.unwrap(helper)
+        if helper in seen or os.path.abspath(helper.__code__.co_filename).startswith(_LIBRARY_DIRS):
+            continue
+        seen.add(helper)
+        hasher.update('{}.{}'.format(helper.__module__, helper.__qualname__).encode())
+        _hash_code(helper.__code__, helper.__globals__, hasher, seen)
+
+
+# This function turns stage parameters into a stable, hashable description
+def fingerprint(value):
+    """
+    This function describes a stage parameter in a way that changes whenever the parameter changes.
+    Dataframes and series are hashed by their column names, dtypes and content row by row in order, paths
+    of existing files are described by their size and modification time (so an updated source file
+    invalidates the stages reading it), functions by their qualified name and the byte code of the function
+    and of the project functions it calls by name, and containers recursively.
+
+    :param value: Stage parameter
+    :return: JSON-serializable description
+
+    >>> fingerprint({'cols': ['AGE_GROUP'], 'decimals': 2})
+    {'cols': ['AGE_GROUP'], 'decimals': '2'}
+
+    Renaming a column, reordering the rows or changing a dtype changes the fingerprint of a dataframe:
+
+    >>> df = pd.DataFrame({'SEX': ['F', 'M', 'M']})
+    >>> len({fingerprint(frame) for frame in [df, df.rename(columns={'SEX': 'OTHER'}), df.iloc[::-1],
+    ...                                       df.astype('category')]})
+    4
+
+    So does a change to a helper the function calls:
+
+    >>> namespace = {}
+    >>> exec('def helper(x):\\n    return x + 1\\ndef stage(x):\\n    return helper(x)', namespace)
+    >>> before = fingerprint(namespace['stage'])
+    >>> exec('def helper(x):\\n    return x + 2', namespace)
+    >>> fingerprint(namespace['stage']) == before
+    False
+    """
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        frame = value.to_frame() if isinstance(value, pd.Series) else value
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(repr([(str(name), str(dtype)) for name, dtype in frame.dtypes.items()]).encode())
+        hasher.update(repr([list(map(str, frame.index.names)), str(frame.index.dtype)]).encode())
+        hasher.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        return 'frame:' + hasher.hexdigest()
+    if isinstance(value, str):
+        if os.path.isfile(value):
+            stat = os.stat(value)
+            return 'file:{}:{}:{}'.format(os.path.abspath(value), stat.st_size, stat.st_mtime_ns)
+        return value
+    if isinstance(value, dict):
+        return {str(key): fingerprint(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [fingerprint(item) for item in value]
+    if callable(value) and hasattr(value, '__code__'):
+        # Decorated functions (e.g. @instrumented) are described by the code of the function they wrap
+        value = inspect.unwrap(value)
+        hasher = hashlib.sha256()
+        _hash_code(value.__code__, getattr(value, '__globals__', {}), hasher, {value})
+        digest = hasher.hexdigest()[:16]
+        return 'function:{}.{}:{}'.format(value.__module__, value.__qualname__, digest)
+    return repr(value)
+
+
+# This class memoizes stage results in memory and optionally on disk, evicting the least recently used
+class StageCache:
+    """
+    Size-bounded LRU cache of stage results. The in-memory part is bounded by a number of entries and a
+    number of bytes; the on-disk part (pickles in disk_dir) by a number of bytes, with the least recently
+    read or written files removed first.
+
+    >>> cache = StageCache(max_items=2)
+    >>> for key in ['a', 'b', 'c']:
+    ...     cache.put(key, key.upper())
+    >>> list(cache.memory), cache.get('a') is _MISSING
+    (['b', 'c'], True)
+    """
+
+    def __init__(self, max_items=32, max_bytes=2 * 1024 ** 3, disk_dir=None, max_disk_bytes=10 * 1024 ** 3):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.sizes = {}
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.disk_dir is not None:
+            path = self._path(key)
+            if os.path.exists(path):
+                with open(path, 'rb') as source:
+                    value = pickle.load(source)
+                os.utime(path)
+                self._remember(key, value)
+                return value
+        return _MISSING
+
+    def put(self, key, value):
+        self._remember(key, value)
+        if self.disk_dir is not None:
+            path = self._path(key)
+            with open(path + '.tmp', 'wb') as out:
+                pickle.dump(value, out, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+            self._evict_disk()
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + '.pkl')
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.sizes[key] = result_size(value)
+        self.memory.move_to_end(key)
+        # The newest entry is always kept, even when it alone is larger than max_bytes
+        while len(self.memory) > 1 and (len(self.memory) > self.max_items
+                                        or sum(self.sizes.values()) > self.max_bytes):
+            oldest, _ = self.memory.popitem(last=False)
+            del self.sizes[oldest]
+
+    def _evict_disk(self):
+        files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith('.pkl')]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        while len(files) > 1 and total > self.max_disk_bytes:
+            oldest = files.pop(0)
+            total -= os.path.getsize(oldest)
+            os.remove(oldest)
+
+
+# This class holds the stages of one hypothesis and evaluates them lazily
+class Pipeline:
+    """
+    DAG of named stages. A stage calls function(*input_results, *args, **kwargs), where the input results
+    are the results of the stages named in inputs. Stages are evaluated on demand by run, and each result
+    is cached under a key combining the stage definition and the keys of its inputs.
+
+    >>> def count_rows(df, col):
+    ...     return df[col].value_counts().sort_index()
+    >>> pipeline = Pipeline()
+    >>> _ = pipeline.add_source('records', pd.DataFrame({'SEX': ['MALE', 'FEMALE', 'MALE']}))
+    >>> _ = pipeline.add('counts', count_rows, ['records'], args=('SEX',))
+    >>> pipeline.run('counts').tolist(), pipeline.executed
+    ([1, 2], ['records', 'counts'])
+    >>> pipeline.run('counts').tolist(), pipeline.executed
+    ([1, 2], [])
+    >>> _ = pipeline.add_source('records', pd.DataFrame({'SEX': ['MALE']}))
+    >>> pipeline.run('counts').tolist(), pipeline.executed
+    ([1], ['records', 'counts'])
+    """
+
+    def __init__(self, cache=None):
+        self.stages = {}
+        self.cache = cache if cache is not None else StageCache()
+        self.executed = []
+
+    def add(self, name, function, inputs=(), args=(), kwargs=None, copy_inputs=False):
+        """
+        This method adds (or replaces) a stage.
+
+        :param name: Name of the stage
+        :param function: Function computing the stage result
+        :param inputs: Names of the stages whose results are passed as the first positional arguments
+        :param args: Further positional arguments
+        :param kwargs: Keyword arguments
+        :param copy_inputs: Pass copies of the input results, for functions that modify their input in place
+        :return: The pipeline, so that calls can be chained
+        """
+        missing = [stage for stage in inputs if stage not in self.stages]
+        if missing:
+            raise KeyError('Unknown input stage(s) for {!r}: {}'.format(name, missing))
+        self.stages[name] = {'function': function, 'inputs': tuple(inputs), 'args': tuple(args),
+                             'kwargs': dict(kwargs or {}), 'copy_inputs': copy_inputs}
+        return self
+
+    def add_source(self, name, value):
+        """
+        This method adds a stage which simply returns an already loaded value (e.g. a dataframe).
+
+        :param name: Name of the stage
+        :param value: Value returned by the stage
+        :return: The pipeline
+        """
+        return self.add(name, _identity, args=(value,))
+
+    def set_params(self, name, args=None, **kwargs):
+        """
+        This method changes the parameters of a stage. Stages downstream of it get new keys and are
+        re-executed on the next run, all other cached results stay valid.
+
+        :param name: Name of the stage
+        :param args: New positional arguments, kept unchanged when None
+        :param kwargs: Keyword arguments to be updated
+        :return: The pipeline
+        """
+        stage = self.stages[name]
+        if args is not None:
+            stage['args'] = tuple(args)
+        stage['kwargs'].update(kwargs)
+        return self
+
+    def key(self, name, keys=None):
+        """
+        This method returns the cache key of a stage.
+
+        :param name: Name of the stage
+        :param keys: Optional dictionary of already computed keys, filled in by this method
+        :return: Hexadecimal key
+        """
+        keys = {} if keys is None else keys
+        if name not in keys:
+            stage = self.stages[name]
+            description = [name, fingerprint(stage['function']), fingerprint(stage['args']),
+                           fingerprint(stage['kwargs']), [self.key(upstream, keys) for upstream in stage['inputs']]]
+            keys[name] = hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+        return keys[name]
+
+    def run(self, name):
+        """
+        This method returns the result of a stage, evaluating (only) the stages that are not cached yet.
+        The names of the stages executed by the call are available in the executed attribute.
+
+        :param name: Name of the stage
+        :return: Stage result, to be treated as read-only
+        """
+        self.executed = []
+        return self._run(name, {})
+
+    def _run(self, name, keys):
+        key = self.key(name, keys)
+        value = self.cache.get(key)
+        if value is not _MISSING:
+            return value
+        stage = self.stages[name]
+        inputs = [self._run(upstream, keys) for upstream in stage['inputs']]
+        if stage['copy_inputs']:
+            inputs = [value.copy() if hasattr(value, 'copy') else copy.deepcopy(value) for value in inputs]
+        value = stage['function'](*inputs, *stage['args'], **stage['kwargs'])
+        self.cache.put(key, value)
+        self.executed.append(name)
+        return value
+
+
+# This function is the stage function of add_source
+def _identity(value):
+    return value
+
+
+# This function builds the pipeline of Hypothesis 1 (age group of the arrested individuals)
+def age_hypothesis(path=None, cache=None):
+    """
+    This function returns the Hypothesis 1 pipeline, built from the same steps as the notebook. Its
+    final stage, 'proportional', holds the grouped dataframe with COUNT, NORM_VALUES and PROP_VALUES.
+
+    :param path: Path of the arrests CSV file, data_path(ARRESTS_FILE) when None
+    :param cache: Optional StageCache shared with other pipelines
+    :return: Pipeline
+
+    >>> pipeline = age_hypothesis('dummy_doctest_files/Arrests_sample.csv')
+    >>> pipeline.run('proportional')[['AGE_GROUP', 'COUNT', 'PROP_VALUES']]
+      AGE_GROUP  COUNT  PROP_VALUES
+    0       <18      1        12.12
+    1     18-24      1        45.45
+    2     25-44      3        33.33
+    3     45-64      1         9.09
+    >>> pipeline.executed
+    ['arrests', 'age_df', 'age_pct', 'grouped', 'normalized', 'proportional']
+    """
+    path = data_path(ARRESTS_FILE) if path is None else path
+    pipeline = Pipeline(cache)
+    pipeline.add('arrests', read_arrests, kwargs={'usecols': ['AGE_GROUP'], 'path': path})
+    pipeline.add('age_df', select_columns, ['arrests'], args=('AGE_GROUP',))
+    pipeline.add('age_pct', age_pct_col, ['age_df'])
+    pipeline.add('grouped', grouping_for_count, ['age_pct'], args=('AGE_GROUP', 'POP_BY_AGE_PCT', 'AGE_GROUP'))
+    pipeline.add('normalized', normalized_values, ['grouped'], args=('COUNT', 'POP_BY_AGE_PCT'),
+                 kwargs={'inplace': False})
+    pipeline.add('proportional', proportional_values, ['normalized'], kwargs={'inplace': False})
+    return pipeline
+
+
+# This function builds the pipeline of Hypotheses 2 and 3 (probability of being frisked/arrested)
+def flag_hypothesis(group_col, flag_cols=('FRISKED_FLAG', 'SUSPECT_ARRESTED_FLAG'), path=None, cache=None):
+    """
+    This function returns the pipeline of Hypothesis 2 (group_col='SUSPECT_SEX') or Hypothesis 3
+    (group_col='SUSPECT_RACE_DESCRIPTION'). The 'probabilities' stage holds the flag_probabilities table
+    with the PROB_FRISKED and PROB_SUSPECT_ARRESTED columns.
+
+    :param group_col: Demographic column of the stop, question and frisk data
+    :param flag_cols: Outcome flags whose probabilities are computed
+    :param path: Path of the sqf-2019.xlsx workbook, data_path(SQF_FILE) when None
+    :param cache: Optional StageCache shared with other pipelines
+    :return: Pipeline
+    """
+    path = data_path(SQF_FILE) if path is None else path
+    pipeline = Pipeline(cache)
+    pipeline.add('sqf', read_sqf, kwargs={'columns': [group_col, *flag_cols], 'path': path})
+    pipeline.add('probabilities', flag_probabilities, ['sqf'], args=(group_col, list(flag_cols)),
+                 kwargs={'shares': {group_col: SHARES_BY_COLUMN[group_col]}})
+    return pipeline
+
+
+# This function builds the pipeline of Hypothesis 4 (report lag of complaints)
+def report_lag_hypothesis(path=None, cache=None):
+    """
+    This function returns the Hypothesis 4 pipeline. The 'histograms' stage holds the DIFF_DAYS,
+    DIFF_WEEKS and DIFF_MONTHS histograms of report_lag_histograms.
+
+    :param path: Path of the complaints CSV file, data_path(COMPLAINTS_FILE) when None
+    :param cache: Optional StageCache shared with other pipelines
+    :return: Pipeline
+
+    >>> report_lag_hypothesis('dummy_doctest_files/Complaints_sample.csv').run('histograms')['DIFF_MONTHS']
+    0    4
+    1    2
+    dtype: int64
+    """
+    path = data_path(COMPLAINTS_FILE) if path is None else path
+    pipeline = Pipeline(cache)
+    pipeline.add('complaints', read_complaints, kwargs={'usecols': ['CMPLNT_FR_DT', 'RPT_DT'], 'path': path})
+    pipeline.add('histograms', report_lag_histograms, ['complaints'])
+    return pipeline
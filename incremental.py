@@ -0,0 +1,405 @@
+"""
+Incremental refresh of the count tables of the year-to-date extracts.
+
+The arrests extract is republished every quarter with the new records of the year added. Instead of reading
+the whole file again and recounting every hypothesis, IncrementalCounts keeps running count tables in a
+directory and only counts the records added since the last update:
+- an aggregate cube (see aggregate_cube.py) of the dimensions of the dataset, from which the outputs of
+  grouping_for_count, normalized_values and proportional_values of every dimension are derived;
+- the number of records per heatmap frame (day of the year for the arrests, hour for the complaints) and
+  grid cell, from which the HeatMap and HeatMapWithTime payloads are derived.
+
+The new records are found in one of two ways. When the file still starts with the bytes counted last time
+(same header line, same bytes just before the end of the counted part), the records were appended and only
+the bytes past the counted part are parsed. Otherwise the file was rewritten, every record is parsed again
+but only the records whose key (ARREST_KEY, CMPLNT_NUM) is above the largest key counted so far (the
+watermark) are counted, which relies on the keys being assigned in increasing order. Either way the
+tables are updated by adding the counts of the new records, which takes time in proportion to the new
+records and the number of cells, not to the full history. Records revised or removed by a republication
+are not seen by either way; update with rebuild=True to recount the whole file.
+
+Usage:
+    python incremental.py .nypd_counts/arrests --path data/NYPD_Arrests_Data_2019.csv --render
+    python incremental.py .nypd_counts/complaints --dataset complaints --rebuild
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from aggregate_cube import ARRESTS_DIMENSIONS, COMPLAINTS_DIMENSIONS, build_cube, merge_cubes
+from data_loading import (ARRESTS_DATES, ARRESTS_DTYPES, ARRESTS_FILE, COMPLAINTS_DATES, COMPLAINTS_DTYPES,
+                          COMPLAINTS_FILE, DEFAULT_CHUNKSIZE, _import_pyarrow, data_path,
+                          read_arrow, read_csv_chunks)
+from data_schema import ARRESTS_SCHEMA, COMPLAINTS_SCHEMA
+from heatmap_utils import NYC_BOUNDS, TIME_KEYS, _time_key, cell_centres, grid_cells, grid_heatmap_data
+from hypothesis_pipeline import SHARES_BY_COLUMN
+from instrumentation import instrumented
+from parallel_hypotheses import HYPOTHESES, POPULATION_PCT_COLUMNS
+
+# Dataset -> key column, default file, dtypes, date formats, schema, cube dimensions and heatmap frame
+# dimension (date/time column, time key, strftime format)
+INCREMENTAL_DATASETS = {
+    'arrests': {
+        'key': 'ARREST_KEY', 'file': ARRESTS_FILE, 'dtypes': ARRESTS_DTYPES, 'dates': ARRESTS_DATES,
+        'schema': ARRESTS_SCHEMA, 'dimensions': ARRESTS_DIMENSIONS,
+        'frames': ('ARREST_DATE', 'dayofyear', '%m/%d/%Y'),
+    },
+    'complaints': {
+        'key': 'CMPLNT_NUM', 'file': COMPLAINTS_FILE, 'dtypes': COMPLAINTS_DTYPES, 'dates': COMPLAINTS_DATES,
+        'schema': COMPLAINTS_SCHEMA, 'dimensions': COMPLAINTS_DIMENSIONS,
+        'frames': ('CMPLNT_FR_TM', 'hour', '%H:%M:%S'),
+    },
+}
+
+# Cell size (in degrees) of the persisted location counts, the starting cell size of grid_heatmap_data
+DEFAULT_CELL_SIZE = 0.0025
+
+# File (inside the directory of the counts) recording what has been counted
+STATE_FILE = 'state.json'
+# Bumped whenever the layout of the persisted counts changes
+STATE_VERSION = 1
+# Number of bytes before the end of the counted part of the file compared to tell an append from a rewrite
+TAIL_BYTES = 1 << 16
+
+LAT_COL, LON_COL = 'Latitude', 'Longitude'
+
+
+# This function hashes bytes for the state file
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+# This function hashes the bytes just before the end of the counted part of a file
+def _tail_digest(source, header_size, end):
+    start = max(header_size, end - TAIL_BYTES)
+    source.seek(start)
+    return _digest(source.read(end - start))
+
+
+# This function writes a dataframe to an Arrow IPC file through a temporary file. Categorical columns are
+# stored dictionary encoded and come back as categoricals
+def _write_table(df, path):
+    pa = _import_pyarrow()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.OSFile(path + '.tmp', 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(path + '.tmp', path)
+
+
+# This class keeps the count tables of a dataset up to date with the records added to its extract
+class IncrementalCounts:
+    """
+    Running count tables of the records of an extract, stored in a directory (see the module documentation).
+    Opening a directory which already holds counts loads them, and update adds the records added to the
+    extract since the last update.
+
+    Requires the optional pyarrow dependency.
+
+    :param directory: Directory holding the counts, created by the first update
+    :param dataset: 'arrests' or 'complaints'
+    :param cell_size: Cell size in degrees of the location counts
+    :param bounds: (south, north, west, east) edges of the grid of the location counts
+
+    >>> import shutil, tempfile
+    >>> from Functions_and_Doctests import AGE_POPULATION_SHARE, grouped_population_values
+    >>> tmp = tempfile.mkdtemp()
+    >>> source = os.path.join(tmp, 'NYPD_Arrests_Data_2019.csv')
+    >>> with open('dummy_doctest_files/Arrests_sample.csv') as sample:
+    ...     lines = sample.readlines()
+    >>> with open(source, 'w') as extract:
+    ...     extract.writelines(lines[:4])
+    >>> store = IncrementalCounts(os.path.join(tmp, 'counts'))
+    >>> store.update(source)
+    {'mode': 'full', 'rows': 3}
+    >>> with open(source, 'a') as extract:
+    ...     extract.writelines(lines[4:])
+    >>> store.update(source)
+    {'mode': 'append', 'rows': 3}
+    >>> store.update(source)
+    {'mode': 'unchanged', 'rows': 0}
+    >>> store
+    IncrementalCounts('arrests', 6 records, watermark 193260691)
+
+    The tables are the same as the ones computed from all the records, and are loaded again from the directory:
+
+    >>> records = next(read_csv_chunks(source, ['AGE_GROUP', 'Latitude', 'Longitude'], ARRESTS_DTYPES,
+    ...                                schema=ARRESTS_SCHEMA))
+    >>> store = IncrementalCounts(os.path.join(tmp, 'counts'))
+    >>> store.population_values('AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT').equals(
+    ...     grouped_population_values(records, 'AGE_GROUP', AGE_POPULATION_SHARE, 'POP_BY_AGE_PCT'))
+    True
+    >>> store.heatmap_data() == grid_heatmap_data(records['Latitude'], records['Longitude'])
+    True
+
+    A rewritten file is counted past the watermark, here one record with a larger key was added first:
+
+    >>> with open(source, 'w') as extract:
+    ...     extract.writelines(lines[:1] + ['205569016,10/01/2019,ROBBERY,K,75,25-44,M,BLACK,40.67,-73.88\\n']
+    ...                        + lines[1:])
+    >>> store.update(source)
+    {'mode': 'watermark', 'rows': 1}
+    >>> store.cube.counts('MONTH').T
+    MONTH    1   2   3   7   10  12
+    COUNT_T   2   1   1   1   1   1
+    >>> shutil.rmtree(tmp)
+    """
+
+    def __init__(self, directory, dataset='arrests', cell_size=DEFAULT_CELL_SIZE, bounds=NYC_BOUNDS):
+        if dataset not in INCREMENTAL_DATASETS:
+            raise ValueError('Unknown dataset {!r}, choose from {}'.format(dataset, list(INCREMENTAL_DATASETS)))
+        self.directory = directory
+        self.dataset = dataset
+        self.config = INCREMENTAL_DATASETS[dataset]
+        self.cell_size = cell_size
+        self.bounds = tuple(bounds)
+        self.state = {'version': STATE_VERSION, 'dataset': dataset, 'cell_size': cell_size,
+                      'bounds': list(self.bounds), 'generation': 0, 'rows': 0, 'watermark': None}
+        self.cells = None
+        self.locations = None
+        self._cube = None
+        _, rows, cols = grid_cells([], [], cell_size, self.bounds)
+        self._grid_size = rows * cols
+
+        state_file = os.path.join(directory, STATE_FILE)
+        if os.path.exists(state_file):
+            with open(state_file) as state_in:
+                state = json.load(state_in)
+            if state.get('version') != STATE_VERSION:
+                raise ValueError('{!r} holds counts in an older layout, remove it to count again'.format(directory))
+            if (state['dataset'], state['cell_size'], tuple(state['bounds'])) != (dataset, cell_size, self.bounds):
+                raise ValueError('{!r} holds the counts of {} with a cell size of {} over {}'.format(
+                    directory, state['dataset'], state['cell_size'], tuple(state['bounds'])))
+            self.state = state
+            self._load()
+
+    def __repr__(self):
+        return 'IncrementalCounts({!r}, {:,} records, watermark {})'.format(self.dataset, self.state['rows'],
+                                                                         self.state['watermark'])
+
+    # This method returns the path of a table of the current generation
+    def _table_file(self, name, generation=None):
+        generation = self.state['generation'] if generation is None else generation
+        return os.path.join(self.directory, '{}.{}.arrow'.format(name, generation))
+
+    # This method reads the persisted tables back
+    def _load(self):
+        dimensions = self.config['dimensions']
+        cells = read_arrow(self._table_file('cube'))
+        for name, spec in dimensions.items():
+            if not isinstance(spec, str):
+                # Arrow returns the nullable integer time keys as floats
+                cells[name] = cells[name].astype('Int64')
+        self.cells = cells.set_index(list(dimensions))
+        self.locations = read_arrow(self._table_file('locations'))
+        self._cube = None
+
+    # This method writes the tables as a new generation, then the state which points to it
+    def _save(self):
+        previous = self.state['generation']
+        self.state['generation'] += 1
+        os.makedirs(self.directory, exist_ok=True)
+        _write_table(self.cells.reset_index(), self._table_file('cube'))
+        _write_table(self.locations, self._table_file('locations'))
+        state_file = os.path.join(self.directory, STATE_FILE)
+        with open(state_file + '.tmp', 'w') as state_out:
+            json.dump(self.state, state_out, indent=1)
+        os.replace(state_file + '.tmp', state_file)
+        for name in ('cube', 'locations'):
+            if os.path.exists(self._table_file(name, previous)):
+                os.remove(self._table_file(name, previous))
+
+    @property
+    def cube(self):
+        """
+        :return: AggregateCube of all the records counted so far
+        """
+        if self.cells is None:
+            raise ValueError('No records have been counted yet, call update first')
+        if self._cube is None:
+            self._cube = merge_cubes([self.cells], self.config['schema'])
+        return self._cube
+
+    # This method builds the location table from linear (frame, cell) numbers and their counts
+    def _location_table(self, linear, counts):
+        return pd.DataFrame({'FRAME': (linear // self._grid_size).astype('int16'),
+                             'CELL': (linear % self._grid_size).astype('int32'), 'COUNT': counts})
+
+    # This method counts the records of a chunk per heatmap frame and grid cell
+    def _location_counts(self, chunk):
+        col, key, time_format = self.config['frames']
+        frames = _time_key(chunk[col], key, time_format)
+        cells = grid_cells(chunk[LAT_COL].to_numpy(dtype='float64', na_value=np.nan),
+                           chunk[LON_COL].to_numpy(dtype='float64', na_value=np.nan), self.cell_size, self.bounds)[0]
+        valid = (cells >= 0) & ~np.isnan(frames)
+        linear, counts = np.unique(frames[valid].astype('int64') * self._grid_size + cells[valid], return_counts=True)
+        return self._location_table(linear, counts.astype('int64'))
+
+    # This method adds up location tables, the result is sorted by frame and cell
+    def _merge_locations(self, parts):
+        locations = pd.concat(parts, ignore_index=True)
+        linear = locations['FRAME'].to_numpy(dtype='int64') * self._grid_size + locations['CELL'].to_numpy()
+        keys, inverse = np.unique(linear, return_inverse=True)
+        counts = np.bincount(inverse, weights=locations['COUNT'], minlength=len(keys))
+        return self._location_table(keys, counts.astype('int64'))
+
+    # This method returns the columns read from the extract
+    def _columns(self):
+        dimension_cols = [spec if isinstance(spec, str) else spec[0] for spec in self.config['dimensions'].values()]
+        return list(dict.fromkeys([self.config['key'], *dimension_cols, self.config['frames'][0], LAT_COL, LON_COL]))
+
+    @instrumented
+    def update(self, path=None, chunksize=DEFAULT_CHUNKSIZE, rebuild=False):
+        """
+        Counts the records added to the extract since the last update and saves the updated tables. The
+        extract must not be written to while it is counted.
+
+        :param path: Path of the extract, data_path() of the default file of the dataset when None
+        :param chunksize: Number of rows parsed at a time
+        :param rebuild: Whether the counts are dropped and the whole file counted again
+        :return: Dictionary with the 'mode' of the update ('full', 'append', 'watermark' or 'unchanged') and
+                 the number of new 'rows'
+        """
+        path = data_path(self.config['file']) if path is None else path
+        size = os.path.getsize(path)
+        with open(path, 'rb') as source:
+            header = source.readline()
+            counted = self.state.get('offset')
+            if rebuild or self.cells is None or not counted:
+                mode, offset, watermark = 'full', 0, None
+            elif (_digest(header) == self.state['header'] and size >= counted
+                  and _tail_digest(source, len(header), counted) == self.state['tail']):
+                mode, offset, watermark = ('append' if size > counted else 'unchanged'), counted, None
+            else:
+                mode, offset, watermark = 'watermark', 0, self.state['watermark']
+            tail = _tail_digest(source, len(header), size)
+        if mode == 'unchanged':
+            return {'mode': mode, 'rows': 0}
+
+        key = self.config['key']
+        cube_parts = [] if mode == 'full' else [self.cells]
+        location_parts = [] if mode == 'full' else [self.locations]
+        rows, largest = 0, None
+        for chunk in read_csv_chunks(path, self._columns(), self.config['dtypes'], self.config['dates'], chunksize,
+                                     self.config['schema'], offset):
+            if watermark is not None:
+                chunk = chunk[chunk[key] > watermark]
+            if not len(chunk):
+                continue
+            rows += len(chunk)
+            largest = max(int(chunk[key].max()), largest or 0)
+            cube_parts.append(build_cube(chunk, self.config['dimensions']).to_frame())
+            location_parts.append(self._location_counts(chunk))
+
+        if cube_parts:
+            self._cube = merge_cubes(cube_parts, self.config['schema'])
+            self.cells = self._cube.to_frame()
+            self.locations = self._merge_locations(location_parts)
+        else:
+            self.cells = self.locations = self._cube = None
+        previous = None if mode == 'full' else self.state['watermark']
+        self.state.update(source=os.path.abspath(path), header=_digest(header), offset=size, tail=tail,
+                          rows=rows + (0 if mode == 'full' else self.state['rows']),
+                          watermark=max(filter(None, [previous, largest]), default=None))
+        if self.cells is not None:
+            self._save()
+        return {'mode': mode, 'rows': rows}
+
+    def population_values(self, col, shares, pct_col, where=None, unmapped='nan'):
+        """
+        Returns the grouped_population_values table (grouping_for_count, normalized_values and
+        proportional_values) of a demographic dimension, for the records matching where.
+
+        :param col: Demographic dimension
+        :param shares: Dictionary mapping each label to its share of the total population
+        :param pct_col: Name of the population share column in the result
+        :param where: Optional dictionary mapping dimension names to a label or a list of labels to keep
+        :param unmapped: Policy for labels that are not found in shares (see population_share_lookup)
+        :return: Grouped dataframe with the col, pct_col, COUNT, NORM_VALUES and PROP_VALUES columns
+        """
+        return self.cube.population_values(col, shares, pct_col, where, unmapped)
+
+    def hypothesis_results(self):
+        """
+        Returns the results of the population hypotheses on the dataset (see parallel_hypotheses.HYPOTHESES),
+        in the format of run_all_hypotheses, so their charts can be drawn without reading the extract.
+
+        :return: Dictionary mapping the hypothesis names to their result tables
+        """
+        return {name: self.population_values(col, SHARES_BY_COLUMN[col], POPULATION_PCT_COLUMNS[col])
+                for name, (dataset, kind, col) in HYPOTHESES.items()
+                if dataset == self.dataset and kind == 'population' and col in self.config['dimensions']}
+
+    def heatmap_data(self, max_points=20000, normalize=True):
+        """
+        Returns the HeatMap payload of all the records counted, the same as grid_heatmap_data on their
+        coordinates with the cell size of the counts as starting cell size.
+
+        :param max_points: Maximum number of triples returned
+        :param normalize: Whether the weights are divided by the largest weight
+        :return: List of [lat, lon, weight] lists
+        """
+        totals = np.bincount(self.locations['CELL'], weights=self.locations['COUNT'])
+        nonempty = np.flatnonzero(totals)
+        cell_lat, cell_lon = cell_centres(nonempty, self.cell_size, self.bounds)
+        return grid_heatmap_data(cell_lat, cell_lon, self.cell_size, self.bounds, max_points, normalize,
+                                 weights=totals[nonempty])
+
+    def time_frames(self, frames=None, as_arrays=False):
+        """
+        Returns the HeatMapWithTime payload of all the records counted, the same as heatmap_utils.time_frames
+        on the records with the time key of the dataset and the cell size of the counts.
+
+        :param frames: Key values to produce frames for, defaults to the full range of the key
+        :param as_arrays: Return NumPy arrays instead of lists of lists
+        :return: Tuple (index, data) with the frame key values and the per-frame [lat, lon, weight] lists
+        """
+        _, key, _ = self.config['frames']
+        keys = self.locations['FRAME'].to_numpy()
+        cells = self.locations['CELL'].to_numpy()
+        counts = self.locations['COUNT'].to_numpy(dtype='float64')
+        if frames is None:
+            frames = TIME_KEYS[key][1]
+            if key == 'dayofyear' and not (len(keys) and keys[-1] == 366):
+                frames = range(1, 366)
+        index = list(frames)
+        starts = np.searchsorted(keys, index, side='left')
+        ends = np.searchsorted(keys, index, side='right')
+
+        data = []
+        for start, end in zip(starts, ends):
+            cell_lat, cell_lon = cell_centres(cells[start:end], self.cell_size, self.bounds)
+            weight = counts[start:end]
+            if len(weight):
+                weight = weight / weight.max()
+            points = np.column_stack([cell_lat.round(5), cell_lon.round(5), weight.round(4)])
+            data.append(points if as_arrays else points.tolist())
+        return index, data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='directory of the counts')
+    parser.add_argument('--dataset', choices=list(INCREMENTAL_DATASETS), default='arrests')
+    parser.add_argument('--path', default=None, help='path of the extract, found with data_path by default')
+    parser.add_argument('--rebuild', action='store_true', help='count the whole file again')
+    parser.add_argument('--render', action='store_true', help='redraw the charts of the population hypotheses')
+    arguments = parser.parse_args()
+
+    started = time.perf_counter()
+    store = IncrementalCounts(arguments.directory, arguments.dataset)
+    path = data_path(store.config['file']) if arguments.path is None else arguments.path
+    summary = store.update(path, rebuild=arguments.rebuild)
+    print('{}: {:,} new records in {:.2f} s, {!r}'.format(summary['mode'], summary['rows'],
+                                                          time.perf_counter() - started, store))
+    if arguments.render:
+        import render_graphs
+        results = store.hypothesis_results()
+        charts = [name for name, (hypothesis, *_) in render_graphs.CHARTS.items() if hypothesis in results]
+        rendered = render_graphs.render_charts({arguments.dataset: path}, charts=charts, results=results)
+        print('rendered: {}'.format(', '.join(rendered['rendered']) or '-'))
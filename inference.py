@@ -0,0 +1,312 @@
+"""
+Significance tests and confidence intervals for the normalized proportions and flag probabilities of the
+hypotheses.
+
+The hypotheses compare the heights of PROP_VALUES (grouped_population_values, proportional_values) and
+PROB_<NAME> bars (flag_probabilities). The functions below tell which of those differences are larger
+than sampling noise:
+- goodness_of_fit: chi-square test of the group counts against the population shares, i.e. whether the
+  normalized proportions differ at all;
+- flag_independence_test: chi-square test of whether the probability of a flag differs between groups;
+- pairwise_proportion_tests: two-proportion z-tests between every pair of groups, with Holm adjusted
+  p-values;
+- proportion_intervals and probability_intervals: bootstrap (or Bayesian) intervals of PROP_VALUES and
+  PROB_<NAME>.
+
+Everything works on the small grouped tables, never on the records: a bootstrap replicate of the records
+is a multinomial draw of the group counts (a binomial draw of the 'Y' count of every group for a flag), so
+thousands of replicates are drawn at once with NumPy in milliseconds. The 'bayes' method draws from the
+Dirichlet (Beta) posterior of the shares (probabilities) under a Jeffreys prior instead. Replicates are
+drawn in batches of REPLICATE_BATCH, each from its own seed, so very large numbers of replicates can be
+spread over worker processes and give the same intervals whatever the number of workers.
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+DEFAULT_REPLICATES = 10_000
+DEFAULT_LEVEL = 0.95
+# Replicates drawn per batch (and per task of the worker processes)
+REPLICATE_BATCH = 100_000
+METHODS = ('bootstrap', 'bayes')
+# Concentration of the Jeffreys prior of the 'bayes' method
+_PRIOR = 0.5
+
+
+# This function returns the upper tail probability of the standard normal distribution
+def _normal_sf(z):
+    return np.array([0.5 * math.erfc(value / math.sqrt(2)) for value in np.ravel(z)]).reshape(np.shape(z))
+
+
+# This function returns the upper tail probability of the chi-square distribution
+def chi2_sf(statistic, dof):
+    """
+    This function computes P(X > statistic) for a chi-square variable X with dof degrees of freedom, as the
+    regularized upper incomplete gamma function Q(dof / 2, statistic / 2).
+
+    :param statistic: Value of the chi-square statistic
+    :param dof: Degrees of freedom
+    :return: p-value
+
+    >>> round(chi2_sf(3.841459, 1), 4), round(chi2_sf(11.070498, 5), 4), chi2_sf(0, 3)
+    (0.05, 0.05, 1.0)
+    """
+    a, x = dof / 2, statistic / 2
+    if x <= 0:
+        return 1.0
+    log_scale = a * math.log(x) - x - math.lgamma(a)
+    if x < a + 1:
+        # Series of the lower function P
+        term = total = 1 / a
+        n = a
+        while abs(term) > abs(total) * 1e-15:
+            n += 1
+            term *= x / n
+            total += term
+        return max(0.0, 1 - total * math.exp(log_scale))
+    # Continued fraction of Q (modified Lentz)
+    tiny = 1e-300
+    b = x + 1 - a
+    c, d = 1 / tiny, 1 / b
+    fraction = d
+    for i in range(1, 1000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        fraction *= d * c
+        if abs(d * c - 1) < 1e-15:
+            break
+    return math.exp(log_scale) * fraction
+
+
+# This function returns the demographic group labels of a grouped table as strings
+def _group_labels(table):
+    first = min(table.columns.get_loc(col) for col in ('POP_PCT', 'COUNT_T', 'COUNT') if col in table.columns)
+    labels = table.iloc[:, :first].astype(str)
+    return labels.iloc[:, 0] if first == 1 else labels.agg(' / '.join, axis=1)
+
+
+# This function tests the group counts against the population shares
+@instrumented
+def goodness_of_fit(grouped, pct_col, count_col='COUNT'):
+    """
+    This function runs Pearson's chi-square goodness-of-fit test of the group counts of a grouped frame
+    (grouped_population_values, or normalized_values output) against the counts expected if every group
+    were counted in proportion to its population share. The shares of the groups of the frame are rescaled
+    to add up to 1. Under that null hypothesis all the PROP_VALUES are equal.
+
+    :param grouped: Grouped dataframe with the count and population share columns
+    :param pct_col: Population share column, e.g. 'POP_BY_AGE_PCT'
+    :param count_col: Count column
+    :return: Series with CHI2 (statistic), DOF (degrees of freedom) and P_VALUE
+
+    >>> grouped = pd.DataFrame({'SEX': ['F', 'M'], 'POP_BY_SEX_PCT': [0.5, 0.5], 'COUNT': [40, 60]})
+    >>> goodness_of_fit(grouped, 'POP_BY_SEX_PCT').round(4)
+    CHI2       4.0000
+    DOF        1.0000
+    P_VALUE    0.0455
+    dtype: float64
+    """
+    observed = grouped[count_col].to_numpy(dtype='float64')
+    shares = grouped[pct_col].to_numpy(dtype='float64')
+    expected = observed.sum() * shares / shares.sum()
+    statistic = float(((observed - expected) ** 2 / expected).sum())
+    dof = len(observed) - 1
+    return pd.Series({'CHI2': statistic, 'DOF': dof, 'P_VALUE': chi2_sf(statistic, dof)})
+
+
+# This function tests whether the probability of a flag differs between the groups
+@instrumented
+def flag_independence_test(table, name):
+    """
+    This function runs Pearson's chi-square test of independence between the groups of a flag_probabilities
+    table and its flag (the contingency table of the 'Y' and other records of every group).
+
+    :param table: Output of flag_probabilities, with COUNT_T and COUNT_<name>_Y
+    :param name: Short name of the flag, e.g. 'FRISKED'
+    :return: Series with CHI2 (statistic), DOF (degrees of freedom) and P_VALUE
+
+    >>> table = pd.DataFrame({'SUSPECT_SEX': ['FEMALE', 'MALE'], 'COUNT_T': [100, 100], 'COUNT_FRISKED_Y': [30, 50]})
+    >>> flag_independence_test(table, 'FRISKED').round(4)
+    CHI2       8.3333
+    DOF        1.0000
+    P_VALUE    0.0039
+    dtype: float64
+    """
+    flagged = table['COUNT_' + name + '_Y'].to_numpy(dtype='float64')
+    totals = table['COUNT_T'].to_numpy(dtype='float64')
+    observed = np.stack([flagged, totals - flagged])
+    expected = observed.sum(axis=1, keepdims=True) * totals / totals.sum()
+    statistic = float(((observed - expected) ** 2 / expected).sum())
+    dof = len(totals) - 1
+    return pd.Series({'CHI2': statistic, 'DOF': dof, 'P_VALUE': chi2_sf(statistic, dof)})
+
+
+# This function compares the probability of a flag between every pair of groups
+@instrumented
+def pairwise_proportion_tests(table, name):
+    """
+    This function runs a two-proportion z-test (pooled standard error) of PROB_<name> between every pair of
+    groups of a flag_probabilities table. P_HOLM holds the p-values adjusted for the number of pairs with
+    Holm's method, to be compared with the significance level when several pairs are looked at.
+
+    :param table: Output of flag_probabilities, with the group columns first, COUNT_T and COUNT_<name>_Y
+    :param name: Short name of the flag, e.g. 'FRISKED'
+    :return: Dataframe with one row per pair of groups: GROUP_1, GROUP_2, PROB_1, PROB_2, DIFF, Z, P_VALUE
+             and P_HOLM
+
+    >>> table = pd.DataFrame({'SUSPECT_RACE': ['BLACK HISPANIC', 'UNKNOWN', 'WHITE'], 'COUNT_T': [1000, 200, 800],
+    ...                       'COUNT_FRISKED_Y': [700, 136, 480]})
+    >>> pairwise_proportion_tests(table, 'FRISKED').round(4)
+              GROUP_1  GROUP_2  PROB_1  PROB_2  DIFF       Z  P_VALUE  P_HOLM
+    0  BLACK HISPANIC  UNKNOWN    0.70    0.68  0.02  0.5617   0.5743  0.5743
+    1  BLACK HISPANIC    WHITE    0.70    0.60  0.10  4.4365   0.0000  0.0000
+    2         UNKNOWN    WHITE    0.68    0.60  0.08  2.0806   0.0375  0.0749
+    """
+    labels = _group_labels(table).to_numpy()
+    flagged = table['COUNT_' + name + '_Y'].to_numpy(dtype='float64')
+    totals = table['COUNT_T'].to_numpy(dtype='float64')
+    first, second = np.triu_indices(len(totals), k=1)
+    probability = flagged / totals
+    pooled = (flagged[first] + flagged[second]) / (totals[first] + totals[second])
+    error = np.sqrt(pooled * (1 - pooled) * (1 / totals[first] + 1 / totals[second]))
+    diff = probability[first] - probability[second]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(error > 0, diff / error, 0.0)
+    p_value = 2 * _normal_sf(np.abs(z))
+    # Holm: the i-th smallest p-value is multiplied by (pairs - i), the adjusted values kept non-decreasing
+    order = np.argsort(p_value, kind='stable')
+    holm = np.empty_like(p_value)
+    holm[order] = np.minimum(np.maximum.accumulate(p_value[order] * (len(order) - np.arange(len(order)))), 1)
+    return pd.DataFrame({'GROUP_1': labels[first], 'GROUP_2': labels[second], 'PROB_1': probability[first],
+                         'PROB_2': probability[second], 'DIFF': diff, 'Z': z, 'P_VALUE': p_value, 'P_HOLM': holm})
+
+
+# This function draws one batch of replicates of the normalized proportions or of the flag probabilities
+def _replicate_batch(kind, method, counts, totals, shares, replicates, seed):
+    rng = np.random.default_rng(seed)
+    if kind == 'proportions':
+        if method == 'bootstrap':
+            draws = rng.multinomial(int(counts.sum()), counts / counts.sum(), size=replicates) / shares
+        else:
+            draws = rng.dirichlet(counts + _PRIOR, size=replicates) / shares
+        return draws * 100 / draws.sum(axis=1, keepdims=True)
+    if method == 'bootstrap':
+        return rng.binomial(totals.astype('int64'), counts / totals, size=(replicates, len(totals))) / totals
+    return rng.beta(counts + _PRIOR, totals - counts + _PRIOR, size=(replicates, len(totals)))
+
+
+# This function returns the percentile interval of every group from batches of replicates
+def _percentile_intervals(kind, method, counts, totals, shares, replicates, level, seed, workers):
+    if method not in METHODS:
+        raise ValueError('Unknown method {!r}, choose from {}'.format(method, list(METHODS)))
+    sizes = [min(REPLICATE_BATCH, replicates - start) for start in range(0, replicates, REPLICATE_BATCH)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    arguments = [(kind, method, counts, totals, shares, size, batch_seed) for size, batch_seed in zip(sizes, seeds)]
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(arguments) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(arguments))) as pool:
+            batches = list(pool.map(_replicate_batch, *zip(*arguments)))
+    else:
+        batches = [_replicate_batch(*batch) for batch in arguments]
+    tail = (1 - level) / 2
+    return np.quantile(np.concatenate(batches), [tail, 1 - tail], axis=0)
+
+
+# This function adds confidence intervals of PROP_VALUES to a grouped frame
+@instrumented
+def proportion_intervals(grouped, pct_col, count_col='COUNT', replicates=DEFAULT_REPLICATES, level=DEFAULT_LEVEL,
+                         method='bootstrap', seed=None, workers=1):
+    """
+    This function adds the PROP_VALUES_LOW and PROP_VALUES_HIGH bounds of the confidence (or credible)
+    interval of PROP_VALUES to a grouped frame (grouped_population_values, or proportional_values output).
+    The group counts are resampled, normalized by the population shares and turned into proportions for
+    every replicate, and the interval is the percentile interval of the replicates.
+
+    :param grouped: Grouped dataframe with the count and population share columns
+    :param pct_col: Population share column, e.g. 'POP_BY_AGE_PCT'
+    :param count_col: Count column
+    :param replicates: Number of replicates
+    :param level: Confidence level of the intervals
+    :param method: 'bootstrap' (multinomial resampling of the counts) or 'bayes' (Dirichlet posterior)
+    :param seed: Seed of the random generator, for reproducible intervals
+    :param workers: Number of worker processes for the batches of REPLICATE_BATCH replicates, all the cores
+                    when None; only worth it for millions of replicates
+    :return: Shallow copy of grouped with the two interval columns, rounded like PROP_VALUES
+
+    >>> from Functions_and_Doctests import SEX_POPULATION_SHARE, population_values_from_counts
+    >>> grouped = population_values_from_counts(pd.Series({'FEMALE': 523, 'MALE': 953}), 'SEX',
+    ...                                         SEX_POPULATION_SHARE, 'POP_BY_SEX_PCT')
+    >>> intervals = proportion_intervals(grouped, 'POP_BY_SEX_PCT', seed=0)
+    >>> list(intervals.columns[-3:])
+    ['PROP_VALUES', 'PROP_VALUES_LOW', 'PROP_VALUES_HIGH']
+    >>> bool(((intervals['PROP_VALUES_LOW'] < intervals['PROP_VALUES']) &
+    ...       (intervals['PROP_VALUES'] < intervals['PROP_VALUES_HIGH'])).all())
+    True
+
+    The intervals do not depend on how the batches of replicates are spread over worker processes:
+
+    >>> many = proportion_intervals(grouped, 'POP_BY_SEX_PCT', replicates=150_000, method='bayes', seed=1)
+    >>> many.equals(proportion_intervals(grouped, 'POP_BY_SEX_PCT', replicates=150_000, method='bayes', seed=1,
+    ...                                  workers=2))
+    True
+    """
+    counts = grouped[count_col].to_numpy(dtype='float64')
+    shares = grouped[pct_col].to_numpy(dtype='float64')
+    low, high = _percentile_intervals('proportions', method, counts, None, shares, replicates, level, seed,
+                                      workers)
+    result = grouped.copy(deep=False)
+    result['PROP_VALUES_LOW'] = low.round(2)
+    result['PROP_VALUES_HIGH'] = high.round(2)
+    return result
+
+
+# This function adds confidence intervals of the flag probabilities to a probability table
+@instrumented
+def probability_intervals(table, names=None, replicates=DEFAULT_REPLICATES, level=DEFAULT_LEVEL,
+                          method='bootstrap', seed=None, workers=1):
+    """
+    This function adds PROB_<NAME>_LOW and PROB_<NAME>_HIGH interval bounds after every PROB_<NAME> column
+    of a flag_probabilities table. The 'Y' count of every group is resampled from its COUNT_T records (with
+    population shares PROB_<NAME> is the same ratio, up to the rounding of the normalized values).
+
+    :param table: Output of flag_probabilities
+    :param names: Short names of the flags, all the flags of the table when None
+    :param replicates: Number of replicates
+    :param level: Confidence level of the intervals
+    :param method: 'bootstrap' (binomial resampling of the counts) or 'bayes' (Beta posterior)
+    :param seed: Seed of the random generator, for reproducible intervals
+    :param workers: Number of worker processes for the batches of REPLICATE_BATCH replicates, all the cores
+                    when None
+    :return: Shallow copy of table with the interval columns
+
+    >>> table = pd.DataFrame({'SUSPECT_SEX': ['FEMALE', 'MALE'], 'COUNT_T': [100, 4000],
+    ...                       'COUNT_FRISKED_Y': [30, 2000], 'PROB_FRISKED': [0.3, 0.5]})
+    >>> intervals = probability_intervals(table, seed=0)
+    >>> list(intervals.columns)
+    ['SUSPECT_SEX', 'COUNT_T', 'COUNT_FRISKED_Y', 'PROB_FRISKED', 'PROB_FRISKED_LOW', 'PROB_FRISKED_HIGH']
+    >>> (intervals['PROB_FRISKED_HIGH'] - intervals['PROB_FRISKED_LOW']).round(2).tolist()
+    [0.18, 0.03]
+    """
+    if names is None:
+        names = [col[len('PROB_'):] for col in table.columns if col.startswith('PROB_')]
+    totals = table['COUNT_T'].to_numpy(dtype='float64')
+    result = table.copy(deep=False)
+    for position, name in enumerate(names):
+        flagged = table['COUNT_' + name + '_Y'].to_numpy(dtype='float64')
+        name_seed = None if seed is None else [seed, position]
+        low, high = _percentile_intervals('probabilities', method, flagged, totals, None, replicates, level,
+                                          name_seed, workers)
+        column = result.columns.get_loc('PROB_' + name) + 1
+        result.insert(column, 'PROB_' + name + '_LOW', low)
+        result.insert(column + 1, 'PROB_' + name + '_HIGH', high)
+    return result
@@ -0,0 +1,295 @@
+"""
+Opt-in instrumentation of the analysis, loading and heatmap functions.
+
+Functions decorated with @instrumented (and code wrapped in a span() block) record, while instrumentation
+is enabled, one span per call: wall time, rows in and out (the length of the first dataframe, series or
+array argument and of the result) and, when memory tracing is on, the memory allocated and the peak
+reached during the call (tracemalloc). Spans nest, so the time of a hypothesis can be broken down into
+reading, lookups, groupbys and plotting. The spans can be summarized per function, written as JSON, or
+written in the Chrome trace format and opened in chrome://tracing or https://ui.perfetto.dev.
+
+While instrumentation is disabled (the default) a decorated function costs one extra Python call and a
+flag test, so the decorators can stay in place in scheduled runs. Setting the NYPD_TRACE environment
+variable to a file path enables instrumentation at import time and writes a Chrome trace there on exit.
+
+    import instrumentation
+    instrumentation.enable(memory=True)
+    ... run the analysis ...
+    print(instrumentation.summary())
+    instrumentation.export_chrome_trace('trace.json')
+"""
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+class _State:
+    enabled = False
+    memory = False
+    origin = time.perf_counter()
+    spans = []
+    # Whether tracemalloc was started by enable() and has to be stopped by disable()
+    started_tracemalloc = False
+
+
+_state = _State()
+_local = threading.local()
+
+
+# This function turns instrumentation on
+def enable(memory=False):
+    """
+    This function starts recording spans. Spans recorded earlier are discarded.
+
+    :param memory: Whether the allocated and peak memory of every span is traced with tracemalloc. This
+                   slows the traced code down noticeably, timings are best taken with memory=False
+    """
+    reset()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state.started_tracemalloc = True
+    _state.memory = memory
+    _state.enabled = True
+
+
+# This function turns instrumentation off, keeping the recorded spans
+def disable():
+    """
+    This function stops recording spans. The spans recorded so far stay available to summary() and the
+    export functions.
+    """
+    _state.enabled = False
+    if _state.started_tracemalloc:
+        tracemalloc.stop()
+        _state.started_tracemalloc = False
+
+
+# This function tells whether spans are being recorded
+def is_enabled():
+    return _state.enabled
+
+
+# This function discards the recorded spans
+def reset():
+    _state.spans = []
+    _state.origin = time.perf_counter()
+
+
+# This function returns the number of rows of a dataframe, series or array, None for anything else
+def _rows(value):
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index, np.ndarray)):
+        return len(value)
+    return None
+
+
+# This class records one span, it is the context manager returned by span() while instrumentation is enabled
+class _Span:
+
+    def __init__(self, name, rows_in=None, fields=None):
+        self.record = {'name': name, 'rows_in': rows_in, 'rows_out': None}
+        if fields:
+            self.record.update(fields)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self.record['depth'] = len(stack)
+        self.record['parent'] = stack[-1].record['id'] if stack else None
+        self.record['id'] = len(_state.spans)
+        _state.spans.append(self.record)
+        if _state.memory and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak counter is shared, remember the parent's peak before resetting it for this span
+            if stack:
+                stack[-1].max_peak = max(stack[-1].max_peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = self.max_peak = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def set_rows_out(self, value):
+        self.record['rows_out'] = _rows(value)
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        self.record['start'] = self.start - _state.origin
+        self.record['duration'] = end - self.start
+        self.record['pid'] = os.getpid()
+        self.record['thread'] = threading.get_ident()
+        stack = _local.stack
+        stack.pop()
+        if hasattr(self, 'start_memory') and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.record['allocated_bytes'] = current - self.start_memory
+            self.record['peak_bytes'] = max(self.max_peak, peak) - self.start_memory
+            if stack:
+                stack[-1].max_peak = max(stack[-1].max_peak, peak)
+        return False
+
+
+# This class is returned by span() while instrumentation is disabled
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_rows_out(self, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+# This function opens a span around a block of code
+def span(name, rows_in=None, **fields):
+    """
+    This function returns a context manager recording a span around a block of code, or a shared no-op
+    context manager while instrumentation is disabled. Extra keyword arguments are stored with the span.
+
+    :param name: Name of the span
+    :param rows_in: Optional number of rows processed by the block
+    :return: Context manager, whose set_rows_out method records the size of the block's result
+
+    >>> enable()
+    >>> with span('load', source='sample') as load:
+    ...     with span('parse'):
+    ...         df = pd.DataFrame({'col1': range(5)})
+    ...     load.set_rows_out(df)
+    >>> disable()
+    >>> [(record['name'], record['depth'], record['rows_out']) for record in spans()]
+    [('load', 0, 5), ('parse', 1, None)]
+    >>> spans()[0]['source']
+    'sample'
+    """
+    if not _state.enabled:
+        return _NULL_SPAN
+    return _Span(name, rows_in, fields)
+
+
+# This function is the decorator recording a span for every call of a function
+def instrumented(function=None, name=None):
+    """
+    This function decorates a function so that every call records a span named after the function (or
+    after name), with the rows of its first dataframe/series/array argument and of its result.
+
+    :param function: Function to decorate
+    :param name: Optional span name, the qualified name of the function by default
+    :return: The decorated function
+
+    >>> @instrumented
+    ... def double(df):
+    ...     return pd.concat([df, df])
+    >>> enable()
+    >>> _ = double(pd.DataFrame({'col1': [1, 2]}))
+    >>> disable()
+    >>> summary()[['name', 'calls', 'rows_in', 'rows_out']]
+         name  calls  rows_in  rows_out
+    0  double      1        2         4
+    """
+    if function is None:
+        return functools.partial(instrumented, name=name)
+    span_name = name or function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _state.enabled:
+            return function(*args, **kwargs)
+        rows_in = None
+        for argument in args:
+            rows_in = _rows(argument)
+            if rows_in is not None:
+                break
+        with _Span(span_name, rows_in) as call:
+            result = function(*args, **kwargs)
+            call.set_rows_out(result)
+        return result
+
+    return wrapper
+
+
+# This function returns the recorded spans
+def spans():
+    """
+    :return: List of dictionaries, one per span in the order the spans were opened
+    """
+    return list(_state.spans)
+
+
+# This function aggregates the recorded spans per name
+def summary():
+    """
+    This function returns one row per span name with the number of calls, the total, mean and maximum wall
+    time, the total rows in and out and (when memory was traced) the largest peak of memory, sorted by total
+    time.
+
+    :return: Dataframe with the name, calls, total_s, mean_s, max_s, rows_in, rows_out and peak_mb columns
+    """
+    columns = ['name', 'calls', 'total_s', 'mean_s', 'max_s', 'rows_in', 'rows_out', 'peak_mb']
+    finished = [record for record in _state.spans if 'duration' in record]
+    if not finished:
+        return pd.DataFrame(columns=columns)
+    records = pd.DataFrame(finished)
+    if 'peak_bytes' not in records:
+        records['peak_bytes'] = np.nan
+    grouped = records.groupby('name', sort=False)
+    table = pd.DataFrame({
+        'calls': grouped.size(),
+        'total_s': grouped['duration'].sum(),
+        'mean_s': grouped['duration'].mean(),
+        'max_s': grouped['duration'].max(),
+        'rows_in': grouped['rows_in'].sum(min_count=1).astype('Int64'),
+        'rows_out': grouped['rows_out'].sum(min_count=1).astype('Int64'),
+        'peak_mb': grouped['peak_bytes'].max() / 1e6,
+    })
+    return table.sort_values('total_s', ascending=False).reset_index()[columns]
+
+
+# This function writes the recorded spans as JSON
+def export_json(path):
+    """
+    This function writes the recorded spans, with times in seconds and memory in bytes, as a JSON list.
+
+    :param path: Path of the JSON file
+    """
+    with open(path, 'w') as out:
+        json.dump(spans(), out, indent=1, default=str)
+
+
+# This function writes the recorded spans in the Chrome trace event format
+def export_chrome_trace(path):
+    """
+    This function writes the recorded spans as complete ('X') events of the Chrome trace event format,
+    which chrome://tracing and Perfetto display as a flame chart per thread.
+
+    :param path: Path of the trace file
+    """
+    events = []
+    for record in _state.spans:
+        if 'duration' not in record:
+            continue
+        args = {key: value for key, value in record.items()
+                if key not in ('name', 'start', 'duration', 'pid', 'thread', 'id', 'parent', 'depth')
+                and value is not None}
+        events.append({'name': record['name'], 'ph': 'X', 'ts': record['start'] * 1e6,
+                       'dur': record['duration'] * 1e6, 'pid': record['pid'], 'tid': record['thread'],
+                       'args': args})
+    with open(path, 'w') as out:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out, default=str)
+
+
+# Scheduled runs can switch instrumentation on from the environment without code changes
+if os.environ.get('NYPD_TRACE'):
+    enable(memory=os.environ.get('NYPD_TRACE_MEMORY', '') not in ('', '0'))
+    atexit.register(lambda: export_chrome_trace(os.environ['NYPD_TRACE']))
@@ -0,0 +1,57 @@
+"""
+Analysis API of the NYPD arrests, complaints and stop, question and frisk extracts, as a package.
+
+The functions live in the modules at the root of the repository (Functions_and_Doctests.py, data_loading.py,
+...), which the notebooks import directly. This package groups their public API by topic:
+
+lookup    : population share tables and the lookups adding them to record frames
+aggregate : grouped counts, normalized values, proportions, flag probabilities, cubes, out-of-core and
+            incremental counts
+stats     : significance tests and confidence intervals of the aggregated tables
+io        : readers of the extracts, Arrow cache, schemas and the location of the data files
+geo       : heatmap grids, map tiles geometry and the spatial join to regions
+plot      : charts, heatmap tiles and folium layers (matplotlib and folium are imported on first use)
+
+Importing the package imports none of them; a submodule is imported when it is first accessed, so
+scheduled jobs only pay for what they use:
+
+    import nypd_analysis
+    nypd_analysis.aggregate.grouped_population_values(df, 'AGE_GROUP', shares, 'POP_BY_AGE_PCT')
+
+    from nypd_analysis.aggregate import flag_probabilities
+
+The extracts are read from the directory named by the NYPD_DATA_DIR environment variable (see
+nypd_analysis.io.data_path), nothing changes the working directory.
+
+The package is not installable on its own: its submodules re-export the modules at the root of the
+repository, which are not packaged. It must be imported with the repository root on sys.path, i.e. from
+scripts or notebooks run from the repository root, or with the root added to PYTHONPATH:
+
+    PYTHONPATH=/path/to/repository python scheduled_job.py
+"""
+import importlib
+
+__all__ = ['lookup', 'aggregate', 'stats', 'io', 'geo', 'plot']
+
+
+# This function imports a submodule when it is first accessed as an attribute of the package
+def __getattr__(name):
+    """
+    >>> import subprocess, sys
+    >>> code = 'import sys, nypd_analysis; print(sorted(m for m in ("pandas", "matplotlib") if m in sys.modules))'
+    >>> subprocess.run([sys.executable, '-c', code], capture_output=True, text=True).stdout
+    '[]\\n'
+
+    Every name listed in the __all__ of a submodule exists:
+
+    >>> [(module, name) for module in __all__ for name in getattr(importlib.import_module(__name__ + '.' + module),
+    ...  '__all__') if not hasattr(importlib.import_module(__name__ + '.' + module), name)]
+    []
+    """
+    if name in __all__:
+        return importlib.import_module(__name__ + '.' + name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
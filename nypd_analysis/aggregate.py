@@ -0,0 +1,23 @@
+"""
+Grouped counts, normalized values, proportions and flag probabilities of the hypotheses, from record
+frames, chunk streams, files (out of core), a prebuilt aggregate cube or counts kept up to date with the
+records appended to an extract.
+"""
+from aggregate_cube import (ARRESTS_DIMENSIONS, COMPLAINTS_DIMENSIONS, SQF_DIMENSIONS, AggregateCube, build_cube,
+                            merge_cubes)
+from Functions_and_Doctests import (flag_counts, flag_is_yes, flag_probabilities, flag_probabilities_from_counts,
+                                    grouped_population_values, grouping_for_count, is_chunk_stream, merge_counts,
+                                    normalized_values, population_values_from_counts, preliminary_analysis,
+                                    proportional_values, row_slices, select_columns)
+from incremental import INCREMENTAL_DATASETS, IncrementalCounts
+from out_of_core import available_backends, file_group_counts
+from report_lag import merge_report_lag_histograms, report_lag_histograms, report_lags
+
+__all__ = [
+    'select_columns', 'preliminary_analysis', 'row_slices', 'is_chunk_stream', 'merge_counts',
+    'grouping_for_count', 'normalized_values', 'proportional_values', 'grouped_population_values',
+    'population_values_from_counts', 'flag_is_yes', 'flag_counts', 'flag_probabilities',
+    'flag_probabilities_from_counts', 'report_lags', 'report_lag_histograms', 'merge_report_lag_histograms',
+    'AggregateCube', 'build_cube', 'merge_cubes', 'ARRESTS_DIMENSIONS', 'COMPLAINTS_DIMENSIONS', 'SQF_DIMENSIONS',
+    'IncrementalCounts', 'INCREMENTAL_DATASETS', 'file_group_counts', 'available_backends',
+]
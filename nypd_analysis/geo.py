@@ -0,0 +1,14 @@
+"""
+Heatmap grids and time frames, map tile geometry and the spatial join of the records to regions.
+"""
+from heatmap_tiles import mercator_pixels, tile_density, tile_range
+from heatmap_utils import (NYC_BOUNDS, NYC_CENTER, cell_centres, cell_size_for_zoom, grid_cells, grid_counts,
+                           grid_heatmap_data, multi_resolution_heatmap_data, time_frames)
+from spatial_index import (REGION_FILES, RegionIndex, add_region_column, read_regions, region_index,
+                           region_population_shares)
+
+__all__ = [
+    'NYC_BOUNDS', 'NYC_CENTER', 'cell_size_for_zoom', 'grid_cells', 'cell_centres', 'grid_counts', 'grid_heatmap_data',
+    'multi_resolution_heatmap_data', 'time_frames', 'mercator_pixels', 'tile_range', 'tile_density',
+    'REGION_FILES', 'RegionIndex', 'read_regions', 'region_index', 'add_region_column', 'region_population_shares',
+]
@@ -0,0 +1,18 @@
+"""
+Readers of the extracts, the concurrent loading of many extracts, the Arrow cache, the dataset schemas and the
+location of the data files.
+"""
+from bulk_loading import detect_dataset, expand_sources, iter_partitions, load_sources
+from data_loading import (ARRESTS_FILE, COMPLAINTS_FILE, DATA_DIR_VARIABLE, SQF_FILE, arrow_cache, arrow_num_rows,
+                          cached_read, concat_chunks, data_dir, data_path, read_arrests, read_arrests_chunks,
+                          read_arrow, read_complaints, read_complaints_chunks, read_csv_chunks, read_sqf,
+                          source_fingerprint)
+from data_schema import ARRESTS_SCHEMA, COMPLAINTS_SCHEMA, SQF_SCHEMA, apply_schema, canonical_counts
+
+__all__ = [
+    'ARRESTS_FILE', 'COMPLAINTS_FILE', 'SQF_FILE', 'DATA_DIR_VARIABLE', 'data_dir', 'data_path',
+    'read_csv_chunks', 'read_arrests_chunks', 'read_complaints_chunks', 'concat_chunks', 'read_arrests',
+    'read_complaints', 'read_sqf', 'source_fingerprint', 'arrow_cache', 'read_arrow', 'arrow_num_rows',
+    'cached_read', 'ARRESTS_SCHEMA', 'COMPLAINTS_SCHEMA', 'SQF_SCHEMA', 'apply_schema', 'canonical_counts',
+    'detect_dataset', 'expand_sources', 'iter_partitions', 'load_sources',
+]
@@ -0,0 +1,16 @@
+"""
+Population share tables and the lookups adding them to record frames.
+"""
+from Functions_and_Doctests import (AGE_POPULATION_SHARE, RACE_POPULATION_SHARE, SEX_POPULATION_SHARE,
+                                    add_population_share, age_distribution, age_pct_col, population_share_lookup,
+                                    race_pct_col, race_percentage, sex_distribution, sex_pct_col)
+from population_baselines import (DEFAULT_REGISTRY, BaselineRegistry, add_population_share_by_year,
+                                  population_shares_by_year, record_years)
+
+__all__ = [
+    'AGE_POPULATION_SHARE', 'RACE_POPULATION_SHARE', 'SEX_POPULATION_SHARE',
+    'population_share_lookup', 'add_population_share', 'age_pct_col', 'race_pct_col', 'sex_pct_col',
+    'age_distribution', 'race_percentage', 'sex_distribution',
+    'BaselineRegistry', 'DEFAULT_REGISTRY', 'record_years', 'population_shares_by_year',
+    'add_population_share_by_year',
+]
@@ -0,0 +1,39 @@
+"""
+Charts of the hypotheses, heatmap tiles and folium layers.
+
+matplotlib and folium are only imported when one of these functions is first accessed.
+"""
+import importlib
+
+# Name -> module defining it
+_EXPORTS = {
+    'bar_chart': 'render_graphs',
+    'pie_chart': 'render_graphs',
+    'histogram_chart': 'render_graphs',
+    'render_charts': 'render_graphs',
+    'colorize': 'heatmap_tiles',
+    'render_tiles': 'heatmap_tiles',
+    'add_tile_layer': 'heatmap_tiles',
+    'add_multi_resolution_heatmap': 'heatmap_utils',
+}
+
+__all__ = list(_EXPORTS)
+
+
+# This function imports the module defining a name when the name is first accessed
+def __getattr__(name):
+    """
+    >>> import subprocess, sys
+    >>> code = 'import sys; from nypd_analysis.plot import render_tiles; print("matplotlib.pyplot" in sys.modules)'
+    >>> subprocess.run([sys.executable, '-c', code], capture_output=True, text=True).stdout
+    'False\\n'
+    """
+    if name not in _EXPORTS:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,10 @@
+"""
+Significance tests and confidence intervals of the aggregated tables.
+"""
+from inference import (chi2_sf, flag_independence_test, goodness_of_fit, pairwise_proportion_tests,
+                       probability_intervals, proportion_intervals)
+
+__all__ = [
+    'goodness_of_fit', 'flag_independence_test', 'pairwise_proportion_tests', 'proportion_intervals',
+    'probability_intervals', 'chi2_sf',
+]
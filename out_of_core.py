@@ -0,0 +1,187 @@
+"""
+Out-of-core execution backends for the grouped aggregations of the hypotheses.
+
+grouped_population_values and flag_probabilities accept the path of a CSV or Parquet file instead of a
+dataframe. The file is then never loaded as a whole: one of the backends below streams it and only returns
+the record and 'Y' counts per demographic group (the flag_counts format). The population share lookup,
+normalization and proportions are computed from those counts by the same code as for a dataframe, so the
+result frames are identical whichever path was taken.
+
+Backends:
+'arrow'  : pyarrow datasets, scanning the projected columns in record batches and grouping every batch with
+           the Arrow compute kernels (the default, pyarrow is already used by the cache in data_loading.py)
+'duckdb' : an embedded DuckDB query (GROUP BY over read_csv/read_parquet), which spills to disk on its own;
+           requires the optional duckdb package
+'pandas' : pandas chunks (read_csv with chunksize, Parquet row groups), grouped with flag_counts
+
+Counts of the chunks or batches are added up with merge_counts, so memory only depends on the number of
+groups and the batch size.
+"""
+import functools
+import importlib.util
+import os
+
+import pandas as pd
+
+from data_loading import DEFAULT_CHUNKSIZE
+from data_schema import canonical_counts
+from Functions_and_Doctests import _group_and_flag_names, flag_counts, merge_counts
+from instrumentation import instrumented
+
+DEFAULT_BACKEND = 'arrow'
+
+
+# This function tells whether a file is read with the Parquet or the CSV reader
+def _is_parquet(path):
+    return os.path.splitext(str(path))[1].lower() in ('.parquet', '.pq')
+
+
+# This function counts the records of a file with pandas chunks
+def _pandas_counts(path, group_cols, flag_cols, chunksize):
+    columns = group_cols + list(flag_cols)
+    if _is_parquet(path):
+        import pyarrow.parquet as pq
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(chunksize, columns=columns))
+    else:
+        chunks = pd.read_csv(path, usecols=columns, chunksize=chunksize)
+    counts = merge_counts(flag_counts(chunk, group_cols, flag_cols) for chunk in chunks)
+    # pandas reads an integer column with missing values as float, those records are not counted, so the
+    # group keys go back to integers like the ones of the arrow and duckdb backends
+    levels = [counts.index.get_level_values(i) for i in range(counts.index.nlevels)]
+    integral = [level.dtype.kind == 'f' and bool((level % 1 == 0).all()) for level in levels]
+    if any(integral):
+        levels = [level.astype('int64') if whole else level for level, whole in zip(levels, integral)]
+        counts.index = pd.MultiIndex.from_arrays(levels) if len(levels) > 1 else levels[0]
+    return counts
+
+
+# This function counts the records of a file with the Arrow dataset scanner and compute kernels
+def _arrow_counts(path, group_cols, flag_cols, chunksize):
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv
+    import pyarrow.dataset as ds
+
+    if _is_parquet(path):
+        file_format = ds.ParquetFileFormat()
+    else:
+        # Empty strings are missing values for pandas, Arrow only treats them so when asked to
+        file_format = ds.CsvFileFormat(convert_options=pyarrow.csv.ConvertOptions(strings_can_be_null=True))
+    dataset = ds.dataset(str(path), format=file_format)
+    count_cols = ['COUNT_' + name + '_Y' for name in flag_cols.values()]
+
+    def batch_counts():
+        for batch in dataset.to_batches(columns=group_cols + list(flag_cols), batch_size=chunksize):
+            table = pa.Table.from_batches([batch])
+            # Like pandas, records with a missing group label are not counted
+            valid = functools.reduce(pc.and_kleene, [pc.is_valid(table[col]) for col in group_cols])
+            table = table.filter(valid)
+            for flag, count_col in zip(flag_cols, count_cols):
+                values = table[flag]
+                flagged = values if pa.types.is_boolean(values.type) else pc.equal(values.cast(pa.string()), 'Y')
+                table = table.append_column(count_col, pc.fill_null(flagged, False).cast(pa.int64()))
+            grouped = table.group_by(group_cols).aggregate([(col, 'sum') for col in count_cols] +
+                                                          [([], 'count_all')])
+            counts = grouped.to_pandas().rename(columns={'count_all': 'COUNT_T'})
+            counts = counts.rename(columns={col + '_sum': col for col in count_cols})
+            yield counts.set_index(group_cols)[['COUNT_T'] + count_cols]
+
+    return merge_counts(batch_counts())
+
+
+# This function counts the records of a file with an embedded DuckDB query
+def _duckdb_counts(path, group_cols, flag_cols, chunksize):
+    try:
+        import duckdb
+    except ImportError as error:
+        raise ImportError('The duckdb backend requires duckdb, install it with "pip install duckdb"') from error
+
+    def quoted(name):
+        return '"' + name.replace('"', '""') + '"'
+
+    literal = "'" + str(path).replace("'", "''") + "'"
+    # Like pandas, numbers are read as integers or floats and everything else (dates, times) as text
+    source = 'read_parquet({})' if _is_parquet(path) else \
+        "read_csv({}, header=true, auto_type_candidates=['BOOLEAN', 'BIGINT', 'DOUBLE', 'VARCHAR'])"
+    flags = ''.join(", SUM(CASE WHEN CAST({} AS VARCHAR) IN ('Y', 'true') THEN 1 ELSE 0 END) AS {}"
+                    .format(quoted(flag), quoted('COUNT_' + name + '_Y')) for flag, name in flag_cols.items())
+    keys = ', '.join(quoted(col) for col in group_cols)
+    valid = ' AND '.join(quoted(col) + ' IS NOT NULL' for col in group_cols)
+    query = 'SELECT {}, COUNT(*) AS "COUNT_T"{} FROM {} WHERE {} GROUP BY {}'.format(
+        keys, flags, source.format(literal), valid, keys)
+    with duckdb.connect() as connection:
+        counts = connection.execute(query).df()
+    return merge_counts([counts.set_index(group_cols).astype('int64')])
+
+
+BACKENDS = {'arrow': _arrow_counts, 'duckdb': _duckdb_counts, 'pandas': _pandas_counts}
+
+
+# This function lists the backends whose dependencies are installed
+def available_backends():
+    """
+    :return: Names of the backends which can run in this environment
+    """
+    modules = {'arrow': 'pyarrow', 'duckdb': 'duckdb', 'pandas': 'pandas'}
+    return [name for name in BACKENDS if importlib.util.find_spec(modules[name]) is not None]
+
+
+# This function counts the records and 'Y' flags per group of a file without loading it
+@instrumented
+def file_group_counts(path, group_cols, flag_cols=(), backend=None, chunksize=DEFAULT_CHUNKSIZE, schema=None):
+    """
+    This function returns the same count table as flag_counts (COUNT_T and one COUNT_<NAME>_Y column per
+    flag, indexed by the groups) for the records of a CSV or Parquet file, computed out of core.
+
+    The labels are taken as they appear in the file. When a schema is given the labels are converted the
+    way data_schema.apply_schema converts them (aliases resolved, canonical order) after counting.
+
+    :param path: Path of the CSV or Parquet file
+    :param group_cols: Demographic column name, or list of column names, to group by
+    :param flag_cols: Flag column name, list of names or dictionary of short names (see flag_probabilities)
+    :param backend: 'arrow', 'duckdb' or 'pandas', DEFAULT_BACKEND when None
+    :param chunksize: Number of rows per batch or chunk (not used by the duckdb backend)
+    :param schema: Optional dataset schema applied to the group labels
+    :return: Count dataframe indexed by the demographic groups
+
+    >>> counts = file_group_counts('dummy_doctest_files/Arrests_sample.csv', 'PERP_SEX', backend='pandas')
+    >>> counts.reset_index()
+      PERP_SEX  COUNT_T
+    0        F        2
+    1        M        4
+
+    Every available backend returns the same counts as flag_counts on the loaded file:
+
+    >>> path = 'dummy_doctest_files/Complaints_sample.csv'
+    >>> expected = flag_counts(pd.read_csv(path), ['SUSP_SEX', 'SUSP_RACE'], [])
+    >>> all(file_group_counts(path, ['SUSP_SEX', 'SUSP_RACE'], backend=name, chunksize=2).equals(expected)
+    ...     for name in available_backends())
+    True
+    >>> group_cols = ['SUSP_SEX', 'SUSP_RACE', 'BORO_NM']
+    >>> expected = flag_counts(pd.read_csv(path), group_cols, [])
+    >>> file_group_counts(path, group_cols, backend='arrow', chunksize=2).equals(expected)
+    True
+
+    The duckdb backend is only checked when duckdb is installed:
+
+    >>> 'duckdb' not in available_backends() or file_group_counts(path, group_cols, backend='duckdb').equals(expected)
+    True
+
+    Numeric group keys come back as integers from every backend, also when some records have no key:
+
+    >>> group_cols = ['ADDR_PCT_CD', 'KY_CD', 'SUSP_SEX']
+    >>> results = [file_group_counts(path, group_cols, backend=name, chunksize=2) for name in available_backends()]
+    >>> results[0].index.dtypes
+    ADDR_PCT_CD    int64
+    KY_CD          int64
+    SUSP_SEX         str
+    dtype: object
+    >>> for result in results[1:]:
+    ...     pd.testing.assert_frame_equal(result, results[0])
+    """
+    group_cols, flag_cols = _group_and_flag_names(group_cols, flag_cols)
+    backend = DEFAULT_BACKEND if backend is None else backend
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend {!r}, choose from {}'.format(backend, list(BACKENDS)))
+    counts = BACKENDS[backend](path, group_cols, flag_cols, chunksize)
+    return counts if schema is None else canonical_counts(counts, schema)
@@ -0,0 +1,218 @@
+"""
+Batch execution of every hypothesis of PR_All_Hypotheses_Final.ipynb across a pool of worker processes.
+
+Each dataset (arrests, complaints, stop, question and frisk) is converted once into a memory-mapped Arrow
+file holding only the columns the hypotheses need (data_loading.arrow_cache). The file is then split into
+row ranges, and every worker maps the file, converts its own range and computes the partial counts of all
+the hypotheses on that dataset in a single pass: group sizes for the population hypotheses, flag_counts for
+the frisk/arrest probabilities and report_lag_histograms for the report lag. Workers only receive the path
+and the row range, and only send back the small count tables; no dataframe is ever pickled between
+processes. The driver adds the partial counts up with merge_counts, which is exact, and turns them into the
+same tables as the sequential functions.
+
+Usage (from the directory holding the 2019 extracts, or with NYPD_DATA_DIR naming it):
+    python parallel_hypotheses.py --workers 8
+    python parallel_hypotheses.py --hypotheses age report_lag --partition-rows 500000
+"""
+import argparse
+import functools
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from data_loading import (ARRESTS_FILE, COMPLAINTS_FILE, SQF_FILE, arrow_cache, arrow_num_rows, data_path,
+                          read_arrow, read_arrests_chunks, read_complaints_chunks)
+from data_schema import ARRESTS_SCHEMA, COMPLAINTS_SCHEMA, SQF_SCHEMA, apply_schema, canonical_counts
+from Functions_and_Doctests import (flag_counts, flag_probabilities_from_counts, merge_counts,
+                                    population_values_from_counts)
+from hypothesis_pipeline import SHARES_BY_COLUMN
+from report_lag import merge_report_lag_histograms, report_lag_histograms
+
+# Default number of rows handed to a worker at a time
+DEFAULT_PARTITION_ROWS = 1_000_000
+
+# Outcome flags of hypotheses 2 and 3
+SQF_FLAGS = ('FRISKED_FLAG', 'SUSPECT_ARRESTED_FLAG')
+
+# Dataset of every hypothesis, the kind of counts it needs and the demographic column it is grouped by
+HYPOTHESES = {
+    'age': ('arrests', 'population', 'AGE_GROUP'),
+    'sex': ('sqf', 'flags', 'SUSPECT_SEX'),
+    'race': ('sqf', 'flags', 'SUSPECT_RACE_DESCRIPTION'),
+    'report_lag': ('complaints', 'report_lag', None),
+}
+
+# Default source file and schema of every dataset
+DATASETS = {
+    'arrests': (ARRESTS_FILE, ARRESTS_SCHEMA),
+    'complaints': (COMPLAINTS_FILE, COMPLAINTS_SCHEMA),
+    'sqf': (SQF_FILE, SQF_SCHEMA),
+}
+
+# Name of the population share column of the population hypotheses
+POPULATION_PCT_COLUMNS = {'AGE_GROUP': 'POP_BY_AGE_PCT'}
+
+
+# This function returns the columns a hypothesis reads
+def _hypothesis_columns(kind, col):
+    if kind == 'population':
+        return [col]
+    if kind == 'flags':
+        return [col, *SQF_FLAGS]
+    return ['CMPLNT_FR_DT', 'RPT_DT']
+
+
+# This function returns the function parsing the needed columns of a dataset for the Arrow cache
+def _source_reader(dataset, columns):
+    if dataset == 'arrests':
+        return functools.partial(read_arrests_chunks, columns)
+    if dataset == 'complaints':
+        return functools.partial(read_complaints_chunks, columns)
+    return lambda path: pd.read_excel(path, usecols=columns)
+
+
+# This function computes the partial counts of a kind of hypothesis on one partition
+def _partial_counts(df, kind, col):
+    if kind == 'population':
+        return df.groupby(col, sort=True, observed=True).size()
+    if kind == 'flags':
+        return flag_counts(df, col, list(SQF_FLAGS))
+    return report_lag_histograms(df)
+
+
+# This function is run by the worker processes: it reads one row range and counts it for every hypothesis
+def _count_partition(cache_file, start, stop, columns, schema, tasks):
+    df = apply_schema(read_arrow(cache_file, columns, start, stop), schema)
+    return {name: _partial_counts(df, kind, col) for name, kind, col in tasks}
+
+
+# This function turns the merged counts of a hypothesis into its result table
+def _finalize(kind, col, partials, schema):
+    if kind == 'report_lag':
+        return merge_report_lag_histograms(partials)
+    counts = canonical_counts(merge_counts(partials), schema)
+    if kind == 'population':
+        return population_values_from_counts(counts, col, SHARES_BY_COLUMN[col], POPULATION_PCT_COLUMNS[col])
+    return flag_probabilities_from_counts(counts, shares={col: SHARES_BY_COLUMN[col]})
+
+
+# This function splits a number of rows into contiguous row ranges
+def partition_ranges(rows, partition_rows=DEFAULT_PARTITION_ROWS, workers=1):
+    """
+    This function splits the rows of a dataset into contiguous [start, stop) ranges of at most partition_rows
+    rows, using at least as many ranges as there are workers so that none of them stays idle.
+
+    :param rows: Number of rows of the dataset
+    :param partition_rows: Maximum number of rows per range
+    :param workers: Number of worker processes
+    :return: List of (start, stop) tuples
+
+    >>> partition_ranges(10, partition_rows=4)
+    [(0, 4), (4, 8), (8, 10)]
+    >>> partition_ranges(10, workers=2)
+    [(0, 5), (5, 10)]
+    """
+    parts = max(math.ceil(rows / partition_rows), min(workers, rows), 1)
+    size = math.ceil(rows / parts)
+    return [(start, min(start + size, rows)) for start in range(0, rows, size)] or [(0, 0)]
+
+
+# This function runs the selected hypotheses over partitions of their datasets in worker processes
+def run_all_hypotheses(sources=None, workers=None, partition_rows=DEFAULT_PARTITION_ROWS, hypotheses=None,
+                       cache_dir=None):
+    """
+    This function computes the results of the selected hypotheses, each dataset being split into row ranges
+    which are counted in parallel. Hypotheses whose source file does not exist are skipped.
+
+    The results are the same tables as the sequential functions return: the grouped_population_values table
+    for 'age', the flag_probabilities table (PROB_FRISKED and PROB_SUSPECT_ARRESTED) for 'sex' and 'race',
+    and the report_lag_histograms dictionary for 'report_lag'.
+
+    Requires the optional pyarrow dependency.
+
+    :param sources: Optional dictionary mapping 'arrests', 'complaints' and 'sqf' to their source files,
+                    the default 2019 files of data_path are used for the datasets it leaves out
+    :param workers: Number of worker processes, all the cores when None; 1 counts in the calling process
+    :param partition_rows: Maximum number of rows per partition
+    :param hypotheses: Names of the hypotheses to run (keys of HYPOTHESES), all of them when None
+    :param cache_dir: Directory holding the Arrow files, defaults to .nypd_cache next to every source
+    :return: Dictionary mapping the hypothesis names to their results
+
+    >>> import shutil, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> sources = {'arrests': 'dummy_doctest_files/Arrests_sample.csv',
+    ...            'complaints': 'dummy_doctest_files/Complaints_sample.csv', 'sqf': 'missing.xlsx'}
+    >>> results = run_all_hypotheses(sources, workers=2, partition_rows=2, cache_dir=tmp)
+    >>> sorted(results)
+    ['age', 'report_lag']
+    >>> results['age'][['AGE_GROUP', 'COUNT', 'PROP_VALUES']]
+      AGE_GROUP  COUNT  PROP_VALUES
+    0       <18      1        12.12
+    1     18-24      1        45.45
+    2     25-44      3        33.33
+    3     45-64      1         9.09
+    >>> results['report_lag']['DIFF_MONTHS'].equals(
+    ...     run_all_hypotheses(sources, workers=1, cache_dir=tmp)['report_lag']['DIFF_MONTHS'])
+    True
+    >>> shutil.rmtree(tmp)
+    """
+    sources = dict({dataset: data_path(path) for dataset, (path, _) in DATASETS.items()}, **(sources or {}))
+    hypotheses = list(HYPOTHESES) if hypotheses is None else list(hypotheses)
+    workers = workers or os.cpu_count() or 1
+
+    # All the hypotheses on the same dataset share one projection and one pass over each partition
+    jobs = {}
+    for name in hypotheses:
+        dataset, kind, col = HYPOTHESES[name]
+        if os.path.exists(sources[dataset]):
+            jobs.setdefault(dataset, []).append((name, kind, col))
+
+    partials = {name: [] for tasks in jobs.values() for name, _, _ in tasks}
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        futures = []
+        for dataset, tasks in jobs.items():
+            columns = list(dict.fromkeys(column for _, kind, col in tasks
+                                         for column in _hypothesis_columns(kind, col)))
+            tag = 'columns-' + '-'.join(sorted(columns))
+            cache_file = arrow_cache(sources[dataset], _source_reader(dataset, columns), cache_dir, tag)
+            schema = DATASETS[dataset][1]
+            for start, stop in partition_ranges(arrow_num_rows(cache_file), partition_rows, workers):
+                arguments = (cache_file, start, stop, columns, schema, tasks)
+                futures.append(pool.submit(_count_partition, *arguments) if pool else _count_partition(*arguments))
+        for future in futures:
+            for name, counts in (future.result() if pool else future).items():
+                partials[name].append(counts)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    results = {}
+    for dataset, tasks in jobs.items():
+        for name, kind, col in tasks:
+            results[name] = _finalize(kind, col, partials[name], DATASETS[dataset][1])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data-dir', default=None, help='directory of the extracts, $NYPD_DATA_DIR or the working directory by default')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, all the cores by default')
+    parser.add_argument('--partition-rows', type=int, default=DEFAULT_PARTITION_ROWS)
+    parser.add_argument('--hypotheses', nargs='+', choices=list(HYPOTHESES), default=None)
+    arguments = parser.parse_args()
+
+    paths = {dataset: data_path(path, arguments.data_dir) for dataset, (path, _) in DATASETS.items()}
+    started = time.perf_counter()
+    all_results = run_all_hypotheses(paths, arguments.workers, arguments.partition_rows, arguments.hypotheses)
+    for hypothesis, result in all_results.items():
+        print('== {} =='.format(hypothesis))
+        if isinstance(result, dict):
+            for lag_col, histogram in result.items():
+                print('{}: {:,} complaints over {} distinct lags'.format(lag_col, histogram.sum(), len(histogram)))
+        else:
+            print(result.to_string(index=False))
+    print('finished in {:.1f} s'.format(time.perf_counter() - started))
@@ -0,0 +1,261 @@
+"""
+Registry of population baselines (the share of the population in every age group, race or sex) keyed by
+geography, year and dimension.
+
+The 2019 NYC tables of Functions_and_Doctests.py are registered by default. Baselines for other years or
+cities are loaded from CSV or Parquet files with one row per label:
+
+    GEOGRAPHY,YEAR,DIMENSION,LABEL,SHARE[,VERSION]
+    NYC,2018,sex,MALE,0.4762
+
+The optional VERSION column keeps several revisions of the same table (e.g. census estimates which were
+revised later); the highest version is used unless another one is asked for.
+
+Records are normalized by the baseline of their own year: population_shares_by_year looks every
+(year, label) pair up in one vectorized pass, so a dataset spanning 2010-2023 is handled in a single call
+instead of once per year.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from Functions_and_Doctests import AGE_POPULATION_SHARE, RACE_POPULATION_SHARE, SEX_POPULATION_SHARE, unmapped_fill
+from instrumentation import instrumented
+
+# Geography of the built-in tables
+DEFAULT_GEOGRAPHY = 'NYC'
+
+# Names of the dimensions used by age_pct_col, race_pct_col and sex_pct_col
+AGE = 'age'
+RACE = 'race'
+SEX = 'sex'
+
+BASELINE_COLUMNS = ['GEOGRAPHY', 'YEAR', 'DIMENSION', 'LABEL', 'SHARE']
+
+
+# This function returns the label a table version is stored under. Versions read from a file column with
+# missing values come as floats (2.0) and are stored as the integer they stand for, missing ones as ''
+def _version_label(version):
+    if isinstance(version, float):
+        version = '' if np.isnan(version) else int(version) if version.is_integer() else version
+    return str(version)
+
+
+# This function sorts table versions: unversioned first, then numeric versions by value, then the others
+def _version_key(label):
+    try:
+        return 1, float(label), ''
+    except ValueError:
+        return (0, 0.0, '') if label == '' else (2, 0.0, label)
+
+
+class BaselineRegistry:
+    """
+    Population share tables keyed by (geography, year, dimension), each possibly in several versions.
+    Files are only parsed again when they changed since they were loaded.
+
+    >>> registry = BaselineRegistry()
+    >>> registry.register('NYC', 2019, SEX, SEX_POPULATION_SHARE)
+    >>> registry.shares('NYC', 2019, SEX)
+    {'MALE': 0.4767, 'FEMALE': 0.5233}
+    >>> registry.shares('NYC', 2010, SEX)
+    Traceback (most recent call last):
+    ...
+    KeyError: "No population baseline for ('NYC', 2010, 'sex')"
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._loaded = {}
+
+    def register(self, geography, year, dimension, shares, version=''):
+        """
+        Adds (or replaces) the table of one geography, year and dimension.
+
+        :param geography: Name of the geography, e.g. 'NYC'
+        :param year: Year the shares describe
+        :param dimension: Dimension name, e.g. AGE, RACE or SEX
+        :param shares: Dictionary mapping each label to its share of the total population
+        :param version: Optional version of the table, the highest version is used by default
+        """
+        self._tables.setdefault((geography, int(year), dimension), {})[_version_label(version)] = dict(shares)
+
+    def load(self, path):
+        """
+        Registers every table of a CSV or Parquet baseline file (see the module docstring for the columns).
+        Loading a file which has not changed since the last call is a no-op.
+
+        :param path: Path of the baseline file
+        :return: The registry, so that calls can be chained
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        if self._loaded.get(key) == (stat.st_size, stat.st_mtime_ns):
+            return self
+        if os.path.splitext(path)[1].lower() == '.parquet':
+            baselines = pd.read_parquet(path)
+        else:
+            baselines = pd.read_csv(path)
+        missing = [col for col in BASELINE_COLUMNS if col not in baselines.columns]
+        if missing:
+            raise ValueError('{!r} is missing the baseline column(s) {}'.format(path, missing))
+        if 'VERSION' not in baselines.columns:
+            baselines = baselines.assign(VERSION='')
+        for (geography, year, dimension, version), table in baselines.groupby(
+                ['GEOGRAPHY', 'YEAR', 'DIMENSION', 'VERSION'], sort=False, dropna=False):
+            self.register(geography, year, dimension, zip(table['LABEL'], table['SHARE'].astype('float64')),
+                          version)
+        self._loaded[key] = (stat.st_size, stat.st_mtime_ns)
+        return self
+
+    def years(self, geography, dimension):
+        """
+        :param geography: Name of the geography
+        :param dimension: Dimension name
+        :return: Sorted list of the years with a table for that geography and dimension
+        """
+        return sorted(year for table_geography, year, table_dimension in self._tables
+                      if table_geography == geography and table_dimension == dimension)
+
+    def shares(self, geography, year, dimension, version=None):
+        """
+        :param geography: Name of the geography
+        :param year: Year of the table
+        :param dimension: Dimension name
+        :param version: Version of the table, the highest one when None (numeric versions compare by value)
+        :return: Dictionary mapping each label to its population share
+
+        >>> registry = BaselineRegistry()
+        >>> registry.register('NYC', 2019, SEX, {'MALE': 0.47, 'FEMALE': 0.53}, version=9)
+        >>> registry.register('NYC', 2019, SEX, {'MALE': 0.48, 'FEMALE': 0.52}, version=10)
+        >>> registry.shares('NYC', 2019, SEX), registry.shares('NYC', 2019, SEX, version=9.0)
+        ({'MALE': 0.48, 'FEMALE': 0.52}, {'MALE': 0.47, 'FEMALE': 0.53})
+        """
+        versions = self._tables.get((geography, int(year), dimension))
+        if not versions or (version is not None and _version_label(version) not in versions):
+            raise KeyError('No population baseline for {!r}'.format((geography, int(year), dimension)))
+        return versions[max(versions, key=_version_key) if version is None else _version_label(version)]
+
+
+# Registry used when no other one is passed, holding the 2019 NYC tables
+DEFAULT_REGISTRY = BaselineRegistry()
+DEFAULT_REGISTRY.register(DEFAULT_GEOGRAPHY, 2019, AGE, AGE_POPULATION_SHARE)
+DEFAULT_REGISTRY.register(DEFAULT_GEOGRAPHY, 2019, RACE, RACE_POPULATION_SHARE)
+DEFAULT_REGISTRY.register(DEFAULT_GEOGRAPHY, 2019, SEX, SEX_POPULATION_SHARE)
+
+
+# This function turns a year or date column into integer years
+def record_years(series):
+    """
+    This function returns the year of every record. Date columns (datetimes, or strings in the mm/dd/yyyy
+    format of the NYPD extracts) are reduced to their year, numeric columns are taken as years already.
+
+    :param series: Year or date column
+    :return: Series of years (float, missing dates become NaN)
+
+    >>> record_years(pd.Series(['01/26/2019', '12/31/2018', None])).tolist()
+    [2019.0, 2018.0, nan]
+    """
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.astype('float64')
+    if not pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = pd.to_datetime(series, format='%m/%d/%Y', errors='coerce')
+    return series.dt.year.astype('float64')
+
+
+# This function looks up the population share of every record in the baseline of the record's own year
+@instrumented
+def population_shares_by_year(values, years, dimension, geography=DEFAULT_GEOGRAPHY, registry=None,
+                              unmapped='nan'):
+    """
+    This function is the multi-year counterpart of population_share_lookup. The labels and the years are
+    factorized separately, a small (year x label) matrix of shares is filled from the registry, and the share
+    of every record is gathered from it with one NumPy indexing step.
+
+    Records whose year has no baseline, or whose label is not in the baseline of its year, follow the
+    unmapped policy of population_share_lookup ('nan', 'raise' or a positive fill value).
+
+    :param values: Series of demographic labels
+    :param years: Series of years (or dates, see record_years) aligned to values
+    :param dimension: Dimension name, e.g. AGE, RACE or SEX
+    :param geography: Name of the geography
+    :param registry: BaselineRegistry to read from, DEFAULT_REGISTRY when None
+    :param unmapped: Policy for records without a share - 'nan', 'raise' or a positive fill value
+    :return: Float series of population shares, aligned to the index of values
+
+    >>> registry = BaselineRegistry().load('dummy_doctest_files/Population_baselines.csv')
+    >>> population_shares_by_year(pd.Series(['MALE', 'FEMALE', 'MALE', 'MALE']), pd.Series([2018, 2020, 2020, 2015]),
+    ...                           SEX, registry=registry)
+    0    0.4762
+    1    0.5229
+    2    0.4771
+    3       NaN
+    dtype: float64
+    >>> population_shares_by_year(pd.Series(['MALE']), pd.Series([2015]), SEX, registry=registry, unmapped='raise')
+    Traceback (most recent call last):
+    ...
+    ValueError: No population baseline for year(s) [2015]
+    """
+    registry = DEFAULT_REGISTRY if registry is None else registry
+    if not isinstance(values, pd.Series):
+        values = pd.Series(values)
+    years = record_years(pd.Series(years, index=values.index) if not isinstance(years, pd.Series) else years)
+
+    fill = unmapped_fill(unmapped)
+
+    label_codes, labels = pd.factorize(values)
+    year_codes, year_uniques = pd.factorize(years)
+    known_years = set(registry.years(geography, dimension))
+    tables = [registry.shares(geography, year, dimension) if year in known_years else None
+              for year in year_uniques]
+
+    # The trailing row and column of fill values are picked up by the -1 codes of missing years and labels
+    matrix = np.full((len(year_uniques) + 1, len(labels) + 1), fill)
+    for row, table in enumerate(tables):
+        if table is not None:
+            matrix[row, :-1] = [table.get(label, fill) for label in labels]
+    shares = matrix[year_codes, label_codes]
+
+    if unmapped == 'raise' and np.isnan(shares).any():
+        unmatched = np.isnan(shares)
+        without_table = np.append([table is None for table in tables], True)[year_codes] & unmatched
+        if without_table.any():
+            missing_years = sorted({int(year) for year in years[without_table].dropna()})
+            raise ValueError('No population baseline for year(s) {}'.format(missing_years or [None]))
+        missing = sorted(set(values[unmatched].dropna()), key=str)
+        raise ValueError('No population share found for label(s): {}'.format(missing or [None]))
+    return pd.Series(shares, index=values.index, copy=False)
+
+
+# This function appends a population share column looked up by the year of every record
+@instrumented
+def add_population_share_by_year(df, col, year_col, dimension, new_col, geography=DEFAULT_GEOGRAPHY,
+                                 registry=None, unmapped='nan', inplace=False):
+    """
+    This function adds a population share column to a dataframe, taking the share of every record from the
+    baseline of the record's own year. It is what age_pct_col, race_pct_col and sex_pct_col do when they are
+    given a year column. Like add_population_share, the column is added to a shallow copy of df unless
+    inplace is True.
+
+    :param df: Dataframe to which the population share column has to be appended
+    :param col: Column holding the demographic labels
+    :param year_col: Column holding the year or the date of every record
+    :param dimension: Dimension name, e.g. AGE, RACE or SEX
+    :param new_col: Name of the population share column to be added
+    :param geography: Name of the geography
+    :param registry: BaselineRegistry to read from, DEFAULT_REGISTRY when None
+    :param unmapped: Policy for records without a share (see population_shares_by_year)
+    :param inplace: Whether the column is added to df itself instead of a shallow copy
+    :return: Dataframe with the added population share column
+
+    >>> df = pd.DataFrame({'AGE_GROUP': ['<18', '65+'], 'ARREST_DATE': ['01/26/2019', '12/31/2019']})
+    >>> add_population_share_by_year(df, 'AGE_GROUP', 'ARREST_DATE', AGE, 'POP_BY_AGE_PCT')
+      AGE_GROUP ARREST_DATE  POP_BY_AGE_PCT
+    0       <18  01/26/2019           0.232
+    1       65+  12/31/2019           0.170
+    """
+    shares = population_shares_by_year(df[col], df[year_col], dimension, geography, registry, unmapped)
+    result = df if inplace else df.copy(deep=False)
+    result[new_col] = shares
+    return result
@@ -0,0 +1,325 @@
+"""
+Headless regeneration of the hypothesis charts in Graphs/ without running the notebook.
+
+Every dataset is loaded once and all the hypotheses on it are counted together (parallel_hypotheses), then
+the charts are drawn on plain matplotlib Figure objects, which render through the Agg backend and need no
+display, in a pool of worker processes. Only the small result tables are sent to the workers.
+
+A chart is skipped when neither its inputs nor the code drawing it changed since it was last written: the
+fingerprint of every chart (size and modification time of its source file plus a hash of the modules
+computing and drawing it) is stored in Graphs/.render_fingerprints.json. Hypotheses whose charts are all up
+to date are not even computed. A timing summary of every stage is printed at the end.
+
+The value count tables, heatmaps and animations of Graphs/ are screenshots of notebook output and of the
+folium maps (see PR_FutureScope_FinalProject.py), so they are not regenerated here.
+
+Usage (from the directory holding the 2019 extracts, or with NYPD_DATA_DIR naming it):
+    python render_graphs.py --data-dir D:/Downloads --workers 8
+    python render_graphs.py --force Hyp4_Week.png
+"""
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.figure import Figure
+
+import data_loading
+import data_schema
+import Functions_and_Doctests
+import hypothesis_pipeline
+import parallel_hypotheses
+import population_baselines
+import report_lag
+from data_loading import data_path
+from instrumentation import instrumented
+from parallel_hypotheses import DATASETS, HYPOTHESES, run_all_hypotheses
+
+# Directory the charts are written to
+GRAPHS_DIR = 'Graphs'
+
+# File (inside the output directory) recording the fingerprint of every chart written
+FINGERPRINTS_FILE = '.render_fingerprints.json'
+
+HYP1_TITLE = ('Hypothesis 1 - A larger proportion of individuals who are arrested for the crime they commit are '
+              'in the age group of 25 - 44')
+
+
+# This function draws a bar chart of one column of a result table against another
+@instrumented
+def bar_chart(table, path, x, y, title, xlabel, ylabel, decimals=None):
+    """
+    This function draws the bar charts of hypotheses 1 to 3 the same way the notebook does.
+
+    :param table: Result dataframe
+    :param path: Path of the PNG file to write
+    :param x: Column holding the bar labels
+    :param y: Column holding the bar heights
+    :param title: Chart title
+    :param xlabel: Label of the x axis
+    :param ylabel: Label of the y axis
+    :param decimals: Optional number of decimals the heights are rounded to
+    """
+    figure = Figure(figsize=(15, 9))
+    ax = figure.subplots()
+    ax.bar(table[x].astype(str), table[y] if decimals is None else table[y].round(decimals))
+    ax.set_title(title, fontsize=18)
+    ax.set_xlabel(xlabel, fontsize=15)
+    ax.set_ylabel(ylabel, fontsize=15)
+    figure.savefig(path)
+
+
+# This function draws the proportional values of a result table as a pie chart
+@instrumented
+def pie_chart(table, path, labels, sizes, title, legend_title, explode):
+    """
+    This function draws the pie chart of hypothesis 1 the same way the notebook does.
+
+    :param table: Result dataframe
+    :param path: Path of the PNG file to write
+    :param labels: Column holding the wedge labels
+    :param sizes: Column holding the wedge sizes
+    :param title: Chart title
+    :param legend_title: Title of the legend
+    :param explode: Offset of every wedge, repeated if the table has more rows
+    """
+    figure = Figure(figsize=(15, 9))
+    ax = figure.subplots()
+    explode = [explode[min(i, len(explode) - 1)] for i in range(len(table))]
+    wedges, _, autotexts = ax.pie(table[sizes], explode=explode, labels=table[labels].astype(str),
+                                  autopct='%1.1f%%', shadow=True, startangle=90)
+    ax.axis('equal')
+    ax.legend(wedges, table[labels].astype(str), title=legend_title, loc='center left')
+    for autotext in autotexts:
+        autotext.set_size(15)
+        autotext.set_weight('bold')
+    ax.set_title(title + '\n', fontsize=18)
+    figure.savefig(path)
+
+
+# This function draws a report lag histogram as a bar chart
+@instrumented
+def histogram_chart(histogram, path, title, xlabel, ylabel):
+    """
+    This function draws the report lag charts of hypothesis 4 (one bar per lag) the same way the notebook does.
+
+    :param histogram: Count series indexed by the lag
+    :param path: Path of the PNG file to write
+    :param title: Chart title
+    :param xlabel: Label of the x axis
+    :param ylabel: Label of the y axis
+    """
+    figure = Figure(figsize=(15, 9))
+    ax = figure.subplots()
+    histogram = histogram.sort_index()
+    ax.bar(range(len(histogram)), histogram.to_numpy())
+    ax.set_xticks(range(len(histogram)), [str(lag) for lag in histogram.index])
+    ax.set_title(title, fontsize=18)
+    ax.set_xlabel(xlabel, fontsize=15)
+    ax.set_ylabel(ylabel, fontsize=15)
+    figure.savefig(path)
+
+
+# Chart file name -> (hypothesis, drawing function, result part to draw or None for the whole table, arguments)
+CHARTS = {
+    'Hyp1_NormValues.png': ('age', bar_chart, None, {
+        'x': 'AGE_GROUP', 'y': 'NORM_VALUES', 'title': HYP1_TITLE,
+        'xlabel': 'Age Group', 'ylabel': 'Normalized Values'}),
+    'Hyp1_PropValues.png': ('age', bar_chart, None, {
+        'x': 'AGE_GROUP', 'y': 'PROP_VALUES', 'title': HYP1_TITLE,
+        'xlabel': 'Age Group', 'ylabel': 'Proportional Values'}),
+    'Hyp1_PropPie.png': ('age', pie_chart, None, {
+        'labels': 'AGE_GROUP', 'sizes': 'PROP_VALUES', 'title': HYP1_TITLE,
+        'legend_title': 'Age Groups', 'explode': (0.1, 0.1, 0.1, 0.2, 0.3)}),
+    'Hyp2_A_ProbFrisk.png': ('sex', bar_chart, None, {
+        'x': 'SUSPECT_SEX', 'y': 'PROB_FRISKED',
+        'title': 'Hypothesis 2 (A) - Probablity of being frisked - By Sex',
+        'xlabel': 'Sex', 'ylabel': 'Probability', 'decimals': 2}),
+    'Hyp2_A_ProbArrest.png': ('sex', bar_chart, None, {
+        'x': 'SUSPECT_SEX', 'y': 'PROB_SUSPECT_ARRESTED',
+        'title': 'Hypothesis 2 (B) - Probablity of being Arrested - By Sex',
+        'xlabel': 'Sex', 'ylabel': 'Probability'}),
+    'Hyp3_B_Prob_Frisk.png': ('race', bar_chart, None, {
+        'x': 'SUSPECT_RACE_DESCRIPTION', 'y': 'PROB_FRISKED',
+        'title': 'Hypothesis 3 (A) - Probablity of being frisked by Race',
+        'xlabel': 'Race', 'ylabel': 'Probability', 'decimals': 2}),
+    'Hyp3_A_Prob_Arrest.png': ('race', bar_chart, None, {
+        'x': 'SUSPECT_RACE_DESCRIPTION', 'y': 'PROB_SUSPECT_ARRESTED',
+        'title': 'Hypothesis 3 (B) - Probablity of being Arrested - By Race',
+        'xlabel': 'Race', 'ylabel': 'Probability'}),
+    'Hyp4_Week.png': ('report_lag', histogram_chart, 'DIFF_WEEKS', {
+        'title': 'Hypothesis 4 - Complaint for a commited crime is reported in the same week',
+        'xlabel': 'Number of weeks after the crime', 'ylabel': 'Number of Complaints reported'}),
+    'Hyp4_Month.png': ('report_lag', histogram_chart, 'DIFF_MONTHS', {
+        'title': 'Hypothesis 4 - Complaint for a commited crime is reported in the same month',
+        'xlabel': 'Number of months after the crime', 'ylabel': 'Number of Complaints reported'}),
+}
+
+# Modules whose code decides what the charts look like
+CHART_MODULES = [Functions_and_Doctests, data_loading, data_schema, report_lag, parallel_hypotheses,
+                 hypothesis_pipeline, population_baselines, sys.modules[__name__]]
+
+
+# This function hashes the code computing and drawing the charts
+def code_fingerprint(modules=None):
+    """
+    This function returns a hash of the source code of the modules computing and drawing the charts, so that
+    any change to them invalidates every chart.
+
+    :param modules: Modules to hash, CHART_MODULES when None
+    :return: Hexadecimal digest
+
+    >>> code_fingerprint([report_lag]) == code_fingerprint([report_lag]) != code_fingerprint([data_schema])
+    True
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for module in CHART_MODULES if modules is None else modules:
+        hasher.update(inspect.getsource(module).encode())
+    return hasher.hexdigest()
+
+
+# This function computes the fingerprint of one chart
+def chart_fingerprint(name, sources, code, results=None):
+    """
+    This function describes everything a chart depends on: its name and drawing arguments, the size and
+    modification time of the source file of its hypothesis, and the code fingerprint. When the result of the
+    hypothesis is supplied instead of computed from the source, the content of the result is described too,
+    since it may change without the source file changing (another baseline, registry or filter).
+
+    :param name: Chart file name (key of CHARTS)
+    :param sources: Dictionary mapping the datasets to their source files
+    :param code: Result of code_fingerprint
+    :param results: Optional dictionary of hypothesis results already computed (see render_charts)
+    :return: Hexadecimal digest, or None when the source file does not exist
+
+    >>> import pandas as pd
+    >>> sources = {'arrests': 'dummy_doctest_files/Arrests_sample.csv'}
+    >>> table = pd.DataFrame({'AGE_GROUP': ['<18', '25-44'], 'PROP_VALUES': [40.0, 60.0]})
+    >>> fingerprints = [chart_fingerprint('Hyp1_PropPie.png', sources, 'code', results) for results in
+    ...                 [None, {'age': table}, {'age': table.assign(PROP_VALUES=[50.0, 50.0])}]]
+    >>> len(set(fingerprints))
+    3
+    """
+    hypothesis, _, part, arguments = CHARTS[name]
+    path = sources[HYPOTHESES[hypothesis][0]]
+    if not os.path.exists(path):
+        return None
+    stat = data_loading.source_fingerprint(path, with_hash=False)
+    supplied = None
+    if results is not None and hypothesis in results:
+        data = results[hypothesis] if part is None else results[hypothesis][part]
+        supplied = hypothesis_pipeline.fingerprint(data)
+    description = json.dumps([name, part, repr(sorted(arguments.items())), os.path.abspath(path),
+                              stat['size'], stat['mtime_ns'], code, supplied])
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+# This function draws one chart, it is run by the worker processes
+def _render(name, data, path):
+    started = time.perf_counter()
+    _, draw, _, arguments = CHARTS[name]
+    draw(data, path, **arguments)
+    return name, time.perf_counter() - started
+
+
+# This function regenerates the charts whose inputs or code changed
+def render_charts(sources=None, output_dir=GRAPHS_DIR, workers=None, charts=None, force=False, results=None):
+    """
+    This function computes the hypotheses behind the selected charts and redraws the charts in worker
+    processes. Charts whose fingerprint is unchanged (and whose file still exists) are skipped unless force
+    is set, and charts whose source file is missing are skipped as well.
+
+    :param sources: Optional dictionary mapping 'arrests', 'complaints' and 'sqf' to their source files
+    :param output_dir: Directory the PNG files are written to
+    :param workers: Number of worker processes, all the cores when None; 1 draws in the calling process
+    :param charts: Names of the charts to consider (keys of CHARTS), all of them when None
+    :param force: Whether up-to-date charts are redrawn anyway
+    :param results: Optional dictionary of hypothesis results already computed (e.g. by
+                    incremental.IncrementalCounts.hypothesis_results), which are drawn instead of computed
+    :return: Dictionary with the 'rendered', 'skipped' and 'missing' chart names and the 'timings' of every stage
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> sources = {'arrests': 'dummy_doctest_files/Arrests_sample.csv', 'sqf': 'missing.xlsx',
+    ...            'complaints': 'dummy_doctest_files/Complaints_sample.csv'}
+    >>> charts = ['Hyp1_PropPie.png', 'Hyp4_Week.png', 'Hyp2_A_ProbFrisk.png']
+    >>> summary = render_charts(sources, tmp, workers=2, charts=charts)
+    >>> summary['rendered'], summary['missing']
+    (['Hyp1_PropPie.png', 'Hyp4_Week.png'], ['Hyp2_A_ProbFrisk.png'])
+    >>> render_charts(sources, tmp, workers=1, charts=charts)['skipped']
+    ['Hyp1_PropPie.png', 'Hyp4_Week.png']
+    >>> shutil.rmtree(tmp)
+    """
+    sources = dict({dataset: data_path(path) for dataset, (path, _) in DATASETS.items()}, **(sources or {}))
+    charts = list(CHARTS) if charts is None else list(charts)
+    workers = workers or os.cpu_count() or 1
+    timings = {}
+    os.makedirs(output_dir, exist_ok=True)
+    fingerprints_file = os.path.join(output_dir, FINGERPRINTS_FILE)
+    previous = {}
+    if os.path.exists(fingerprints_file):
+        with open(fingerprints_file) as fingerprints_in:
+            previous = json.load(fingerprints_in)
+
+    started = time.perf_counter()
+    code = code_fingerprint()
+    fingerprints = {name: chart_fingerprint(name, sources, code, results) for name in charts}
+    missing = [name for name in charts if fingerprints[name] is None]
+    skipped = [name for name in charts if fingerprints[name] is not None and not force
+               and previous.get(name) == fingerprints[name] and os.path.exists(os.path.join(output_dir, name))]
+    stale = [name for name in charts if name not in missing and name not in skipped]
+    timings['fingerprint'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    results = dict(results or {})
+    needed = list(dict.fromkeys(CHARTS[name][0] for name in stale if CHARTS[name][0] not in results))
+    if needed:
+        results.update(run_all_hypotheses(sources, workers, hypotheses=needed))
+    timings['compute'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    jobs = []
+    for name in stale:
+        hypothesis, _, part, _ = CHARTS[name]
+        data = results[hypothesis] if part is None else results[hypothesis][part]
+        jobs.append((name, data, os.path.join(output_dir, name)))
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            rendered = list(pool.map(_render, *zip(*jobs)))
+    else:
+        rendered = [_render(*job) for job in jobs]
+    for name, seconds in rendered:
+        timings['render ' + name] = seconds
+        previous[name] = fingerprints[name]
+    timings['render'] = time.perf_counter() - started
+
+    with open(fingerprints_file, 'w') as fingerprints_out:
+        json.dump(previous, fingerprints_out, indent=1, sort_keys=True)
+    return {'rendered': stale, 'skipped': skipped, 'missing': missing, 'timings': timings}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('charts', nargs='*', help='charts to render (file names in Graphs/), all by default')
+    parser.add_argument('--data-dir', default=None, help='directory of the extracts, $NYPD_DATA_DIR or the working directory by default')
+    parser.add_argument('--output-dir', default=GRAPHS_DIR)
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, all the cores by default')
+    parser.add_argument('--force', action='store_true', help='redraw charts which are up to date')
+    arguments = parser.parse_args()
+    unknown = [name for name in arguments.charts if name not in CHARTS]
+    if unknown:
+        parser.error('unknown chart(s) {}, choose from {}'.format(unknown, list(CHARTS)))
+
+    paths = {dataset: data_path(path, arguments.data_dir) for dataset, (path, _) in DATASETS.items()}
+    summary = render_charts(paths, arguments.output_dir, arguments.workers, arguments.charts or None,
+                            arguments.force)
+    print('rendered: {}'.format(', '.join(summary['rendered']) or '-'))
+    print('skipped (up to date): {}'.format(', '.join(summary['skipped']) or '-'))
+    print('skipped (source file not found): {}'.format(', '.join(summary['missing']) or '-'))
+    print()
+    for stage, seconds in summary['timings'].items():
+        print('{:<40} {:>8.2f} s'.format(stage, seconds))
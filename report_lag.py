@@ -0,0 +1,176 @@
+"""
+Report lag analysis for Hypothesis 4 - complaints for crimes are reported in the same week/month in which
+the crime was committed.
+
+The lag between CMPLNT_FR_DT (date of occurrence) and RPT_DT (date reported) is computed as integer day
+numbers and bucketed into days, weeks and calendar months with integer arithmetic:
+
+DIFF_DAYS : RPT_DT - CMPLNT_FR_DT in days
+DIFF_WEEKS : completed weeks, DIFF_DAYS // 7 (0 means reported within 7 days)
+DIFF_MONTHS : calendar months between the two dates (0 means reported in the same calendar month)
+
+The histograms are plain count series indexed by the lag, so the histograms of separate extracts (e.g. a
+new monthly complaint file) can be folded into the stored ones with merge_report_lag_histograms instead of
+re-scanning the earlier years.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+from Functions_and_Doctests import is_chunk_stream, merge_counts
+from instrumentation import instrumented
+
+LAG_COLUMNS = ['DIFF_DAYS', 'DIFF_WEEKS', 'DIFF_MONTHS']
+
+# Marker for dates that are missing or could not be parsed
+MISSING_DAY = np.iinfo('int32').min
+
+
+# This function converts a date column into int32 day numbers (days since 1970-01-01)
+def day_numbers(series, date_format='%m/%d/%Y'):
+    """
+    This function returns the dates as int32 day numbers. String columns are parsed with date_format;
+    missing dates and strings that are not valid dates become MISSING_DAY.
+
+    :param series: Datetime column, or column of date strings
+    :param date_format: strftime format of the date strings
+    :return: NumPy int32 array of day numbers
+
+    >>> day_numbers(pd.Series(['01/01/1970', '12/31/2019', None, '02/30/2019']))
+    array([          0,       18261, -2147483648, -2147483648], dtype=int32)
+    """
+    if not pd.api.types.is_datetime64_any_dtype(series.dtype):
+        series = pd.to_datetime(series, format=date_format, errors='coerce')
+    days = series.to_numpy().astype('datetime64[D]')
+    numbers = np.full(len(days), MISSING_DAY, dtype='int32')
+    valid = ~np.isnat(days)
+    numbers[valid] = days[valid].astype('int64')
+    return numbers
+
+
+# This function computes the day, week and calendar month lag between occurrence and report
+@instrumented
+def report_lags(df, occurred_col='CMPLNT_FR_DT', reported_col='RPT_DT', date_format='%m/%d/%Y'):
+    """
+    This function computes the report lag of every complaint. Records with a missing or invalid date are
+    dropped. The result keeps the index of the input records.
+
+    :param df: Complaint dataframe containing the occurrence and report date columns
+    :param occurred_col: Date on which the crime occurred
+    :param reported_col: Date on which the crime was reported
+    :param date_format: strftime format of the dates if they still have to be parsed
+    :return: Dataframe with the int32 DIFF_DAYS, DIFF_WEEKS and DIFF_MONTHS columns
+
+    >>> df = pd.read_csv('dummy_doctest_files/Complaints_sample.csv')
+    >>> report_lags(df)
+       DIFF_DAYS  DIFF_WEEKS  DIFF_MONTHS
+    0          0           0            0
+    1          2           0            0
+    2         16           2            0
+    3         33           4            1
+    4          0           0            0
+    5          6           0            1
+    """
+    occurred = day_numbers(df[occurred_col], date_format)
+    reported = day_numbers(df[reported_col], date_format)
+    valid = (occurred != MISSING_DAY) & (reported != MISSING_DAY)
+    occurred, reported = occurred[valid], reported[valid]
+
+    days = reported - occurred
+    # Day numbers -> calendar month numbers (months since 1970-01) without going through datetimes
+    months = (reported.astype('datetime64[D]').astype('datetime64[M]').astype('int32')
+              - occurred.astype('datetime64[D]').astype('datetime64[M]').astype('int32'))
+    return pd.DataFrame({'DIFF_DAYS': days, 'DIFF_WEEKS': days // 7, 'DIFF_MONTHS': months},
+                        index=df.index[valid])
+
+
+# This function counts the values of an integer array
+def _histogram(values):
+    if not len(values):
+        return pd.Series([], dtype='int64')
+    low = values.min()
+    counts = np.bincount(values - low)
+    lags = np.flatnonzero(counts)
+    return pd.Series(counts[lags], index=lags + low, dtype='int64')
+
+
+# This function builds the day, week and month histograms of the report lag
+@instrumented
+def report_lag_histograms(df, occurred_col='CMPLNT_FR_DT', reported_col='RPT_DT', date_format='%m/%d/%Y'):
+    """
+    This function returns how many complaints were reported after each number of days, weeks and calendar
+    months. The complaints may be passed as one dataframe or as an iterable of chunks (for example from
+    data_loading.read_complaints_chunks), in which case only the histograms are kept between chunks.
+
+    :param df: Complaint dataframe or iterable of dataframe chunks
+    :param occurred_col: Date on which the crime occurred
+    :param reported_col: Date on which the crime was reported
+    :param date_format: strftime format of the dates if they still have to be parsed
+    :return: Dictionary mapping DIFF_DAYS, DIFF_WEEKS and DIFF_MONTHS to count series indexed by the lag
+
+    >>> df = pd.read_csv('dummy_doctest_files/Complaints_sample.csv')
+    >>> report_lag_histograms(df)['DIFF_WEEKS']
+    0    4
+    2    1
+    4    1
+    dtype: int64
+    """
+    if is_chunk_stream(df):
+        return merge_report_lag_histograms(report_lag_histograms(chunk, occurred_col, reported_col, date_format)
+                                           for chunk in df)
+    lags = report_lags(df, occurred_col, reported_col, date_format)
+    return {col: _histogram(lags[col].to_numpy()) for col in LAG_COLUMNS}
+
+
+# This function folds several sets of report lag histograms into one
+@instrumented
+def merge_report_lag_histograms(histograms):
+    """
+    This function adds up report lag histograms computed on separate extracts or chunks.
+
+    :param histograms: Iterable of dictionaries returned by report_lag_histograms
+    :return: Dictionary with the merged histograms
+
+    >>> df = pd.read_csv('dummy_doctest_files/Complaints_sample.csv')
+    >>> merged = merge_report_lag_histograms([report_lag_histograms(df.iloc[:4]),
+    ...                                       report_lag_histograms(df.iloc[4:])])
+    >>> merged['DIFF_MONTHS'].equals(report_lag_histograms(df)['DIFF_MONTHS'])
+    True
+    """
+    histograms = list(histograms)
+    return {col: merge_counts(histogram[col] for histogram in histograms) for col in LAG_COLUMNS}
+
+
+# This function stores report lag histograms so that later extracts can be folded into them
+def save_report_lag_histograms(histograms, path):
+    """
+    This function writes the histograms to a JSON file.
+
+    :param histograms: Dictionary returned by report_lag_histograms
+    :param path: Path of the JSON file
+    """
+    serializable = {col: {str(lag): int(count) for lag, count in histograms[col].items()} for col in LAG_COLUMNS}
+    with open(path, 'w') as out:
+        json.dump(serializable, out, indent=1)
+
+
+# This function reads histograms written by save_report_lag_histograms
+def load_report_lag_histograms(path):
+    """
+    This function reads the histograms back from a JSON file.
+
+    :param path: Path of the JSON file
+    :return: Dictionary mapping DIFF_DAYS, DIFF_WEEKS and DIFF_MONTHS to count series
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'report_lag.json')
+    >>> histograms = report_lag_histograms(pd.read_csv('dummy_doctest_files/Complaints_sample.csv'))
+    >>> save_report_lag_histograms(histograms, path)
+    >>> load_report_lag_histograms(path)['DIFF_DAYS'].equals(histograms['DIFF_DAYS'])
+    True
+    """
+    with open(path) as source:
+        stored = json.load(source)
+    return {col: pd.Series({int(lag): count for lag, count in stored[col].items()}, dtype='int64').sort_index()
+            for col in LAG_COLUMNS}
@@ -0,0 +1,369 @@
+"""
+Spatial join of the arrest/complaint locations to precincts, boroughs or neighbourhood tabulation areas.
+
+The region boundaries are read from a local GeoJSON file (as downloaded from NYC Open Data) into a
+RegionIndex, a grid-bucketed polygon index built with NumPy only:
+- a regular grid of cells covers the extent of the boundaries. Cells which no boundary edge touches lie
+  entirely inside one region (or outside all of them) and store that region, so the points falling in them
+  are assigned with a single lookup;
+- the region of a reference point of every cell is found once, at build time, with a ray casting test
+  (even-odd rule, so holes and multi-part regions are handled). A point of a boundary cell is in the region
+  of the reference point, unless the segment from the point to the reference point crosses boundary edges,
+  which can only be edges of that cell: every crossing of an edge of a region toggles whether the point is
+  in it. All the points of the boundary cells are tested at once against the few edges of their cell.
+
+Building the index takes a few seconds for the precinct boundaries, so it is cached next to the boundary
+file (in the same cache directory as the Arrow cache of data_loading.py) and only rebuilt when the file
+changes. The region of every record is added as a categorical column (add_region_column), which can be
+grouped by like the demographic columns, and normalized by the population of the regions with
+region_population_shares:
+
+    index = region_index('Police_Precincts.geojson', 'precinct')
+    arrests = add_region_column(read_arrests(['Latitude', 'Longitude']), index, 'PRECINCT')
+    grouped_population_values(arrests, 'PRECINCT', region_population_shares(populations), 'POP_BY_PRECINCT_PCT')
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from data_loading import CACHE_DIR_NAME, CACHE_FORMAT_VERSION, _cache_is_fresh, source_fingerprint
+from instrumentation import instrumented
+
+# Region layer -> (default boundary file, feature property holding the region key)
+REGION_FILES = {
+    'precinct': ('Police_Precincts.geojson', 'precinct'),
+    'borough': ('Borough_Boundaries.geojson', 'boro_name'),
+    'nta': ('Neighborhood_Tabulation_Areas.geojson', 'ntacode'),
+}
+
+# Number of grid cells along each axis of the index
+DEFAULT_GRID_CELLS = 512
+# Position of the reference point of the cells within them, off the round coordinates boundaries often
+# run along (a point on an edge has no well-defined side)
+_REFERENCE = (np.sqrt(5) - 1) / 2
+# Upper bound of the points x edges pairs tested at once
+_TEST_BLOCK = 1 << 20
+
+
+# This function reads the polygons of a GeoJSON file as edges
+def read_regions(path, key):
+    """
+    This function reads the Polygon and MultiPolygon features of a GeoJSON file and returns every ring
+    (outer rings and holes alike) as a list of edges.
+
+    :param path: Path of the GeoJSON file
+    :param key: Feature property holding the region key
+    :return: Tuple (keys, edges, edge_region): the list of region keys, an (n, 4) array of the lon0, lat0,
+             lon1, lat1 ends of every edge, and the position in keys of the region of every edge
+
+    >>> keys, edges, edge_region = read_regions('dummy_doctest_files/Regions_sample.geojson', 'region')
+    >>> keys, edges.shape, np.bincount(edge_region).tolist()
+    (['A', 'B', 'C'], (19, 4), [8, 4, 7])
+    """
+    with open(path) as geojson_in:
+        features = json.load(geojson_in)['features']
+    keys, edges, edge_region = [], [], []
+    for feature in features:
+        geometry = feature['geometry']
+        if geometry is None or geometry['type'] not in ('Polygon', 'MultiPolygon'):
+            continue
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        region = len(keys)
+        keys.append(feature['properties'][key])
+        for ring in (ring for polygon in polygons for ring in polygon):
+            ring = np.asarray(ring, dtype='float64')[:, :2]
+            if not np.array_equal(ring[0], ring[-1]):
+                ring = np.vstack([ring, ring[:1]])
+            edges.append(np.hstack([ring[:-1], ring[1:]]))
+            edge_region.append(np.full(len(ring) - 1, region))
+    return keys, np.vstack(edges), np.concatenate(edge_region).astype('int32')
+
+
+# This function lists, for every edge, the cells of a range of grid rows and columns it covers
+def _spans(first, last):
+    span = last - first + 1
+    owner = np.repeat(np.arange(len(span)), span)
+    offset = np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span)
+    return owner, offset
+
+
+# This class locates points in a set of non-overlapping polygons
+class RegionIndex:
+    """
+    Grid-bucketed point-in-polygon index of a set of regions. Build it from a GeoJSON file with
+    region_index (cached) or RegionIndex.from_file, or from edges with the constructor.
+
+    >>> index = RegionIndex.from_file('dummy_doctest_files/Regions_sample.geojson', 'region', cells=16)
+    >>> index
+    RegionIndex(3 regions, 19 edges, 16 x 16 cells)
+
+    A point in the hole of A, one outside every region and one without coordinates are not located:
+
+    >>> lat = [40.61, 40.65, 40.65, 40.72, 40.62, 40.75, np.nan]
+    >>> lon = [-73.99, -73.95, -73.85, -73.95, -73.76, -73.70, np.nan]
+    >>> index.locate(lat, lon).tolist()
+    [0, -1, 1, 2, 2, -1, -1]
+    >>> index.regions(lat, lon).tolist()
+    ['A', nan, 'B', 'C', 'C', nan, nan]
+    """
+
+    def __init__(self, keys, edges, edge_region, cells=DEFAULT_GRID_CELLS):
+        self.keys = list(keys)
+        self.edges = np.asarray(edges, dtype='float64')
+        self.edge_region = np.asarray(edge_region, dtype='int32')
+        self.cells = cells
+        lon0, lat0, lon1, lat1 = self.edges.T
+        self.west, self.east = min(lon0.min(), lon1.min()), max(lon0.max(), lon1.max())
+        self.south, self.north = min(lat0.min(), lat1.min()), max(lat0.max(), lat1.max())
+        self.cell_width = (self.east - self.west) / cells
+        self.cell_height = (self.north - self.south) / cells
+
+        # Edges bucketed by the grid rows their latitude range covers
+        first_row, last_row = self._row(np.minimum(lat0, lat1)), self._row(np.maximum(lat0, lat1))
+        owner, offset = _spans(first_row, last_row)
+        rows = first_row[owner] + offset
+        self.row_edges = owner[np.argsort(rows, kind='stable')].astype('int32')
+        self.row_offsets = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=cells))])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.inverse_slope = np.where(lat1 != lat0, (lon1 - lon0) / (lat1 - lat0), 0.0)
+
+        # Edges bucketed by the cells covered by their bounding box, the boundary cells
+        first_col, last_col = self._col(np.minimum(lon0, lon1)), self._col(np.maximum(lon0, lon1))
+        widths = last_col - first_col + 1
+        owner, offset = _spans(np.zeros_like(first_row), (last_row - first_row + 1) * widths - 1)
+        covered = (first_row[owner] + offset // widths[owner]) * cells + first_col[owner] + offset % widths[owner]
+        self.cell_edges = owner[np.argsort(covered, kind='stable')].astype('int32')
+        self.cell_offsets = np.concatenate([[0], np.cumsum(np.bincount(covered, minlength=cells * cells))])
+        self.boundary = np.diff(self.cell_offsets) > 0
+
+        # Region of the reference point of every cell, -1 outside every region
+        all_cells = np.arange(cells * cells)
+        self.cell_region = self._ray_casting(self._reference_lon(all_cells), self._reference_lat(all_cells),
+                                             all_cells // cells)
+
+    def __repr__(self):
+        return 'RegionIndex({} regions, {:,} edges, {} x {} cells)'.format(len(self.keys), len(self.edges),
+                                                                           self.cells, self.cells)
+
+    @classmethod
+    def from_file(cls, path, key, cells=DEFAULT_GRID_CELLS):
+        """
+        Builds the index of the regions of a GeoJSON file (see read_regions).
+
+        :param path: Path of the GeoJSON file
+        :param key: Feature property holding the region key
+        :param cells: Number of grid cells along each axis
+        :return: RegionIndex
+        """
+        return cls(*read_regions(path, key), cells=cells)
+
+    def _row(self, lat):
+        return np.clip(np.floor((lat - self.south) / self.cell_height), 0, self.cells - 1).astype('int64')
+
+    def _col(self, lon):
+        return np.clip(np.floor((lon - self.west) / self.cell_width), 0, self.cells - 1).astype('int64')
+
+    def _reference_lon(self, cell):
+        return self.west + (cell % self.cells + _REFERENCE) * self.cell_width
+
+    def _reference_lat(self, cell):
+        return self.south + (cell // self.cells + _REFERENCE) * self.cell_height
+
+    # This method finds the region of points with the even-odd ray casting test against the edges of their row
+    def _ray_casting(self, lon, lat, rows):
+        located = np.full(len(lon), -1, dtype='int32')
+        order = np.argsort(rows, kind='stable')
+        bounds = np.searchsorted(rows[order], np.arange(self.cells + 1))
+        for row in np.flatnonzero(np.diff(bounds)):
+            edges = self.row_edges[self.row_offsets[row]:self.row_offsets[row + 1]]
+            if not len(edges):
+                continue
+            lon0, lat0, _, lat1 = self.edges[edges].T
+            slope = self.inverse_slope[edges]
+            regions, edge_region = np.unique(self.edge_region[edges], return_inverse=True)
+            members = np.zeros((len(edges), len(regions)), dtype='float32')
+            members[np.arange(len(edges)), edge_region] = 1
+            points = order[bounds[row]:bounds[row + 1]]
+            step = max(1, _TEST_BLOCK // len(edges))
+            for start in range(0, len(points), step):
+                block = points[start:start + step]
+                point_lon, point_lat = lon[block, None], lat[block, None]
+                # A horizontal ray going east from the point crosses the edges straddling its latitude east of it
+                crossing = ((lat0 > point_lat) != (lat1 > point_lat)) & \
+                    (lon0 + (point_lat - lat0) * slope > point_lon)
+                odd = (crossing.astype('float32') @ members) % 2 == 1
+                located[block] = np.where(odd.any(axis=1), regions[odd.argmax(axis=1)], -1)
+        return located
+
+    # This method finds the region of points of boundary cells from the cell edges crossed to the reference point
+    def _cell_crossings(self, lon, lat, cell):
+        located = self.cell_region[cell]
+        counts = self.cell_offsets[cell + 1] - self.cell_offsets[cell]
+        step = max(1, _TEST_BLOCK // max(1, int(counts.max(initial=0))))
+        for start in range(0, len(cell), step):
+            block = np.arange(start, min(start + step, len(cell)))
+            owner, offset = _spans(np.zeros(len(block), dtype='int64'), counts[block] - 1)
+            point = block[owner]
+            edge = self.cell_edges[self.cell_offsets[cell[point]] + offset]
+            point_lon, point_lat = lon[point], lat[point]
+            reference_lon, reference_lat = self._reference_lon(cell[point]), self._reference_lat(cell[point])
+            lon0, lat0, lon1, lat1 = self.edges[edge].T
+
+            # The segments cross when the ends of each one lie on both sides of the other one
+            def side(from_lon, from_lat, to_lon, to_lat, at_lon, at_lat):
+                return (to_lon - from_lon) * (at_lat - from_lat) - (to_lat - from_lat) * (at_lon - from_lon) > 0
+
+            crossing = (side(lon0, lat0, lon1, lat1, point_lon, point_lat) !=
+                        side(lon0, lat0, lon1, lat1, reference_lon, reference_lat)) & \
+                (side(point_lon, point_lat, reference_lon, reference_lat, lon0, lat0) !=
+                 side(point_lon, point_lat, reference_lon, reference_lat, lon1, lat1))
+            # The point is in the regions crossed an odd number of times, the region of the reference point excepted
+            located_reference = block[located[block] >= 0]
+            pairs, parity = np.unique(np.concatenate([
+                point[crossing] * len(self.keys) + self.edge_region[edge[crossing]],
+                located_reference * len(self.keys) + located[located_reference]]), return_counts=True)
+            pairs = pairs[parity % 2 == 1]
+            located[block] = -1
+            located[pairs // len(self.keys)] = pairs % len(self.keys)
+        return located
+
+    @instrumented
+    def locate(self, lat, lon):
+        """
+        :param lat: Array-like of latitudes
+        :param lon: Array-like of longitudes
+        :return: int32 array of the position in keys of the region of every point, -1 for points outside
+                 every region or without coordinates
+        """
+        lat = np.asarray(lat, dtype='float64')
+        lon = np.asarray(lon, dtype='float64')
+        inside = (lat >= self.south) & (lat <= self.north) & (lon >= self.west) & (lon <= self.east)
+        located = np.full(len(lat), -1, dtype='int32')
+        points = np.flatnonzero(inside)
+        rows = self._row(lat[points])
+        cells = rows * self.cells + self._col(lon[points])
+        located[points] = self.cell_region[cells]
+        tested = self.boundary[cells]
+        located[points[tested]] = self._cell_crossings(lon[points[tested]], lat[points[tested]], cells[tested])
+        return located
+
+    def regions(self, lat, lon):
+        """
+        :param lat: Array-like of latitudes
+        :param lon: Array-like of longitudes
+        :return: Categorical of the region keys of the points (NaN when not located), with the keys of every
+                 region as categories
+        """
+        return pd.Categorical.from_codes(self.locate(lat, lon), categories=self.keys)
+
+    def save(self, path):
+        """
+        Writes the index (boundary edges and grid) to a NumPy .npz file.
+
+        :param path: Path of the .npz file
+        """
+        arrays = {name: value for name, value in vars(self).items() if isinstance(value, np.ndarray)}
+        np.savez(path, keys=np.asarray(self.keys), cells=self.cells, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: Path of a .npz file written by save
+        :return: RegionIndex
+        """
+        index = cls.__new__(cls)
+        with np.load(path) as saved:
+            vars(index).update((name, saved[name]) for name in saved.files)
+        index.keys, index.cells = index.keys.tolist(), int(index.cells)
+        lon0, lat0, lon1, lat1 = index.edges.T
+        index.west, index.east = min(lon0.min(), lon1.min()), max(lon0.max(), lon1.max())
+        index.south, index.north = min(lat0.min(), lat1.min()), max(lat0.max(), lat1.max())
+        index.cell_width = (index.east - index.west) / index.cells
+        index.cell_height = (index.north - index.south) / index.cells
+        return index
+
+
+# This function returns the index of a boundary file, built once and cached next to the file
+@instrumented
+def region_index(path, key, cells=DEFAULT_GRID_CELLS, cache_dir=None):
+    """
+    This function returns the RegionIndex of the regions of a GeoJSON file. The index is cached in a
+    .npz file of the cache directory of data_loading.py, so it is only built again when the GeoJSON changed.
+
+    :param path: Path of the GeoJSON file
+    :param key: Feature property holding the region key
+    :param cells: Number of grid cells along each axis
+    :param cache_dir: Directory of the cache files, a .nypd_cache directory next to the file when None
+    :return: RegionIndex
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> index = region_index('dummy_doctest_files/Regions_sample.geojson', 'region', cells=16, cache_dir=tmp)
+    >>> sorted(os.listdir(tmp))
+    ['Regions_sample.geojson.region.16.npz', 'Regions_sample.geojson.region.16.npz.json']
+    >>> cached = region_index('dummy_doctest_files/Regions_sample.geojson', 'region', cells=16, cache_dir=tmp)
+    >>> cached, cached.locate([40.61, 40.65], [-73.99, -73.95]).tolist()
+    (RegionIndex(3 regions, 19 edges, 16 x 16 cells), [0, -1])
+    >>> shutil.rmtree(tmp)
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR_NAME)
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = os.path.join(cache_dir, '{}.{}.{}.npz'.format(os.path.basename(path), key, cells))
+    meta_file = cache_file + '.json'
+    if _cache_is_fresh(path, cache_file, meta_file):
+        return RegionIndex.load(cache_file)
+    index = RegionIndex.from_file(path, key, cells)
+    index.save(cache_file)
+    with open(meta_file, 'w') as meta_out:
+        json.dump(dict(source_fingerprint(path), version=CACHE_FORMAT_VERSION), meta_out)
+    return index
+
+
+# This function adds the region of every record as a categorical column
+def add_region_column(df, index, new_col, lat_col='Latitude', lon_col='Longitude', inplace=False):
+    """
+    This function adds the key of the region holding every record (NaN for records outside every region or
+    without coordinates) as a categorical column, which can be grouped by like a demographic column.
+
+    :param df: Dataframe holding the coordinate columns
+    :param index: RegionIndex of the regions
+    :param new_col: Name of the region column to be added
+    :param lat_col: Latitude column
+    :param lon_col: Longitude column
+    :param inplace: Whether the column is added to df itself instead of a shallow copy
+    :return: Dataframe with the added region column
+
+    >>> from Functions_and_Doctests import grouped_population_values
+    >>> index = RegionIndex.from_file('dummy_doctest_files/Regions_sample.geojson', 'region', cells=16)
+    >>> df = pd.DataFrame({'Latitude': [40.61, 40.62, 40.65, 40.72], 'Longitude': [-73.99, -73.98, -73.85, -73.95]})
+    >>> df = add_region_column(df, index, 'REGION')
+    >>> df['REGION'].tolist()
+    ['A', 'A', 'B', 'C']
+    >>> shares = region_population_shares({'A': 5000, 'B': 2500, 'C': 2500})
+    >>> grouped_population_values(df, 'REGION', shares, 'POP_BY_REGION_PCT')
+      REGION  POP_BY_REGION_PCT  COUNT  NORM_VALUES  PROP_VALUES
+    0      A               0.50      2            4        33.33
+    1      B               0.25      1            4        33.33
+    2      C               0.25      1            4        33.33
+    """
+    regions = index.regions(df[lat_col], df[lon_col])
+    result = df if inplace else df.copy(deep=False)
+    result[new_col] = regions
+    return result
+
+
+# This function turns the population of every region into population shares
+def region_population_shares(populations):
+    """
+    :param populations: Dictionary or series mapping region keys to their population
+    :return: Dictionary mapping region keys to their share of the total population, for the population
+             lookups (e.g. grouped_population_values)
+
+    >>> region_population_shares({'1': 30000, '5': 10000})
+    {'1': 0.75, '5': 0.25}
+    """
+    populations = pd.Series(populations, dtype='float64')
+    return (populations / populations.sum()).to_dict()